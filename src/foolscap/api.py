@@ -20,11 +20,14 @@ from foolscap.remoteinterface import RemoteInterface
 from foolscap.referenceable import Referenceable, SturdyRef
 from foolscap.copyable import Copyable, RemoteCopy, registerRemoteCopy
 from foolscap.copyable import registerCopier, registerRemoteCopyFactory
-from foolscap.ipb import DeadReferenceError, IConnectionHintHandler
+from foolscap.ipb import DeadReferenceError, CallTimeoutError, \
+    IConnectionHintHandler
 from foolscap.tokens import BananaError
 from foolscap.schema import StringConstraint, IntegerConstraint, \
-    ListOf, TupleOf, SetOf, DictOf, ChoiceOf, Any
-from foolscap.storage import serialize, unserialize
+    StreamedBytes, ListOf, TupleOf, SetOf, DictOf, ChoiceOf, Any
+from foolscap.slicers.filebody import FileBody
+from foolscap.storage import serialize, unserialize, \
+    serialize_sync, unserialize_sync
 from foolscap.tokens import Violation, RemoteException
 from foolscap.eventual import eventually, fireEventually, flushEventualQueue
 from foolscap.logging import app_versions
@@ -37,11 +40,12 @@ _unused = [
     Referenceable, SturdyRef,
     Copyable, RemoteCopy, registerRemoteCopy,
     registerCopier, registerRemoteCopyFactory,
-    DeadReferenceError, IConnectionHintHandler,
+    DeadReferenceError, CallTimeoutError, IConnectionHintHandler,
     BananaError,
-    StringConstraint, IntegerConstraint,
+    StringConstraint, IntegerConstraint, StreamedBytes,
     ListOf, TupleOf, SetOf, DictOf, ChoiceOf, Any,
-    serialize, unserialize,
+    FileBody,
+    serialize, unserialize, serialize_sync, unserialize_sync,
     Violation, RemoteException,
     eventually, fireEventually, flushEventualQueue,
     app_versions,
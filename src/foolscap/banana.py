@@ -1,7 +1,9 @@
 
-import struct, time
+import re, struct, time
+from collections import deque
 
-from twisted.internet import protocol, defer, reactor
+from zope.interface import implements
+from twisted.internet import protocol, defer, reactor, interfaces
 from twisted.python.failure import Failure
 from twisted.python import log
 
@@ -10,33 +12,72 @@ from twisted.python import log
 from foolscap.slicers.allslicers import RootSlicer, RootUnslicer
 from foolscap.slicers.allslicers import ReplaceVocabSlicer, AddVocabSlicer
 
-import stringchain
 import tokens
 from tokens import SIZE_LIMIT, STRING, LIST, INT, NEG, \
      LONGINT, LONGNEG, VOCAB, FLOAT, OPEN, CLOSE, ABORT, ERROR, \
-     PING, PONG, \
+     PING, PONG, StringBodyChunk, \
      BananaError, BananaFailure, Violation
 
 EPSILON = 0.1
 
-def int2b128(integer, stream):
+# the receive side locates the type byte of each token with a single search
+# for the first byte with the high bit set
+_find_type_byte = re.compile(r"[\x80-\xff]").search
+
+# Nearly every header we send is small (list lengths, open counts, request
+# IDs, CLIDs, short STRING lengths), so the encoded form of every value below
+# HEADER_TABLE_SIZE is computed once and looked up by index. The same table
+# (inverted) is used to decode short headers on the receive side. Larger
+# values go through the shift-based encoder and decoder.
+HEADER_TABLE_SIZE = 2**14
+
+def _encode_b128(integer):
     if integer == 0:
-        stream(chr(0))
-        return
+        return chr(0)
     assert integer > 0, "can only encode positive integers"
+    chunks = []
     while integer:
-        stream(chr(integer & 0x7f))
-        integer = integer >> 7
+        chunks.append(chr(integer & 0x7f))
+        integer >>= 7
+    return "".join(chunks)
 
-def b1282int(st):
+def _decode_b128(st):
     # NOTE that this is little-endian
-    oneHundredAndTwentyEight = 128
     i = 0
-    place = 0
+    shift = 0
     for char in st:
-        num = ord(char)
-        i = i + (num * (oneHundredAndTwentyEight ** place))
-        place = place + 1
+        i |= ord(char) << shift
+        shift += 7
+    return i
+
+_header_table = []
+_header_decode_table = {}
+
+def setHeaderTableSize(size):
+    """Precompute the encoded headers for all values in range(size). This
+    is done at import time with HEADER_TABLE_SIZE, but may be called again
+    to trade memory for speed."""
+    global HEADER_TABLE_SIZE, _header_table, _header_decode_table
+    table = [_encode_b128(i) for i in range(size)]
+    HEADER_TABLE_SIZE = size
+    _header_table = table
+    _header_decode_table = dict(zip(table, range(size)))
+
+setHeaderTableSize(HEADER_TABLE_SIZE)
+
+def int2b128str(integer):
+    """Return the encoded header for a non-negative integer."""
+    if 0 <= integer < HEADER_TABLE_SIZE:
+        return _header_table[integer]
+    return _encode_b128(integer)
+
+def int2b128(integer, stream):
+    stream(int2b128str(integer))
+
+def b1282int(st):
+    i = _header_decode_table.get(st)
+    if i is None:
+        i = _decode_b128(st)
     return i
 
 # long_to_bytes and bytes_to_long taken from PyCrypto: Crypto/Util/number.py
@@ -90,18 +131,56 @@ def bytes_to_long(s):
 
 HIGH_BIT_SET = chr(0x80)
 
+# the largest index we will accept in an inbound (add-vocab) sequence, which
+# bounds the memory a peer can make us spend on its vocabulary. Our own
+# adaptive vocabulary never allocates an index at or above this.
+MAX_VOCAB_INDEX = 4096
+
 
 
 # Banana is a big class. It is split up into three sections: sending,
 # receiving, and connection setup. These used to be separate classes, but
 # the __init__ functions got too weird.
 
+class _StringBody:
+    """I am the sink for a large STRING body. Nothing is allocated until the
+    body actually arrives, since its size comes from the peer. If the
+    unslicer accepts a buffer, each piece is appended to a bytearray, which
+    it gets as a memoryview. Otherwise the pieces are kept as they are and
+    joined into a str at the end. Either way each byte is copied once."""
+
+    def __init__(self, asBuffer):
+        self.asBuffer = asBuffer
+        if asBuffer:
+            self.body = bytearray()
+        else:
+            self.pieces = []
+
+    def write(self, data):
+        if self.asBuffer:
+            self.body.extend(data)
+        else:
+            self.pieces.append(data)
+
+    def finish(self):
+        if self.asBuffer:
+            return memoryview(self.body)
+        return "".join(self.pieces)
+
 class Banana(protocol.Protocol):
+    # while sending large amounts of data, we register with the transport
+    # as a streaming producer, so that it can stop the produce() loop when
+    # its write buffer fills up
+    implements(interfaces.IPushProducer)
 
     def __init__(self, features={}):
         """
         @param features: a dictionary of negotiated connection features
         """
+        self.negotiatedFeatures = features.get("banana-features",
+                                               frozenset())
+        if "auto-vocab" in self.negotiatedFeatures:
+            self.useAutoVocabulary = True
         self.initSend()
         self.initReceive()
 
@@ -128,30 +207,26 @@ class Banana(protocol.Protocol):
     def connectionMade(self):
         if self.debugSend:
             print "Banana.connectionMade"
+        if getattr(self.transport, "passTokens", False):
+            self.useTokenTransport()
         self.initSlicer()
         self.initUnslicer()
-        if self.keepaliveTimeout is not None:
+        if (self.keepaliveTimeout is not None
+            or self.disconnectTimeout is not None):
             self.dataLastReceivedAt = time.time()
-            t = reactor.callLater(self.keepaliveTimeout + EPSILON,
-                                  self.keepaliveTimerFired)
-            self.keepaliveTimer = t
-            self.useKeepalives = True
-        if self.disconnectTimeout is not None:
-            self.dataLastReceivedAt = time.time()
-            t = reactor.callLater(self.disconnectTimeout + EPSILON,
-                                  self.disconnectTimerFired)
-            self.disconnectTimer = t
             self.useKeepalives = True
+            timeouts = [t for t in (self.keepaliveTimeout,
+                                    self.disconnectTimeout)
+                        if t is not None]
+            self.scheduleIdleCheck(self.dataLastReceivedAt + min(timeouts))
         # prime the pump
         self.produce()
 
     def connectionLost(self, why):
-        if self.disconnectTimer:
-            self.disconnectTimer.cancel()
-            self.disconnectTimer = None
-        if self.keepaliveTimer:
-            self.keepaliveTimer.cancel()
-            self.keepaliveTimer = None
+        self.discardOutput()
+        self.registeredAsProducer = False
+        if self.useKeepalives:
+            self.cancelIdleCheck()
         protocol.Protocol.connectionLost(self, why)
 
     ### SendBanana
@@ -162,12 +237,62 @@ class Banana(protocol.Protocol):
     paused = False
     streamable = True # this is checked at connectionMade() time
     debugSend = False
+    # encoded tokens are accumulated in self.outputBuffer and handed to the
+    # transport in a single write() when produce() finishes a top-level
+    # object, yields, or has queued at least this many bytes
+    outputFlushThreshold = 64*1024
+    # the receive buffer is compacted once this many bytes have been consumed
+    bufferCompactThreshold = 64*1024
+    # STRING bodies at least this large which arrive in pieces are collected
+    # by a _StringBody instead of accumulating in the buffer
+    largeStringThreshold = 256*1024
+    # while the transport has paused us, flushed output is held in
+    # self.pendingWrites. The produce() loop stops once sendHighWater bytes
+    # are held, and starts again when the transport has accepted all but
+    # sendLowWater of them.
+    sendHighWater = 1024*1024
+    sendLowWater = 256*1024
+    # the adaptive vocabulary promotes strings that we send in full at least
+    # autoVocabThreshold times into VOCAB entries. It is only enabled when
+    # both ends negotiated the "auto-vocab" feature, since older peers do
+    # not accept (add-vocab) sequences.
+    useAutoVocabulary = False
+    autoVocabThreshold = 3
+    autoVocabMinLength = 3 # a VOCAB token is two bytes, so skip tiny strings
+    autoVocabMaxLength = 100 # AddVocabUnslicer rejects anything longer
+    autoVocabMaxEntries = 500 # beyond this, we evict the least-used entry
+    autoVocabTrackerSize = 1000 # candidate strings we count at once
 
     def initSend(self):
         self.openCount = 0
         self.outgoingVocabulary = {}
         self.nextAvailableOutgoingVocabularyIndex = 0
         self.pendingVocabAdditions = set()
+        # maps candidate string to the number of times it was sent in full
+        self.autoVocabCandidates = {}
+        # maps each added (not initial) vocab string to its use count
+        self.addedVocabUses = {}
+        self.outputBuffer = []
+        self.outputBufferSize = 0
+        # counters, to help tune outputFlushThreshold
+        self.outputFlushes = 0
+        self.outputBytesFlushed = 0
+        self.outputLargestFlush = 0
+        # flow control
+        self.registeredAsProducer = False
+        self.transportPaused = False
+        self.pendingWrites = deque()
+        self.pendingBytes = 0
+        self.transportPauses = 0
+        self.producePauses = 0
+        self.peakPendingBytes = 0
+        self.pausedSince = None
+        self.timePaused = 0.0
+        # while a streamed STRING body is incomplete, control tokens cannot
+        # be sent: they wait here until the body is done
+        self.stringBodyRemaining = 0
+        self.heldControl = []
+        self.heldError = None
 
     def initSlicer(self):
         self.rootSlicer = self.slicerClass(self)
@@ -194,6 +319,13 @@ class Banana(protocol.Protocol):
         while self.slicerStack and not self.paused:
             if self.debugSend: print "produce.loop"
             try:
+                if len(self.slicerStack) == 1:
+                    # the RootSlicer fires the objectSentDeferred of the
+                    # previous object in .next, so everything it produced
+                    # must be on the transport by then
+                    self.flushProduced()
+                elif self.outputBufferSize >= self.outputFlushThreshold:
+                    self.flushProduced()
                 slicer, next, openID = self.slicerStack[-1]
                 obj = next()
                 if self.debugSend: print " produce.obj=%s" % (obj,)
@@ -208,6 +340,9 @@ class Banana(protocol.Protocol):
                 elif type(obj) in (int, long, float, str):
                     # sendToken raises a BananaError for weird tokens
                     self.sendToken(obj)
+                elif type(obj) is StringBodyChunk:
+                    # part of a STRING body being streamed by the slicer
+                    self.sendStringBody(obj.data)
                 else:
                     # newSlicerFor raises a Violation for unsendable types
                     # pushSlicer calls .slice, which can raise Violation
@@ -250,6 +385,7 @@ class Banana(protocol.Protocol):
             except:
                 print "exception in produce"
                 log.msg("exception in produce")
+                self.flushOutput()
                 self.sendFailed(Failure())
                 # there is no point to raising this again. The Deferreds are
                 # all errbacked in sendFailed(). This function was called
@@ -259,7 +395,139 @@ class Banana(protocol.Protocol):
                 # is nothing left to do.
                 return
 
+        self.flushProduced()
         assert self.slicerStack # should never be empty
+        if (self.registeredAsProducer and len(self.slicerStack) == 1
+            and not self.transportPaused and not self.pendingWrites):
+            # we're idle again
+            self.unregisterAsProducer()
+
+    def _write(self, data):
+        self.outputBuffer.append(data)
+        self.outputBufferSize += len(data)
+
+    def flushProduced(self):
+        # whatever produce() writes is subject to flow control, even a
+        # stream of small objects, so we register before the transport can
+        # back up. produce() unregisters once it is idle again.
+        if self.outputBuffer and not self.registeredAsProducer:
+            self.registerAsProducer()
+        self.flushOutput()
+
+    def flushOutput(self):
+        """Hand all buffered tokens to the transport in a single write."""
+        if not self.outputBuffer:
+            return
+        data = "".join(self.outputBuffer)
+        self.outputBuffer = []
+        self.outputBufferSize = 0
+        if not self.transport:
+            return
+        self.outputFlushes += 1
+        self.outputBytesFlushed += len(data)
+        self.outputLargestFlush = max(self.outputLargestFlush, len(data))
+        if self.transportPaused or self.pendingWrites:
+            self.holdOutput(data)
+        else:
+            self.transport.write(data)
+
+    def holdOutput(self, data):
+        self.pendingWrites.append(data)
+        self.pendingBytes += len(data)
+        if self.pendingBytes > self.peakPendingBytes:
+            self.peakPendingBytes = self.pendingBytes
+        if self.pendingBytes >= self.sendHighWater and not self.paused:
+            self.paused = True
+            self.producePauses += 1
+
+    def discardOutput(self):
+        self.outputBuffer = []
+        self.outputBufferSize = 0
+        self.pendingWrites.clear()
+        self.pendingBytes = 0
+
+    def registerAsProducer(self):
+        # this is only done while produce() is sending data, because
+        # transports do not finish closing while a producer is registered
+        if not hasattr(self.transport, "registerProducer"):
+            return
+        self.registeredAsProducer = True
+        self.transport.registerProducer(self, True)
+
+    def unregisterAsProducer(self):
+        # call this before transport.loseConnection()
+        if not self.registeredAsProducer:
+            return
+        self.registeredAsProducer = False
+        self.transportPaused = False
+        self.transport.unregisterProducer()
+        # the transport buffers whatever we were still holding, and writes
+        # it out before it closes
+        while self.pendingWrites:
+            data = self.pendingWrites.popleft()
+            self.pendingBytes -= len(data)
+            self.transport.write(data)
+
+    # IPushProducer, driven by the transport
+
+    def pauseProducing(self):
+        if self.transportPaused:
+            return
+        self.transportPaused = True
+        self.transportPauses += 1
+        self.pausedSince = time.time()
+
+    def resumeProducing(self):
+        if self.transportPaused:
+            self.transportPaused = False
+            self.timePaused += time.time() - self.pausedSince
+            self.pausedSince = None
+        # hand over held output until the transport pushes back again
+        # (transport.write may call pauseProducing)
+        while self.pendingWrites and not self.transportPaused:
+            data = self.pendingWrites.popleft()
+            self.pendingBytes -= len(data)
+            self.transport.write(data)
+        if self.paused and self.pendingBytes <= self.sendLowWater:
+            self.paused = False
+            self.produce()
+
+    def stopProducing(self):
+        # the connection is going away, and the transport has forgotten us
+        # (a TLS transport which has already lost its connection does this
+        # from within registerProducer)
+        self.registeredAsProducer = False
+        self.transportPaused = False
+        self.discardOutput()
+
+    def getOutputStats(self):
+        """Return a dictionary of counters that describe how the outbound
+        token buffer has been flushed to the transport: 'flushes' is the
+        number of transport writes, 'bytes' is the total number of bytes
+        written, 'bytes-per-flush' is their ratio, and 'largest-flush' is
+        the size of the biggest single write.
+
+        The flow-control counters are 'transport-pauses' (how many times the
+        transport has paused us), 'paused-time' (seconds spent paused, so
+        far), 'send-pauses' (how many times the produce() loop was stopped
+        by reaching sendHighWater), 'pending-bytes' (output being held until
+        the transport resumes), and 'peak-pending-bytes'."""
+        perFlush = 0
+        if self.outputFlushes:
+            perFlush = float(self.outputBytesFlushed) / self.outputFlushes
+        timePaused = self.timePaused
+        if self.pausedSince is not None:
+            timePaused += time.time() - self.pausedSince
+        return {"flushes": self.outputFlushes,
+                "bytes": self.outputBytesFlushed,
+                "bytes-per-flush": perFlush,
+                "largest-flush": self.outputLargestFlush,
+                "transport-pauses": self.transportPauses,
+                "paused-time": timePaused,
+                "send-pauses": self.producePauses,
+                "pending-bytes": self.pendingBytes,
+                "peak-pending-bytes": self.peakPendingBytes,
+                }
 
     def handleSendViolation(self, f, doPop, sendAbort):
         f.value.setLocation(self.describeSend())
@@ -431,7 +699,7 @@ class Banana(protocol.Protocol):
             return
         if value in self.pendingVocabAdditions:
             return
-        self.pendingVocabAdditions.add(str)
+        self.pendingVocabAdditions.add(value)
         s = AddVocabSlicer(value)
         self.send(s)
 
@@ -439,6 +707,7 @@ class Banana(protocol.Protocol):
         # this is called by the ReplaceVocabSlicer to manipulate our table.
         # It must certainly *not* be called by higher-level user code.
         self.outgoingVocabulary = newTable
+        self.addedVocabUses = {}
         if newTable:
             maxIndex = max(newTable.values()) + 1
             self.nextAvailableOutgoingVocabularyIndex = maxIndex
@@ -455,93 +724,184 @@ class Banana(protocol.Protocol):
         #
         # return self.outgoingVocabulary[string]
 
-        self.pendingVocabAdditions.remove(self.value)
         index = self.nextAvailableOutgoingVocabularyIndex
+        if (len(self.addedVocabUses) >= self.autoVocabMaxEntries
+            or index >= MAX_VOCAB_INDEX):
+            return self.evictOutgoingVocabEntry()
         self.nextAvailableOutgoingVocabularyIndex = index + 1
         return index
 
+    def evictOutgoingVocabEntry(self):
+        # the table is full, so recycle the index of the least-used added
+        # entry. This is called by AddVocabSlicer.start, so any VOCAB token
+        # for the victim has already been serialized: from now on it will be
+        # sent as a STRING, and the far end will overwrite its entry when
+        # the (add-vocab) sequence arrives.
+        uses = self.addedVocabUses
+        victim = min(uses, key=uses.get)
+        del uses[victim]
+        index = self.outgoingVocabulary.pop(victim)
+        # age the survivors, so that formerly-popular strings can be evicted
+        # too once they stop being used
+        for string in uses:
+            uses[string] >>= 1
+        return index
+
     def outgoingVocabTableWasAmended(self, index, string):
+        # the string stays pending until now, because AddVocabSlicer sends
+        # it in full (and thus through maybeVocabizeString) one more time
+        self.pendingVocabAdditions.discard(string)
         self.outgoingVocabulary[string] = index
+        self.addedVocabUses[string] = 0
 
-    # these methods define how we emit low-level tokens
+    # these methods define how we emit low-level tokens. They all append to
+    # self.outputBuffer: the ones that are used outside of produce() must
+    # flush it themselves.
 
     def sendPING(self, number=0):
-        if number:
-            int2b128(number, self.transport.write)
-        self.transport.write(PING)
+        if self.stringBodyRemaining:
+            self.heldControl.append((PING, number))
+            return
+        self._writeControl(PING, number)
+        self.flushOutput()
 
     def sendPONG(self, number):
-        if number:
-            int2b128(number, self.transport.write)
-        self.transport.write(PONG)
+        if self.stringBodyRemaining:
+            self.heldControl.append((PONG, number))
+            return
+        self._writeControl(PONG, number)
+        self.flushOutput()
+
+    def releaseControl(self):
+        # the streamed STRING body is complete, so anything that was held
+        # back can follow it
+        held, self.heldControl = self.heldControl, []
+        for typebyte, number in held:
+            self._writeControl(typebyte, number)
+        if self.heldError is not None:
+            msg, self.heldError = self.heldError, None
+            self.sendError(msg)
+
+    def _writeControl(self, typebyte, header, body=""):
+        # PING, PONG, and ERROR tokens
+        if header:
+            self._write(int2b128str(header) + typebyte)
+        else:
+            self._write(typebyte)
+        if body:
+            self._write(body)
 
     def sendOpen(self):
         openID = self.openCount
         self.openCount += 1
-        int2b128(openID, self.transport.write)
-        self.transport.write(OPEN)
+        if openID < HEADER_TABLE_SIZE:
+            self._write(_header_table[openID] + OPEN)
+        else:
+            self._write(_encode_b128(openID) + OPEN)
         return openID
 
     def sendToken(self, obj):
-        write = self.transport.write
+        write = self._write
         if isinstance(obj, (int, long)):
             if obj >= 2**31:
                 s = long_to_bytes(obj)
-                int2b128(len(s), write)
-                write(LONGINT)
+                write(int2b128str(len(s)) + LONGINT)
                 write(s)
             elif obj >= 0:
-                int2b128(obj, write)
-                write(INT)
+                if obj < HEADER_TABLE_SIZE:
+                    write(_header_table[obj] + INT)
+                else:
+                    write(_encode_b128(obj) + INT)
             elif -obj > 2**31: # NEG is [-2**31, 0)
                 s = long_to_bytes(-obj)
-                int2b128(len(s), write)
-                write(LONGNEG)
+                write(int2b128str(len(s)) + LONGNEG)
                 write(s)
             else:
-                int2b128(-obj, write)
-                write(NEG)
+                write(int2b128str(-obj) + NEG)
         elif isinstance(obj, float):
-            write(FLOAT)
-            write(struct.pack("!d", obj))
+            write(FLOAT + struct.pack("!d", obj))
         elif isinstance(obj, str):
             if self.outgoingVocabulary.has_key(obj):
                 symbolID = self.outgoingVocabulary[obj]
-                int2b128(symbolID, write)
-                write(VOCAB)
+                write(int2b128str(symbolID) + VOCAB)
+                uses = self.addedVocabUses
+                if obj in uses:
+                    uses[obj] += 1
             else:
                 self.maybeVocabizeString(obj)
-                int2b128(len(obj), write)
-                write(STRING)
+                write(int2b128str(len(obj)) + STRING)
                 write(obj)
         else:
             raise BananaError, "could not send object: %s" % repr(obj)
 
+    def sendStringHeader(self, length):
+        """Start a STRING token whose body will be supplied later, by the
+        current Slicer yielding StringBodyChunk objects that add up to
+        exactly 'length' bytes. Nothing else may be sent in between: PING,
+        PONG, and ERROR tokens are held until the body is complete."""
+        self._write(int2b128str(length) + STRING)
+        self.stringBodyRemaining = length
+
+    def sendStringBody(self, data):
+        self._write(data)
+        self.stringBodyRemaining -= len(data)
+        if not self.stringBodyRemaining and (self.heldControl
+                                             or self.heldError is not None):
+            self.releaseControl()
+
     def maybeVocabizeString(self, string):
-        # TODO: keep track of the last 30 strings we've send in full. If this
-        # string appears more than 3 times on that list, create a vocab item
-        # for it. Make sure we don't start using the vocab number until the
-        # ADDVOCAB token has been queued.
-        if False:
+        # count the strings we send in full. Once one of them has been sent
+        # autoVocabThreshold times, create a vocab item for it. We don't
+        # start using the vocab number until the ADDVOCAB sequence has been
+        # serialized (see AddVocabSlicer).
+        if not self.useAutoVocabulary:
+            return
+        if not (self.autoVocabMinLength <= len(string)
+                <= self.autoVocabMaxLength):
+            return
+        if (self.nextAvailableOutgoingVocabularyIndex >= MAX_VOCAB_INDEX
+            and not self.addedVocabUses):
+            return # no room, and nothing we are allowed to evict
+        counts = self.autoVocabCandidates
+        count = counts.get(string, 0) + 1
+        if count >= self.autoVocabThreshold:
+            del counts[string]
             self.addToOutgoingVocabulary(string)
+            return
+        if count == 1 and len(counts) >= self.autoVocabTrackerSize:
+            self.ageVocabCandidates()
+        counts[string] = count
+
+    def ageVocabCandidates(self):
+        # the tracker is full: halve every count, which forgets the strings
+        # that were only seen once
+        counts = self.autoVocabCandidates
+        for string, count in counts.items():
+            if count > 1:
+                counts[string] = count >> 1
+            else:
+                del counts[string]
 
     def sendClose(self, openID):
-        int2b128(openID, self.transport.write)
-        self.transport.write(CLOSE)
+        self._write(int2b128str(openID) + CLOSE)
 
     def sendAbort(self, count=0):
-        int2b128(count, self.transport.write)
-        self.transport.write(ABORT)
+        self._write(int2b128str(count) + ABORT)
 
     def sendError(self, msg):
         if not self.transport:
             return
+        if self.stringBodyRemaining:
+            # the connection is dropped once the body has been sent
+            if self.heldError is None:
+                self.heldError = msg
+            return
         if len(msg) > SIZE_LIMIT:
             msg = msg[:SIZE_LIMIT-10] + "..."
-        int2b128(len(msg), self.transport.write)
-        self.transport.write(ERROR)
-        self.transport.write(msg)
+        self._writeControl(ERROR, len(msg), msg)
+        self.flushOutput()
         # now you should drop the connection
+        self.unregisterAsProducer()
         self.transport.loseConnection()
 
     def sendFailed(self, f):
@@ -553,6 +913,7 @@ class Banana(protocol.Protocol):
         log.err(f)
         try:
             if self.transport:
+                self.unregisterAsProducer()
                 self.transport.loseConnection()
         except:
             print "exception during transport.loseConnection"
@@ -563,6 +924,95 @@ class Banana(protocol.Protocol):
             print "exception during rootSlicer.connectionLost"
             log.err()
 
+    # When both ends of the connection live in this process (see
+    # broker.LoopbackTransport), tokens are not encoded at all. Each one is
+    # queued as a (typebyte, header, value) tuple, and flushOutput() hands
+    # the list to transport.writeTokens(), which delivers it to the peer's
+    # tokensReceived(). The header is what the byte encoding would carry,
+    # so the receiving Unslicers check exactly what they would have checked
+    # on the wire. Slicing and unslicing still happen, so the peer gets a
+    # copy of the object graph, built by the same Unslicers (and subject to
+    # the same constraints) as if it had arrived over TCP.
+
+    passTokens = False
+
+    def useTokenTransport(self):
+        self.passTokens = True
+        self.sendOpen = self._tokenSendOpen
+        self.sendToken = self._tokenSendToken
+        self.sendStringHeader = self._tokenSendStringHeader
+        self.sendStringBody = self._tokenSendStringBody
+        self.sendClose = self._tokenSendClose
+        self.sendAbort = self._tokenSendAbort
+        self._writeControl = self._tokenWriteControl
+        self.flushOutput = self._tokenFlushOutput
+        self.streamedString = None
+
+    def _queueToken(self, token):
+        self.outputBuffer.append(token)
+        self.outputBufferSize += 1
+
+    def _tokenSendOpen(self):
+        openID = self.openCount
+        self.openCount += 1
+        self._queueToken((OPEN, openID, None))
+        return openID
+
+    def _tokenSendToken(self, obj):
+        if isinstance(obj, (int, long)):
+            if obj >= 2**31:
+                token = (LONGINT, len(long_to_bytes(obj)), long(obj))
+            elif obj >= 0:
+                token = (INT, obj, int(obj))
+            elif -obj > 2**31:
+                token = (LONGNEG, len(long_to_bytes(-obj)), long(obj))
+            else:
+                token = (NEG, -obj, int(obj))
+        elif isinstance(obj, float):
+            token = (FLOAT, 0, float(obj))
+        elif isinstance(obj, str):
+            token = (STRING, len(obj), str(obj))
+        else:
+            raise BananaError, "could not send object: %s" % repr(obj)
+        self._queueToken(token)
+
+    def _tokenSendStringHeader(self, length):
+        if length:
+            self.streamedString = (length, [])
+        else:
+            self._queueToken((STRING, 0, ""))
+
+    def _tokenSendStringBody(self, data):
+        length, pieces = self.streamedString
+        pieces.append(data)
+        length -= len(data)
+        if length > 0:
+            self.streamedString = (length, pieces)
+            return
+        self.streamedString = None
+        body = "".join(pieces)
+        self._queueToken((STRING, len(body), body))
+
+    def _tokenSendClose(self, openID):
+        self._queueToken((CLOSE, openID, None))
+
+    def _tokenSendAbort(self, count=0):
+        self._queueToken((ABORT, count, None))
+
+    def _tokenWriteControl(self, typebyte, header, body=""):
+        self._queueToken((typebyte, header, body))
+
+    def _tokenFlushOutput(self):
+        if not self.outputBuffer:
+            return
+        tokens = self.outputBuffer
+        self.outputBuffer = []
+        self.outputBufferSize = 0
+        if not self.transport:
+            return
+        self.outputFlushes += 1
+        self.transport.writeTokens(tokens)
+
     ### ReceiveBanana
     # called with dataReceived()
     # calls self.receivedObject()
@@ -573,9 +1023,8 @@ class Banana(protocol.Protocol):
     logReceiveErrors = True
     useKeepalives = False
     keepaliveTimeout = None
-    keepaliveTimer = None
     disconnectTimeout = None
-    disconnectTimer = None
+    idleTimer = None
 
     def initReceive(self):
         self.inOpen = False # set during the Index Phase of an OPEN sequence
@@ -586,7 +1035,16 @@ class Banana(protocol.Protocol):
         # self.buffer with the inbound negotiation block.
         self.negotiated = False
         self.connectionAbandoned = False
-        self.buffer = stringchain.StringChain()
+        # inbound bytes accumulate in a single bytearray. bufferOffset
+        # points at the start of the first unconsumed token: handleData
+        # advances it as tokens are parsed, and only occasionally moves the
+        # unconsumed tail back to the front of the array.
+        self.buffer = bytearray()
+        self.bufferOffset = 0
+        # the sink for a STRING body which is still arriving, and how many
+        # more bytes it needs. See handleData.
+        self.stringSink = None
+        self.stringRemaining = 0
 
         self.incomingVocabulary = {}
         self.skipBytes = 0 # used to discard a single long token
@@ -627,16 +1085,26 @@ class Banana(protocol.Protocol):
         self.incomingVocabulary = vocabDict
 
     def addIncomingVocabulary(self, key, value):
-        # called in response to an OPEN(add-vocab) sequence
+        # called in response to an OPEN(add-vocab) sequence. The sender may
+        # replace an existing entry when their table is full.
+        if not 0 <= key < MAX_VOCAB_INDEX:
+            raise BananaError("add-vocab index %d out of range" % key)
         self.incomingVocabulary[key] = value
 
     def dataReceived(self, chunk):
+        self._receive(self.handleData, chunk)
+
+    def tokensReceived(self, tokens):
+        # a list of tokens from a peer in this process, see useTokenTransport
+        self._receive(self.handleTokens, tokens)
+
+    def _receive(self, handler, data):
         if self.connectionAbandoned:
             return
         if self.useKeepalives:
             self.dataLastReceivedAt = time.time()
         try:
-            self.handleData(chunk)
+            handler(data)
         except Exception, e:
             if isinstance(e, BananaError):
                 # only reveal the reason if it is a protocol error
@@ -652,33 +1120,54 @@ class Banana(protocol.Protocol):
             self.connectionAbandoned = True
             self.reportReceiveError(Failure())
 
-    def keepaliveTimerFired(self):
-        self.keepaliveTimer = None
-        age = time.time() - self.dataLastReceivedAt
-        if age > self.keepaliveTimeout:
-            # the connection looks idle, so let's provoke a response
-            self.sendPING()
-        # we restart the timer in either case
-        t = reactor.callLater(self.keepaliveTimeout + EPSILON,
-                              self.keepaliveTimerFired)
-        self.keepaliveTimer = t
-
-    def disconnectTimerFired(self):
-        self.disconnectTimer = None
-        age = time.time() - self.dataLastReceivedAt
-        if age > self.disconnectTimeout:
-            # the connection looks dead, so drop it
-            log.msg("disconnectTimeout, no data for %d seconds" % age)
-            self.connectionTimedOut()
-            # we assume that connectionTimedOut() will actually drop the
-            # connection, so we don't restart the timer. TODO: this might not
-            # be the right thing to do, perhaps we should restart it
-            # unconditionally.
-        else:
-            # we're still ok, so restart the timer
-            t = reactor.callLater(self.disconnectTimeout + EPSILON,
-                                  self.disconnectTimerFired)
-            self.disconnectTimer = t
+    def checkIdle(self, now):
+        """Send a PING if nothing has been received for keepaliveTimeout
+        seconds, or drop the connection if nothing has been received for
+        disconnectTimeout seconds. Return the time at which I should be
+        called again, or None if the connection was dropped. Receiving data
+        only updates dataLastReceivedAt, so an active connection is simply
+        found to be not idle yet."""
+        last = self.dataLastReceivedAt
+        age = now - last
+        deadlines = []
+        if self.disconnectTimeout is not None:
+            if age >= self.disconnectTimeout:
+                # the connection looks dead, so drop it
+                log.msg("disconnectTimeout, no data for %d seconds" % age)
+                self.connectionTimedOut()
+                # we assume that connectionTimedOut() will actually drop the
+                # connection, so we don't check it again. TODO: this might
+                # not be the right thing to do.
+                return None
+            deadlines.append(last + self.disconnectTimeout)
+        if self.keepaliveTimeout is not None:
+            if age >= self.keepaliveTimeout:
+                # the connection looks idle, so let's provoke a response
+                self.sendPING()
+                deadlines.append(now + self.keepaliveTimeout)
+            else:
+                deadlines.append(last + self.keepaliveTimeout)
+        return min(deadlines)
+
+    def idleCheckFired(self, now):
+        when = self.checkIdle(now)
+        if when is not None:
+            self.scheduleIdleCheck(when)
+
+    # Brokers override these two, to share one TimerWheel per Tub
+
+    def scheduleIdleCheck(self, when):
+        delay = max(when - time.time(), 0) + EPSILON
+        self.idleTimer = reactor.callLater(delay, self._idleTimerFired)
+
+    def cancelIdleCheck(self):
+        if self.idleTimer:
+            self.idleTimer.cancel()
+            self.idleTimer = None
+
+    def _idleTimerFired(self):
+        self.idleTimer = None
+        self.idleCheckFired(time.time())
 
     def getDataLastReceivedAt(self):
         """If keepalives are enabled, this returns the seconds-since-epoch
@@ -718,40 +1207,67 @@ class Banana(protocol.Protocol):
             # skip part of the chunk, and stop skipping
             chunk = chunk[self.skipBytes:]
             self.skipBytes = 0
-        self.buffer.append(chunk)
+        if self.stringSink is not None:
+            # we are in the middle of a STRING body which is being delivered
+            # in pieces, rather than accumulated in the buffer
+            sink = self.stringSink
+            need = self.stringRemaining
+            if len(chunk) < need:
+                sink.write(chunk)
+                self.stringRemaining = need - len(chunk)
+                return
+            if len(chunk) > need:
+                sink.write(chunk[:need])
+                chunk = chunk[need:]
+            else:
+                sink.write(chunk)
+                chunk = ""
+            self.stringSink = None
+            self.stringRemaining = 0
+            # the token was checked (and accepted) when its header arrived
+            self.handleToken(sink.finish())
+        buf = self.buffer
+        buf.extend(chunk)
 
         # Loop through the available input data, extracting one token per
-        # pass.
-
-        while len(self.buffer):
-            first65 = self.buffer.popleft(65)
-            pos = 0
-            for ch in first65:
-                if ch >= HIGH_BIT_SET:
-                    break
-                pos = pos + 1
-                if pos > 64:
+        # pass. self.bufferOffset is re-read each time, and is advanced past
+        # each token before that token is delivered.
+
+        while self.bufferOffset < len(buf):
+            start = self.bufferOffset
+            m = _find_type_byte(buf, start, start+65)
+            if m is None:
+                if len(buf) - start > 64:
                     # drop the connection. We log more of the buffer, but not
                     # all of it, to make it harder for someone to spam our
                     # logs.
-                    s = first65 + self.buffer.popleft(200)
+                    s = str(buf[start:start+265])
                     raise BananaError("token prefix is limited to 64 bytes: "
                                       "but got %r" % s)
-            else:
                 # we've run out of buffer without seeing the high bit, which
                 # means we're still waiting for header to finish
-                self.buffer.appendleft(first65)
-                return
+                break
+            typepos = m.start()
+            pos = typepos - start
             assert pos <= 64
 
             # At this point, the header and type byte have been received.
-            # The body may or may not be complete.
+            # The body may or may not be complete. The header is decoded in
+            # place, without slicing it out of the buffer.
 
-            typebyte = first65[pos]
-            if pos:
-                header = b1282int(first65[:pos])
+            typebyte = chr(buf[typepos])
+            if pos == 0:
+                header = 0
+            elif pos == 1:
+                header = buf[start]
             else:
                 header = 0
+                shift = 0
+                for i in xrange(start, typepos):
+                    header |= buf[i] << shift
+                    shift += 7
+            bodystart = typepos + 1
+            available = len(buf) - bodystart
 
             # rejected is set as soon as a violation is detected. It
             # indicates that this single token will be rejected.
@@ -804,6 +1320,12 @@ class Banana(protocol.Protocol):
                         top.openerCheckToken(typebyte, header, self.opentype)
                     else:
                         top.checkToken(typebyte, header)
+                        if typebyte == VOCAB:
+                            # a VOCAB token stands in for a STRING, so the
+                            # expanded string must meet the same size limit
+                            s = self.incomingVocabulary.get(header)
+                            if s is not None:
+                                top.checkToken(STRING, len(s))
                 except Violation:
                     rejected = True
                     f = BananaFailure()
@@ -819,7 +1341,7 @@ class Banana(protocol.Protocol):
                 # them with extreme prejudice.
                 raise BananaError("oversized ERROR token")
 
-            self.buffer.appendleft(first65[pos+1:])
+            self.bufferOffset = bodystart
 
             # determine what kind of token it is. Each clause finishes in
             # one of four ways:
@@ -827,7 +1349,9 @@ class Banana(protocol.Protocol):
             #  raise BananaError: the protocol was violated so badly there is
             #                     nothing to do for it but hang up abruptly
             #
-            #  return: if the token is not yet complete (need more data)
+            #  break: if the token is not yet complete (need more data).
+            #         self.bufferOffset is wound back to the start of the
+            #         token, so it will be parsed again next time
             #
             #  continue: if the token is complete but no object (for
             #            handleToken) was produced, e.g. OPEN, CLOSE, ABORT
@@ -897,15 +1421,16 @@ class Banana(protocol.Protocol):
 
             elif typebyte == ERROR:
                 strlen = header
-                if len(self.buffer) >= strlen:
+                if available >= strlen:
                     # the whole string is available
-                    obj = self.buffer.popleft(strlen)
+                    obj = str(buffer(buf, bodystart, strlen))
+                    self.bufferOffset = bodystart + strlen
                     # handleError must drop the connection
                     self.handleError(obj)
                     return
                 else:
-                    self.buffer.appendleft(first65[:pos+1])
-                    return # there is more to come
+                    self.bufferOffset = start
+                    break # there is more to come
 
             elif typebyte == LIST:
                 raise BananaError("oldbanana peer detected, " +
@@ -914,9 +1439,10 @@ class Banana(protocol.Protocol):
 
             elif typebyte == STRING:
                 strlen = header
-                if len(self.buffer) >= strlen:
+                if available >= strlen:
                     # the whole string is available
-                    obj = self.buffer.popleft(strlen)
+                    obj = str(buffer(buf, bodystart, strlen))
+                    self.bufferOffset = bodystart + strlen
                     # although it might be rejected
                 else:
                     # there is more to come
@@ -925,11 +1451,22 @@ class Banana(protocol.Protocol):
                         # dropped
                         if self.debugReceive:
                             print "DROPPED some string bits"
-                        self.skipBytes = strlen - len(self.buffer)
-                        self.buffer.clear()
+                        self.skipBytes = strlen - available
+                        self.bufferOffset = len(buf)
                     else:
-                        self.buffer.appendleft(first65[:pos+1])
-                    return
+                        sink = None
+                        if not self.inOpen:
+                            sink = self.getStringSink(strlen)
+                        if sink is not None:
+                            # the rest of the body will go to the sink as
+                            # it arrives, instead of into the buffer
+                            sink.write(str(buffer(buf, bodystart, available)))
+                            self.stringSink = sink
+                            self.stringRemaining = strlen - available
+                            self.bufferOffset = len(buf)
+                        else:
+                            self.bufferOffset = start
+                    break
 
             elif typebyte == INT:
                 obj = int(header)
@@ -939,9 +1476,10 @@ class Banana(protocol.Protocol):
                 obj = int(-long(header))
             elif typebyte == LONGINT or typebyte == LONGNEG:
                 strlen = header
-                if len(self.buffer) >= strlen:
+                if available >= strlen:
                     # the whole number is available
-                    obj = bytes_to_long(self.buffer.popleft(strlen))
+                    obj = bytes_to_long(str(buffer(buf, bodystart, strlen)))
+                    self.bufferOffset = bodystart + strlen
                     if typebyte == LONGNEG:
                         obj = -obj
                     # although it might be rejected
@@ -950,26 +1488,24 @@ class Banana(protocol.Protocol):
                     if rejected:
                         # drop all we have and note how much more should be
                         # dropped
-                        self.skipBytes = strlen - len(self.buffer)
-                        self.buffer.clear()
+                        self.skipBytes = strlen - available
+                        self.bufferOffset = len(buf)
                     else:
-                        self.buffer.appendleft(first65[:pos+1])
-                    return
+                        self.bufferOffset = start
+                    break
 
             elif typebyte == VOCAB:
                 obj = self.incomingVocabulary[header]
-                # TODO: bail if expanded string is too big
-                # this actually means doing self.checkToken(VOCAB, len(obj))
-                # but we have to make sure we handle the rejection properly
 
             elif typebyte == FLOAT:
-                if len(self.buffer) >= 8:
-                    obj = struct.unpack("!d", self.buffer.popleft(8))[0]
+                if available >= 8:
+                    obj = struct.unpack_from("!d", buf, bodystart)[0]
+                    self.bufferOffset = bodystart + 8
                 else:
                     # this case is easier than STRING, because it is only 8
                     # bytes. We don't bother skipping anything.
-                    self.buffer.appendleft(first65[:pos+1])
-                    return
+                    self.bufferOffset = start
+                    break
 
             elif typebyte == PING:
                 self.sendPONG(header)
@@ -998,10 +1534,120 @@ class Banana(protocol.Protocol):
 
             # while loop ends here
 
-        # note: this is redundant, as there are no 'break' statements in that
-        # loop, and the loop exit condition is 'while len(self.buffer)'
-        self.buffer.clear()
+        self.compactBuffer()
+
+    def compactBuffer(self):
+        # discard consumed bytes from the front of the receive buffer. This
+        # is cheap when everything has been consumed (the usual case). When
+        # a partial token remains, the tail is only moved down once the
+        # consumed prefix is both large and more than half of the buffer, so
+        # the copying cost is amortized over many tokens.
+        offset = self.bufferOffset
+        if not offset:
+            return
+        buf = self.buffer
+        if offset >= len(buf):
+            del buf[:]
+            self.bufferOffset = 0
+        elif offset > self.bufferCompactThreshold and offset*2 > len(buf):
+            del buf[:offset]
+            self.bufferOffset = 0
+
+
+    def handleTokens(self, tokens):
+        # this is handleData for a peer that sends (typebyte, header, value)
+        # tuples instead of bytes. Every token is complete, so the only
+        # thing left to do is decide whether it is accepted.
+        for typebyte, header, obj in tokens:
+            rejected = False
+            if self.discardCount:
+                rejected = True
+
+            wasInOpen = self.inOpen
+            if typebyte == OPEN:
+                self.inboundObjectCount = self.objectCounter
+                self.objectCounter += 1
+                if self.inOpen:
+                    raise BananaError("OPEN token followed by OPEN")
+                self.inOpen = True
+
+            if ((not rejected) and
+                (typebyte not in (PING, PONG, ABORT, CLOSE, ERROR))):
+                try:
+                    top = self.receiveStack[-1]
+                    if wasInOpen:
+                        top.openerCheckToken(typebyte, header, self.opentype)
+                    else:
+                        top.checkToken(typebyte, header)
+                except Violation:
+                    rejected = True
+                    f = BananaFailure()
+                    if wasInOpen:
+                        methname = "openerCheckToken"
+                    else:
+                        methname = "checkToken"
+                    self.handleViolation(f, methname, inOpen=self.inOpen)
+                    self.inOpen = False
+
+            if typebyte == OPEN:
+                self.inboundOpenCount = header
+                if rejected:
+                    if self.inOpen:
+                        self.discardCount += 1
+                        self.inOpen = False
+                else:
+                    self.inOpen = True
+                    self.opentype = []
+                continue
+
+            elif typebyte == CLOSE:
+                if self.discardCount:
+                    self.discardCount -= 1
+                else:
+                    self.handleClose(header)
+                continue
 
+            elif typebyte == ABORT:
+                if rejected:
+                    continue
+                try:
+                    raise Violation("ABORT received")
+                except Violation:
+                    f = BananaFailure()
+                    self.handleViolation(f, "receive-abort")
+                continue
+
+            elif typebyte == ERROR:
+                if header > SIZE_LIMIT:
+                    raise BananaError("oversized ERROR token")
+                # handleError must drop the connection
+                self.handleError(obj)
+                return
+
+            elif typebyte == PING:
+                self.sendPONG(header)
+                continue
+
+            elif typebyte == PONG:
+                continue
+
+            if not rejected:
+                if self.inOpen:
+                    self.handleOpen(self.inboundOpenCount,
+                                    self.inboundObjectCount,
+                                    obj)
+                else:
+                    self.handleToken(obj)
+
+    def getStringSink(self, size):
+        # an accepted STRING token of 'size' bytes has started to arrive.
+        # The current unslicer may want to stream the body somewhere. If
+        # not, large bodies are collected by a _StringBody.
+        top = self.receiveStack[-1]
+        sink = top.getStringSink(size)
+        if sink is None and size >= self.largeStringThreshold:
+            sink = _StringBody(top.acceptsStringBuffers)
+        return sink
 
     def handleOpen(self, openCount, objectCount, indexToken):
         self.opentype.append(indexToken)
@@ -1167,6 +1813,7 @@ class Banana(protocol.Protocol):
 
     def handleError(self, msg):
         log.msg("got banana ERROR from remote side: %s" % msg)
+        self.unregisterAsProducer()
         self.transport.loseConnection()
 
 
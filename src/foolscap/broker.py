@@ -2,21 +2,25 @@
 
 # This module is responsible for the per-connection Broker object
 
-import types, time
+import types, time, heapq
 from itertools import count
+from collections import deque
 
 from zope.interface import implements
 from twisted.python import failure
-from twisted.internet import defer, error
+from twisted.internet import defer, error, reactor
 from twisted.internet import interfaces as twinterfaces
 from twisted.internet.protocol import connectionDone
 
 from foolscap import banana, tokens, ipb, vocab
 from foolscap import call, slicer, referenceable, copyable, remoteinterface
 from foolscap.constraint import Any
+from foolscap.slicers.list import ListConstraint
+from foolscap.slicers.tuple import TupleConstraint
 from foolscap.tokens import Violation, BananaError
-from foolscap.ipb import DeadReferenceError, IBroker
+from foolscap.ipb import DeadReferenceError, CallTimeoutError, IBroker
 from foolscap.slicers.root import RootSlicer, RootUnslicer, ScopedRootSlicer
+from foolscap.slicers.vocab import AddVocabUnslicer
 from foolscap.eventual import eventually
 from foolscap.logging import log
 
@@ -31,6 +35,13 @@ PBTopRegistry = {
     ("call",): call.CallUnslicer,
     ("answer",): call.AnswerUnslicer,
     ("error",): call.ErrorUnslicer,
+    # sent by peers which negotiated the "auto-vocab" feature
+    ("add-vocab",): AddVocabUnslicer,
+    # sent by peers which negotiated the "call-batch" feature
+    ("call-batch",): call.CallBatchUnslicer,
+    ("answer-batch",): call.AnswerBatchUnslicer,
+    # sent by peers which negotiated the "call-pipeline" feature
+    ("promise-call",): call.PromiseCallUnslicer,
     }
 
 PBOpenRegistry = {
@@ -113,6 +124,11 @@ class PBRootSlicer(RootSlicer):
         assert 0
 
 
+# the most (clid, count) or (giftID, count) pairs in one decref_many or
+# decgift_many message
+MAX_DECREFS = 1000
+DecrefList = ListConstraint(TupleConstraint(int, int), maxLength=MAX_DECREFS)
+
 class RIBroker(remoteinterface.RemoteInterface):
     def getReferenceByName(name=str):
         """If I have published an object by that name, return a reference to
@@ -127,6 +143,31 @@ class RIBroker(remoteinterface.RemoteInterface):
         """Release some reference to a their-reference 'giftID' that was
         sent earlier."""
         return None
+    def decref_many(refs=DecrefList):
+        """Release references to several my-references at once. 'refs' is a
+        list of (clid, count) pairs, each handled like decref(clid, count).
+        I will return an ack when all of them have been released. Only sent
+        to peers which negotiated the 'decref-many' feature."""
+        return None
+    def decgift_many(gifts=DecrefList):
+        """Release references to several their-references at once. 'gifts'
+        is a list of (giftID, count) pairs, each handled like
+        decgift(giftID, count). Only sent to peers which negotiated the
+        'decref-many' feature."""
+        return None
+    def release_answer(reqID=int):
+        """I no longer need the result of call 'reqID', which was sent with
+        RETAIN_ANSWER: I have its answer, and will not pipeline any more
+        calls onto it. Only sent to peers which negotiated the
+        'call-pipeline' feature."""
+        return None
+    def cancel(reqID=int):
+        """Abandon the call 'reqID' that was sent earlier. If it has not
+        started yet, it never will. If it is still running, I will cancel
+        the Deferred it returned. Either way, the call will be answered
+        with a CancelledError, unless it has already been answered. Only
+        sent to peers which negotiated the 'call-cancel' feature."""
+        return None
 
 
 class Broker(banana.Banana, referenceable.Referenceable):
@@ -151,12 +192,42 @@ class Broker(banana.Banana, referenceable.Referenceable):
     startingTLS = False
     startedTLS = False
     use_remote_broker = True
+    # doNextCall starts at most this many ready inbound calls before
+    # yielding the reactor
+    inboundCallsPerTurn = 100
+    # once this many inbound calls are running (their remote_ methods have
+    # been invoked but their results are not yet known), further deliveries
+    # wait in inboundDeliveryQueue. None means no limit.
+    maxInboundCalls = None
+    # callRemote gives up on answers after this many seconds, unless told
+    # otherwise with _timeout=. None means wait forever.
+    callTimeout = None
+    # we remember at most this many abandoned reqIDs, so their late answers
+    # can be discarded quietly
+    maxAbandonedRequests = 1000
+    # set when both ends negotiated the "call-cancel" feature
+    useCallCancel = False
+    # set when both ends negotiated the "call-batch" feature
+    useCallBatch = False
+    # set when both ends negotiated the "decref-many" feature
+    useDecrefMany = False
+    # set when both ends negotiated the "call-pipeline" feature
+    useCallPipeline = False
+    timerWheel = None
 
     def __init__(self, remote_tubref, params={},
                  keepaliveTimeout=None, disconnectTimeout=None):
         banana.Banana.__init__(self, params)
         self._expose_remote_exception_types = True
         self.remote_tubref = remote_tubref
+        if "call-cancel" in self.negotiatedFeatures:
+            self.useCallCancel = True
+        if "call-batch" in self.negotiatedFeatures:
+            self.useCallBatch = True
+        if "decref-many" in self.negotiatedFeatures:
+            self.useDecrefMany = True
+        if "call-pipeline" in self.negotiatedFeatures:
+            self.useCallPipeline = True
         self.keepaliveTimeout = keepaliveTimeout
         self.disconnectTimeout = disconnectTimeout
         self._banana_decision_version = params.get("banana-decision-version")
@@ -179,6 +250,11 @@ class Broker(banana.Banana, referenceable.Referenceable):
         # receiving side uses these
         self.yourReferenceByCLID = {}
         self.yourReferenceByURL = {}
+        # with "decref-many", the decrefs and decgifts from one turn are
+        # collected here and sent together when the turn ends
+        self.pendingDecrefs = {} # maps CLID to [tracker, count]
+        self.pendingDecgifts = {} # maps giftID to count
+        self._decrefFlushScheduled = False
 
         # tracking Gifts
         self.nextGiftID = count(1).next
@@ -189,11 +265,31 @@ class Broker(banana.Banana, referenceable.Referenceable):
         # sending side uses these
         self.nextReqID = count(1).next # 0 means "we don't want a response"
         self.waitingForAnswers = {} # we wait for the other side to answer
+        # (deadline, reqID) for requests with a timeout. A single timer
+        # fires for the earliest one. Requests that are answered in time
+        # are skipped when their deadline comes up, or dropped when they
+        # make up most of the heap.
+        self.requestDeadlines = []
+        self.requestTimer = None
+        self.requestTimerDeadline = None
+        # reqIDs which timed out: their answers are discarded
+        self.abandonedRequests = set()
         self.disconnectWatchers = []
         # receiving side uses these
-        self.inboundDeliveryQueue = []
+        self.inboundDeliveryQueue = deque()
         self._waiting_for_call_to_be_ready = False
+        self._doNextCallScheduled = False
+        self.inboundCallsInFlight = 0
+        self._waiting_for_calls_to_finish = False
         self.activeLocalCalls = {} # the other side wants an answer from us
+        # maps reqID to the Deferred returned by its remote_ method, while
+        # that is still running
+        self.runningLocalCalls = {}
+        # reqIDs cancelled before their remote_ method was invoked
+        self.cancelledLocalCalls = set()
+        # maps reqID to a RetainedAnswer, for calls whose results may have
+        # further calls pipelined onto them
+        self.retainedAnswers = {}
 
     def setTub(self, tub):
         assert ipb.ITub.providedBy(tub)
@@ -203,6 +299,28 @@ class Broker(banana.Banana, referenceable.Referenceable):
         if tub.debugBanana:
             self.debugSend = True
             self.debugReceive = True
+        if tub.sendHighWater is not None:
+            self.sendHighWater = tub.sendHighWater
+        if tub.sendLowWater is not None:
+            self.sendLowWater = tub.sendLowWater
+        if tub.inboundCallsPerTurn is not None:
+            self.inboundCallsPerTurn = tub.inboundCallsPerTurn
+        self.maxInboundCalls = tub.maxInboundCallsPerConnection
+        self.callTimeout = tub.callTimeout
+
+    def scheduleIdleCheck(self, when):
+        # all of a Tub's connections share one TimerWheel, rather than each
+        # keeping its own reactor timer
+        if self.timerWheel is None and self.tub:
+            self.timerWheel = self.tub.getTimerWheel()
+        if self.timerWheel is None:
+            return banana.Banana.scheduleIdleCheck(self, when)
+        self.timerWheel.schedule(self, when, self.idleCheckFired)
+
+    def cancelIdleCheck(self):
+        if self.timerWheel is None:
+            return banana.Banana.cancelIdleCheck(self)
+        self.timerWheel.cancel(self)
 
     def connectionMade(self):
         banana.Banana.connectionMade(self)
@@ -240,6 +358,7 @@ class Broker(banana.Banana, referenceable.Referenceable):
             self.disconnectWatchers = []
         self.finish(why)
         # loseConnection eventually provokes connectionLost()
+        self.unregisterAsProducer()
         self.transport.loseConnection()
 
     def connectionLost(self, why):
@@ -256,6 +375,10 @@ class Broker(banana.Banana, referenceable.Referenceable):
         assert isinstance(why, failure.Failure), why
         self.disconnected = True
         self.remote_broker = None
+        if self.requestTimer:
+            self.requestTimer.cancel()
+            self.requestTimer = None
+        self.requestDeadlines = []
         self.abandonAllRequests(why)
         # TODO: why reset all the tables to something useable? There may be
         # outstanding RemoteReferences that point to us, but I don't see why
@@ -357,6 +480,14 @@ class Broker(banana.Banana, referenceable.Referenceable):
         if not self.remote_broker: # tests do not set this up
             self.freeYourReferenceTracker(None, tracker)
             return
+        if self.useDecrefMany:
+            pending = self.pendingDecrefs.get(tracker.clid)
+            if pending:
+                pending[1] += count
+            else:
+                self.pendingDecrefs[tracker.clid] = [tracker, count]
+            self._scheduleDecrefFlush()
+            return
         try:
             rb = self.remote_broker
             # TODO: do we want callRemoteOnly here? is there a way we can
@@ -381,10 +512,7 @@ class Broker(banana.Banana, referenceable.Referenceable):
             d = rb.callRemote("decref", clid=tracker.clid, count=count)
             # if the connection was lost before we can get an ack, we're
             # tearing this down anyway
-            def _ignore_loss(f):
-                f.trap(DeadReferenceError, *LOST_CONNECTION_ERRORS)
-                return None
-            d.addErrback(_ignore_loss)
+            d.addErrback(self._ignoreLoss)
             # once the ack comes back, or if we know we'll never get one,
             # release the tracker
             d.addCallback(self.freeYourReferenceTracker, tracker)
@@ -393,6 +521,53 @@ class Broker(banana.Banana, referenceable.Referenceable):
             log.msg("failure during freeRemoteReference", facility="foolscap",
                     level=log.UNUSUAL, failure=f)
 
+    def _ignoreLoss(self, f):
+        f.trap(DeadReferenceError, *LOST_CONNECTION_ERRORS)
+        return None
+
+    def releaseGift(self, giftID, count):
+        # this is called when a their-reference we received has been
+        # resolved, to tell the sender it can forget about the gift
+        rb = self.remote_broker
+        if not self.useDecrefMany:
+            # if we lose the connection, they'll decref the gift anyway
+            rb.callRemoteOnly("decgift", giftID=giftID, count=count)
+            return
+        self.pendingDecgifts[giftID] = self.pendingDecgifts.get(giftID,
+                                                                0) + count
+        self._scheduleDecrefFlush()
+
+    def _scheduleDecrefFlush(self):
+        if not self._decrefFlushScheduled:
+            self._decrefFlushScheduled = True
+            eventually(self._flushDecrefs)
+
+    def _flushDecrefs(self):
+        self._decrefFlushScheduled = False
+        decrefs, self.pendingDecrefs = self.pendingDecrefs.values(), {}
+        decgifts, self.pendingDecgifts = self.pendingDecgifts.items(), {}
+        try:
+            rb = self.remote_broker
+            for i in range(0, len(decgifts), MAX_DECREFS):
+                rb.callRemoteOnly("decgift_many",
+                                  gifts=decgifts[i:i+MAX_DECREFS])
+            for i in range(0, len(decrefs), MAX_DECREFS):
+                chunk = decrefs[i:i+MAX_DECREFS]
+                refs = [(tracker.clid, refcount)
+                        for (tracker, refcount) in chunk]
+                d = rb.callRemote("decref_many", refs=refs)
+                d.addErrback(self._ignoreLoss)
+                d.addCallback(self._freeYourReferenceTrackers,
+                              [tracker for (tracker, refcount) in chunk])
+        except:
+            f = failure.Failure()
+            log.msg("failure during _flushDecrefs", facility="foolscap",
+                    level=log.UNUSUAL, failure=f)
+
+    def _freeYourReferenceTrackers(self, res, trackers):
+        for tracker in trackers:
+            self.freeYourReferenceTracker(res, tracker)
+
     def freeYourReferenceTracker(self, res, tracker):
         if tracker.received_count != 0:
             return
@@ -432,6 +607,10 @@ class Broker(banana.Banana, referenceable.Referenceable):
             del self.myReferenceByPUID[tracker.puid]
             del self.myReferenceByCLID[clid]
 
+    def remote_decref_many(self, refs):
+        for (clid, refcount) in refs:
+            self.remote_decref(clid, refcount)
+
     # methods to send RemoteReference 'gifts' to third-parties
 
     def makeGift(self, rref):
@@ -458,6 +637,10 @@ class Broker(banana.Banana, referenceable.Referenceable):
         else:
             self.myGifts[(broker, clid)] = (rref, giftID, gift_count)
 
+    def remote_decgift_many(self, gifts):
+        for (giftID, refcount) in gifts:
+            self.remote_decgift(giftID, refcount)
+
     # methods to deal with URLs
 
     def getYourReferenceByName(self, name):
@@ -467,6 +650,18 @@ class Broker(banana.Banana, referenceable.Referenceable):
     def remote_getReferenceByName(self, name):
         return self.tub.getReferenceForName(name)
 
+    def remote_cancel(self, reqID):
+        d = self.runningLocalCalls.get(reqID)
+        if d:
+            # this errbacks the call with CancelledError, unless the
+            # remote_ method's canceller provides some other result
+            d.cancel()
+        elif reqID in self.activeLocalCalls:
+            # still being received, or waiting in inboundDeliveryQueue.
+            # _startCall will fail it instead of invoking the method.
+            self.cancelledLocalCalls.add(reqID)
+        # otherwise it has already been answered
+
     # remote-method-invocation methods, calling side, invoked by
     # RemoteReference.callRemote and CallSlicer
 
@@ -475,20 +670,85 @@ class Broker(banana.Banana, referenceable.Referenceable):
             raise DeadReferenceError("Calling Stale Broker")
         return self.nextReqID()
 
-    def addRequest(self, req):
+    def addRequest(self, req, timeout=None):
         req.broker = self
         self.waitingForAnswers[req.reqID] = req
+        if timeout is not None:
+            deadline = reactor.seconds() + timeout
+            req.timeout = timeout
+            heapq.heappush(self.requestDeadlines, (deadline, req.reqID))
+            if (self.requestTimer is None
+                or deadline < self.requestTimerDeadline):
+                self._startRequestTimer(deadline)
 
     def removeRequest(self, req):
-        del self.waitingForAnswers[req.reqID]
+        waiting = self.waitingForAnswers
+        del waiting[req.reqID]
+        deadlines = self.requestDeadlines
+        if len(deadlines) > 2*len(waiting):
+            # most of these belong to requests that were answered in time.
+            # _requestTimerFired may be looping over the heap, so it is
+            # rebuilt in place.
+            deadlines[:] = [(deadline, reqID)
+                            for (deadline, reqID) in deadlines
+                            if reqID in waiting]
+            heapq.heapify(deadlines)
+            if not deadlines and self.requestTimer:
+                self.requestTimer.cancel()
+                self.requestTimer = None
 
     def getRequest(self, reqID):
         # invoked by AnswerUnslicer and ErrorUnslicer
         try:
             return self.waitingForAnswers[reqID]
         except KeyError:
+            if reqID in self.abandonedRequests:
+                self.abandonedRequests.remove(reqID)
+                return call.DiscardedRequest(reqID)
             raise Violation("non-existent reqID '%d'" % reqID)
 
+    def abandonRequest(self, reqID):
+        # we have given up on this request (it timed out or was cancelled),
+        # so we will discard the answer if one arrives, and ask the far end
+        # to stop working on it
+        abandoned = self.abandonedRequests
+        abandoned.add(reqID)
+        if len(abandoned) > self.maxAbandonedRequests:
+            # the far end is not answering, so this must not grow without
+            # bound. reqIDs only increase, so we forget the oldest half: a
+            # very late answer to one of those is a Violation instead.
+            for old in sorted(abandoned)[:len(abandoned)//2]:
+                abandoned.remove(old)
+        if self.useCallCancel and self.remote_broker:
+            self.remote_broker.callRemoteOnly("cancel", reqID=reqID)
+
+    def _startRequestTimer(self, deadline):
+        if self.requestTimer:
+            self.requestTimer.cancel()
+        delay = max(deadline - reactor.seconds(), 0)
+        self.requestTimer = reactor.callLater(delay, self._requestTimerFired)
+        self.requestTimerDeadline = deadline
+
+    def _requestTimerFired(self):
+        self.requestTimer = None
+        now = reactor.seconds()
+        deadlines = self.requestDeadlines
+        while deadlines and deadlines[0][0] <= now:
+            deadline, reqID = heapq.heappop(deadlines)
+            req = self.waitingForAnswers.get(reqID)
+            if req:
+                self.timeoutRequest(req)
+        if deadlines:
+            self._startRequestTimer(deadlines[0][0])
+
+    def timeoutRequest(self, req):
+        tubid = None
+        if self.remote_tubref:
+            tubid = self.remote_tubref.getShortTubID()
+        e = CallTimeoutError(req.timeout, tubid, req)
+        req.fail(failure.Failure(e))
+        self.abandonRequest(req.reqID)
+
     def abandonAllRequests(self, why):
         for req in self.waitingForAnswers.values():
             if why.check(*LOST_CONNECTION_ERRORS):
@@ -505,6 +765,25 @@ class Broker(banana.Banana, referenceable.Referenceable):
 
     # target-side, invoked by CallUnslicer
 
+    def retainAnswer(self, reqID):
+        self.retainedAnswers[reqID] = call.RetainedAnswer()
+
+    def resolveRetainedAnswer(self, reqID, res):
+        answer = self.retainedAnswers.get(reqID)
+        if answer and not answer.resolved:
+            answer.resolve(res)
+            if answer.released:
+                del self.retainedAnswers[reqID]
+
+    def remote_release_answer(self, reqID):
+        answer = self.retainedAnswers.get(reqID)
+        if answer:
+            if answer.resolved:
+                del self.retainedAnswers[reqID]
+            else:
+                # calls pipelined onto it are still waiting
+                answer.released = True
+
     def getRemoteInterfaceByName(self, riname):
         # this lives in the broker because it ought to be per-connection
         return remoteinterface.RemoteInterfaceRegistry[riname]
@@ -520,47 +799,114 @@ class Broker(banana.Banana, referenceable.Referenceable):
         return None
 
     def scheduleCall(self, delivery, ready_deferred):
+        if (delivery.obj is self and delivery.methodname == "cancel"
+            and not ready_deferred):
+            # a cancel must not wait in the queue behind the very call it
+            # is trying to stop, so it is delivered right away
+            d = defer.maybeDeferred(self._doCall, delivery)
+            d.addCallback(self._callFinished, delivery)
+            d.addErrback(self.callFailed, delivery.reqID, delivery)
+            d.addErrback(log.err)
+            return
         self.inboundDeliveryQueue.append( (delivery,ready_deferred) )
-        eventually(self.doNextCall)
+        self._scheduleNextCall()
 
-    def doNextCall(self):
-        if self.disconnected:
-            return
-        if self._waiting_for_call_to_be_ready:
-            return
-        if not self.inboundDeliveryQueue:
-            return
-        delivery, ready_deferred = self.inboundDeliveryQueue.pop(0)
-        self._waiting_for_call_to_be_ready = True
-        if not ready_deferred:
-            ready_deferred = defer.succeed(None)
-        d = ready_deferred
-
-        def _ready(res):
-            self._waiting_for_call_to_be_ready = False
+    def _scheduleNextCall(self):
+        # a burst of inbound calls only needs one doNextCall
+        if not self._doNextCallScheduled:
+            self._doNextCallScheduled = True
             eventually(self.doNextCall)
-            return res
-        d.addBoth(_ready)
-
-        # at this point, the Deferred chain for this one delivery runs
-        # independently of any other, and methods which take a long time to
-        # complete will not hold up other methods. We must call _doCall and
-        # let the remote_ method get control before we process any other
-        # message, but the eventually() above insures we'll have a chance to
-        # do that before we give up control.
-
-        d.addCallback(lambda res: self._doCall(delivery))
-        d.addCallback(self._callFinished, delivery)
-        d.addErrback(self.callFailed, delivery.reqID, delivery)
-        d.addErrback(log.err)
+
+    def doNextCall(self):
+        self._doNextCallScheduled = False
+        queue = self.inboundDeliveryQueue
+        for i in range(self.inboundCallsPerTurn):
+            if self.disconnected:
+                return
+            if self._waiting_for_call_to_be_ready:
+                return
+            if not queue:
+                return
+            if (self.maxInboundCalls is not None
+                and self.inboundCallsInFlight >= self.maxInboundCalls):
+                # _inboundCallDone will continue when one of them finishes
+                self._waiting_for_calls_to_finish = True
+                return
+            delivery, ready_deferred = queue.popleft()
+            if not ready_deferred:
+                d = defer.succeed(None)
+            elif ready_deferred.called and not ready_deferred.paused:
+                d = ready_deferred
+            else:
+                # this call (and every one behind it) must wait until its
+                # arguments are ready
+                self._waiting_for_call_to_be_ready = True
+                d = ready_deferred
+                def _ready(res):
+                    self._waiting_for_call_to_be_ready = False
+                    self._scheduleNextCall()
+                    return res
+                d.addBoth(_ready)
+
+            # at this point, the Deferred chain for this one delivery runs
+            # independently of any other, and methods which take a long time
+            # to complete will not hold up other methods. We must call
+            # _doCall and let the remote_ method get control before we
+            # process any other message. If the call was ready, d has
+            # already fired, and _doCall runs right here, before we go
+            # around the loop for the next one. If not, the loop stops
+            # until _ready lets it continue.
+
+            d.addCallback(lambda res, delivery=delivery:
+                          self._startCall(delivery))
+            d.addCallback(self._callFinished, delivery)
+            d.addErrback(self.callFailed, delivery.reqID, delivery)
+            d.addErrback(log.err)
+        if queue:
+            # we've used up this turn's budget, let other events run
+            self._scheduleNextCall()
         return None
 
+    def _startCall(self, delivery):
+        reqID = delivery.reqID
+        if reqID in self.cancelledLocalCalls:
+            self.cancelledLocalCalls.remove(reqID)
+            raise defer.CancelledError()
+        self.inboundCallsInFlight += 1
+        d = defer.maybeDeferred(self._doCall, delivery)
+        if reqID and not d.called:
+            self.runningLocalCalls[reqID] = d
+        d.addBoth(self._inboundCallDone, reqID)
+        return d
+
+    def _inboundCallDone(self, res, reqID):
+        self.runningLocalCalls.pop(reqID, None)
+        self.inboundCallsInFlight -= 1
+        if self._waiting_for_calls_to_finish:
+            self._waiting_for_calls_to_finish = False
+            self._scheduleNextCall()
+        return res
+
+    def getInboundQueueStats(self):
+        """Return a dictionary describing the inbound calls that are
+        waiting to be started, and the ones which are running."""
+        return {"queued": len(self.inboundDeliveryQueue),
+                "in-flight": self.inboundCallsInFlight,
+                "max-in-flight": self.maxInboundCalls,
+                }
+
     def _doCall(self, delivery):
         # our ordering rules require that the order in which each
         # remote_foo() method gets control is exactly the same as the order
         # in which the original caller invoked callRemote(). To insure this,
         # _startCall() is not allowed to insert additional delays before it
-        # runs doRemoteCall() on the target object.
+        # runs doRemoteCall() on the target object. The exception is a call
+        # pipelined onto an answer, which waits for that answer, and so is
+        # only ordered with respect to other calls on the same answer.
+        if delivery.answerTarget:
+            d = delivery.answerTarget.whenResolved()
+            d.addCallback(self._doPipelinedCall, delivery)
+            return d
         obj = delivery.obj
         args = delivery.allargs.args
         kwargs = delivery.allargs.kwargs
@@ -568,10 +914,12 @@ class Broker(banana.Banana, referenceable.Referenceable):
             assert not isinstance(i, defer.Deferred)
 
         if delivery.methodSchema:
-            # we asked about each argument on the way in, but ask again so
-            # they can look for missing arguments. TODO: see if we can remove
-            # the redundant per-argument checks.
-            delivery.methodSchema.checkAllArgs(args, kwargs, True)
+            # we asked about each argument on the way in. If that settled
+            # everything, we only need to look for missing arguments.
+            if delivery.allargs.checked:
+                delivery.methodSchema.checkRequiredArgs(args, kwargs)
+            else:
+                delivery.methodSchema.checkAllArgs(args, kwargs, True)
 
         # interesting case: if the method completes successfully, but
         # our schema prohibits us from sending the result (perhaps the
@@ -587,6 +935,34 @@ class Broker(banana.Banana, referenceable.Referenceable):
             return obj.doRemoteCall(delivery.methodname, args, kwargs)
 
 
+    def _doPipelinedCall(self, target, delivery):
+        # the target must be something we could send as a my-reference
+        if not ipb.IRemotelyCallable.providedBy(target):
+            raise Violation("pipelined call to %s, which is not Referenceable"
+                            % (target,))
+        delivery.obj = target
+        delivery.answerTarget = None
+        getDispatchTable = getattr(target, "getDispatchTable", None)
+        if getDispatchTable:
+            dispatch = getDispatchTable()
+            delivery.interface = dispatch.interface
+            ms = dispatch.getMethodSchema(delivery.methodname)
+        else:
+            delivery.interface = target.getInterface()
+            ms = None
+            if delivery.interface:
+                ms = delivery.interface.get(delivery.methodname)
+        if delivery.interface:
+            if not ms:
+                why = "method '%s' not defined in %s" % \
+                      (delivery.methodname, delivery.interface.__remote_name__)
+                raise Violation(why)
+            delivery.methodSchema = ms
+        elif self.requireSchema:
+            why = "This broker does not accept unconstrained method calls"
+            raise Violation(why)
+        return self._doCall(delivery)
+
     def _callFinished(self, res, delivery):
         reqID = delivery.reqID
         if reqID == 0:
@@ -602,7 +978,12 @@ class Broker(banana.Banana, referenceable.Referenceable):
                 v.prependLocation("in return value of %s.%s" %
                                   (delivery.obj, methodSchema.name))
                 raise
+        self.resolveRetainedAnswer(reqID, res)
 
+        if delivery.batch:
+            delivery.batch.answer(reqID, res)
+            del self.activeLocalCalls[reqID]
+            return
         answer = call.AnswerSlicer(reqID, res, methodName)
         # once the answer has started transmitting, any exceptions must be
         # logged and dropped, and not turned into an Error to be sent.
@@ -628,8 +1009,13 @@ class Broker(banana.Banana, referenceable.Referenceable):
                 delivery.logFailure(f)
         if reqID != 0:
             assert self.activeLocalCalls[reqID]
-            self.send(call.ErrorSlicer(reqID, f))
+            self.resolveRetainedAnswer(reqID, f)
+            if delivery and delivery.batch:
+                delivery.batch.fail(reqID, f)
+            else:
+                self.send(call.ErrorSlicer(reqID, f))
             del self.activeLocalCalls[reqID]
+            self.cancelledLocalCalls.discard(reqID)
 
 class StorageBrokerRootSlicer(ScopedRootSlicer):
     # each StorageBroker is a single serialization domain, so we inherit from
@@ -704,7 +1090,9 @@ class StorageBroker(Broker):
 
 # this loopback stuff is based upon twisted.protocols.loopback, except that
 # we use it for real, not just for testing. The IConsumer stuff hasn't been
-# tested at all.
+# tested at all. Since both Brokers are in the same process, they exchange
+# Banana tokens instead of bytes (see Banana.useTokenTransport), which
+# skips encoding and parsing but keeps the eventual-send ordering.
 
 class LoopbackAddress(object):
     implements(twinterfaces.IAddress)
@@ -714,6 +1102,7 @@ class LoopbackTransport(object):
     implements(twinterfaces.ITransport, twinterfaces.IConsumer)
 
     producer = None
+    passTokens = True
 
     def __init__(self):
         self.connected = True
@@ -725,9 +1114,15 @@ class LoopbackTransport(object):
     def writeSequence(self, iovec):
         self.write(''.join(iovec))
 
+    def writeTokens(self, tokens):
+        eventually(self.peer.tokensReceived, tokens)
+
     def dataReceived(self, data):
         if self.connected:
             self.protocol.dataReceived(data)
+    def tokensReceived(self, tokens):
+        if self.connected:
+            self.protocol.tokensReceived(tokens)
 
     def loseConnection(self, _connDone=connectionDone):
         if not self.connected:
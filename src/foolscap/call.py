@@ -8,6 +8,7 @@ from foolscap.constraint import ByteStringConstraint
 from foolscap.slicers.list import ListConstraint
 from tokens import BananaError, Violation
 from foolscap.util import AsyncAND
+from foolscap.observer import OneShotObserverList
 from foolscap.logging import log
 
 def wrap_remote_failure(f):
@@ -31,34 +32,65 @@ class FailureConstraint(AttributeDictConstraint):
             raise Violation("is not an instance of %s" % self.klass)
 
 
+# the most calls that one 'call-batch' sequence may carry. callRemoteBatch
+# splits longer lists into several batches.
+MAX_BATCH_CALLS = 1000
+
+# flags for a 'promise-call' sequence
+RETAIN_ANSWER = 1 # keep the result, later calls may be pipelined onto it
+TARGET_IS_ANSWER = 2 # the target is the result of an earlier call
+
 class PendingRequest(object):
     # this object is a local representation of a message we have sent to
     # someone else, that will be executed on their end.
     active = True
+    timeout = None # seconds, if the broker will give up on us
 
     def __init__(self, reqID, rref, interface_name, method_name):
         self.reqID = reqID
         self.rref = rref # keep it alive
         self.broker = None # if set, the broker knows about us
-        self.deferred = defer.Deferred()
+        self.deferred = defer.Deferred(self._cancel)
         self.constraint = None # this constrains the results
         self.failure = None
-        self.interface_name = interface_name # for error messages
-        self.method_name = method_name # same
+        self.interfaceName = interface_name # for error messages
+        self.methodName = method_name # same
 
     def setConstraint(self, constraint):
         self.constraint = constraint
 
     def getMethodNameInfo(self):
-        return (self.interface_name, self.method_name)
+        return (self.interfaceName, self.methodName)
+
+    def _cancel(self, d):
+        # the caller has lost interest. Our Deferred will errback with
+        # CancelledError as soon as we return.
+        if self.active:
+            self.active = False
+            self.rref = None
+            if self.broker:
+                self.broker.removeRequest(self)
+                self.broker.abandonRequest(self.reqID)
+
+    def _answerAbandoned(self):
+        # an answer was already arriving when we gave up on this request
+        # (it timed out or was cancelled), so the broker has no
+        # DiscardedRequest to absorb it. We do it instead.
+        if self.broker and self.reqID in self.broker.abandonedRequests:
+            self.broker.abandonedRequests.discard(self.reqID)
+            return True
+        return False
 
     def complete(self, res):
-        if self.broker:
-            self.broker.removeRequest(self)
         if self.active:
+            if self.broker:
+                self.broker.removeRequest(self)
             self.active = False
+            # our canceller makes a cycle through self.deferred, so drop the
+            # RemoteReference now rather than waiting for the collector
+            self.rref = None
             self.deferred.callback(res)
-        else:
+        elif not self._answerAbandoned():
             log.msg("PendingRequest.complete called on an inactive request")
 
     def fail(self, why):
@@ -92,7 +124,10 @@ class PendingRequest(object):
                 log.msg(" the REMOTE failure was:", failure=why,
                         level=log.NOISY, parent=lp)
                 #log.msg(stack, level=log.NOISY, parent=lp)
+            self.rref = None
             self.deferred.errback(why)
+        elif self._answerAbandoned():
+            pass
         else:
             log.msg("WEIRD: fail() on an inactive request", traceback=True)
             if self.failure:
@@ -101,6 +136,55 @@ class PendingRequest(object):
                 log.msg("this one was:", why)
                 log.err("multiple failures indicate a problem")
 
+class CallPlan(object):
+    """I hold what stays the same from one outbound call to the next, for
+    calls of one method through one RemoteReference: the interface and
+    method names, the method's schema, and the constraint for its answer.
+    The RemoteReferenceTracker keeps one for each method that has been
+    called, so a callRemote() without options only has to check its
+    arguments and build the PendingRequest.
+    """
+
+    def __init__(self, interfaceName, methodName, methodSchema):
+        self.interfaceName = interfaceName
+        self.methodName = methodName
+        self.methodSchema = methodSchema
+        self.responseConstraint = None
+        if methodSchema:
+            self.responseConstraint = methodSchema.getResponseConstraint()
+
+    def checkArgs(self, methodSchema, args, kwargs):
+        # check args against the arg constraint. This could fail if any
+        # arguments are of the wrong type
+        try:
+            methodSchema.checkAllArgs(args, kwargs, False)
+        except Violation, v:
+            v.setLocation("%s.%s(%s)" % (self.interfaceName, self.methodName,
+                                         v.getLocation()))
+            raise
+
+    def newRequest(self, reqID, rref, args, kwargs):
+        if self.methodSchema:
+            self.checkArgs(self.methodSchema, args, kwargs)
+        req = PendingRequest(reqID, rref, self.interfaceName, self.methodName)
+        # the Interface gets to constrain the return value too
+        req.constraint = self.responseConstraint
+        return req
+
+class DiscardedRequest(object):
+    # this stands in for a PendingRequest that timed out, to absorb the
+    # answer (or error) if the far end gets around to sending one
+    constraint = None
+
+    def __init__(self, reqID):
+        self.reqID = reqID
+
+    def complete(self, res):
+        pass
+
+    def fail(self, why):
+        pass
+
 class ArgumentSlicer(slicer.ScopedSlicer):
     opentype = ('arguments',)
 
@@ -147,6 +231,53 @@ class CallSlicer(slicer.ScopedSlicer):
     def describe(self):
         return "<call-%s-%s-%s>" % (self.reqID, self.clid, self.methodname)
 
+class PromiseCallSlicer(CallSlicer):
+    """I send a call which takes part in promise pipelining. If flags has
+    TARGET_IS_ANSWER, 'target' is the reqID of an earlier call (which was
+    sent with RETAIN_ANSWER), and the method is invoked on its result. If
+    not, 'target' is a clid, as for CallSlicer."""
+    opentype = ('promise-call',)
+
+    def __init__(self, reqID, flags, target, methodname, args, kwargs):
+        CallSlicer.__init__(self, reqID, target, methodname, args, kwargs)
+        self.flags = flags
+
+    def sliceBody(self, streamable, banana):
+        yield self.reqID
+        yield self.flags
+        yield self.clid
+        yield self.methodname
+        yield ArgumentSlicer(self.args, self.kwargs, self.methodname)
+
+    def describe(self):
+        return "<promise-call-%s-%s-%s-%s>" % (self.reqID, self.flags,
+                                               self.clid, self.methodname)
+
+class CallBatchSlicer(slicer.ScopedSlicer):
+    """I send several method calls to the same object in a single
+    'call-batch' sequence. The calls use consecutive reqIDs, starting with
+    firstReqID, so only the first one is sent."""
+    opentype = ('call-batch',)
+
+    def __init__(self, firstReqID, clid, calls):
+        slicer.ScopedSlicer.__init__(self, None)
+        assert 0 < len(calls) <= MAX_BATCH_CALLS
+        self.firstReqID = firstReqID
+        self.clid = clid
+        self.calls = calls # list of (methodname, args, kwargs)
+
+    def sliceBody(self, streamable, banana):
+        yield self.firstReqID
+        yield len(self.calls)
+        yield self.clid
+        for methodname, args, kwargs in self.calls:
+            yield methodname
+            yield ArgumentSlicer(args, kwargs, methodname)
+
+    def describe(self):
+        return "<call-batch-%s-%s-x%d>" % (self.firstReqID, self.clid,
+                                           len(self.calls))
+
 class InboundDelivery(object):
     """An inbound message that has not yet been delivered.
 
@@ -176,6 +307,13 @@ class InboundDelivery(object):
     above any cycles.
     """
 
+    # if the call arrived in a 'call-batch', this is the AnswerBatch that
+    # will carry its result
+    batch = None
+    # if the call was pipelined onto the result of an earlier call, this is
+    # the RetainedAnswer for that call, and .obj is not known yet
+    answerTarget = None
+
     def __init__(self, broker, reqID, obj,
                  interface, methodname, methodSchema,
                  allargs):
@@ -222,6 +360,9 @@ class InboundDelivery(object):
 class ArgumentUnslicer(slicer.ScopedUnslicer):
     methodSchema = None
     debug = False
+    # True once closed if every argument value was fully checked against its
+    # constraint as it arrived, so the Broker need not check it again
+    checked = False
 
     def setConstraint(self, methodSchema):
         self.methodSchema = methodSchema
@@ -238,6 +379,22 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
         self._all_children_are_referenceable_d = None
         self._ready_deferreds = []
         self.closed = False
+        self.streamedArg = False
+        self.argsChecked = True
+        self.sawReference = False
+
+    def getObject(self, counter):
+        obj = slicer.ScopedUnslicer.getObject(self, counter)
+        if obj is not None:
+            # a shared reference is only checked against the constraint of
+            # the place it is first seen
+            self.sawReference = True
+        return obj
+
+    def noteArgument(self):
+        c = self.argConstraint
+        if not (c and c.checkedOnReceive):
+            self.argsChecked = False
 
     def checkToken(self, typebyte, size):
         if self.numargs is None:
@@ -269,6 +426,30 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
                 unslicer.setConstraint(self.argConstraint)
         return unslicer
 
+    def getStringSink(self, size):
+        if self.numargs is None or not self.argConstraint:
+            return None
+        if len(self.args) >= self.numargs and self.argname is None:
+            return None # this is the name of a keyword argument
+        sink = self.argConstraint.makeStringSink(size)
+        if sink is not None:
+            self.streamedArg = True
+        return sink
+
+    def sinkArgument(self, argvalue):
+        # a StreamedBytesConstraint argument that arrived in a single piece
+        # (so Banana never asked for a sink) is written to one now, so the
+        # method always receives what the sink produces
+        if self.streamedArg:
+            self.streamedArg = False
+            return argvalue
+        if self.argConstraint and isinstance(argvalue, str):
+            sink = self.argConstraint.makeStringSink(len(argvalue))
+            if sink is not None:
+                sink.write(argvalue)
+                return sink.finish()
+        return argvalue
+
     def receiveChild(self, token, ready_deferred=None):
         if self.debug:
             log.msg("%s.receiveChild: %s %s %s %s %s args=%s kwargs=%s" %
@@ -290,7 +471,8 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
 
         if len(self.args) < self.numargs:
             # this token is a positional argument
-            argvalue = token
+            self.noteArgument()
+            argvalue = self.sinkArgument(token)
             argpos = len(self.args)
             self.args.append(argvalue)
             if isinstance(argvalue, defer.Deferred):
@@ -327,7 +509,8 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
             return
 
         # this token is the value of a keyword argument
-        argvalue = token
+        self.noteArgument()
+        argvalue = self.sinkArgument(token)
         self.kwargs[self.argname] = argvalue
         if isinstance(argvalue, defer.Deferred):
             self.num_unreferenceable_children += 1
@@ -376,6 +559,9 @@ class ArgumentUnslicer(slicer.ScopedUnslicer):
             d = self._all_children_are_referenceable_d = defer.Deferred()
             dl.append(d)
         dl.extend(self._ready_deferreds)
+        # anything that arrives later (like a gift) was not checked yet
+        self.checked = (self.methodSchema is not None and self.argsChecked
+                        and not self.sawReference and not dl)
         ready_deferred = None
         if dl:
             ready_deferred = AsyncAND(dl)
@@ -452,6 +638,59 @@ class CallUnslicer(slicer.ScopedUnslicer):
             self.broker.callFailed(f, self.reqID)
         return f # give up our sequence
 
+    def lookupObject(self, objID):
+        self.objID = objID
+        try:
+            self.obj = self.broker.getMyReferenceByCLID(objID)
+        except KeyError:
+            raise Violation("unknown CLID %d" % (objID,))
+        #iface = self.broker.getRemoteInterfaceByName(objID)
+        if self.objID < 0:
+            self.interface = None
+            self.dispatch = None
+        else:
+            getDispatchTable = getattr(self.obj, "getDispatchTable", None)
+            if getDispatchTable:
+                self.dispatch = getDispatchTable()
+                self.interface = self.dispatch.interface
+            else:
+                self.dispatch = None
+                self.interface = self.obj.getInterface()
+
+    def lookupMethod(self, methodname):
+        # must find the schema, using the interfaces. Referenceables keep
+        # a per-class DispatchTable, so this is a single dict lookup.
+
+        # TODO: getSchema should probably be in an adapter instead of in
+        # a pb.Referenceable base class. Old-style (unconstrained)
+        # flavors.Referenceable should be adapted to something which
+        # always returns None
+
+        if self.objID < 0:
+            # the target is a bound method, ignore the methodname
+            self.methodSchema = getattr(self.obj, "methodSchema", None)
+            self.methodname = None # TODO: give it something useful
+            if self.broker.requireSchema and not self.methodSchema:
+                why = "This broker does not accept unconstrained " + \
+                      "method calls"
+                raise Violation(why)
+            return
+
+        self.methodname = methodname
+        self.methodSchema = None
+
+        if self.interface:
+            # they are calling an interface+method pair
+            if self.dispatch:
+                ms = self.dispatch.getMethodSchema(self.methodname)
+            else:
+                ms = self.interface.get(self.methodname)
+            if not ms:
+                why = "method '%s' not defined in %s" % \
+                      (self.methodname, self.interface.__remote_name__)
+                raise Violation(why)
+            self.methodSchema = ms
+
     def receiveChild(self, token, ready_deferred=None):
         assert not isinstance(token, defer.Deferred)
         if self.debug:
@@ -471,62 +710,16 @@ class CallUnslicer(slicer.ScopedUnslicer):
         if self.stage == 1: # objID
             # this might raise an exception if objID is invalid
             assert ready_deferred is None
-            self.objID = token
-            try:
-                self.obj = self.broker.getMyReferenceByCLID(token)
-            except KeyError:
-                raise Violation("unknown CLID %d" % (token,))
-            #iface = self.broker.getRemoteInterfaceByName(token)
-            if self.objID < 0:
-                self.interface = None
-            else:
-                self.interface = self.obj.getInterface()
+            self.lookupObject(token)
             self.stage = 2
             return
 
         if self.stage == 2: # methodname
             # validate the methodname, get the schema. This may raise an
             # exception for unknown methods
-
-            # must find the schema, using the interfaces
-
-            # TODO: getSchema should probably be in an adapter instead of in
-            # a pb.Referenceable base class. Old-style (unconstrained)
-            # flavors.Referenceable should be adapted to something which
-            # always returns None
-
-            # TODO: make this faster. A likely optimization is to take a
-            # tuple of components.getInterfaces(obj) and use it as a cache
-            # key. It would be even faster to use obj.__class__, but that
-            # would probably violate the expectation that instances can
-            # define their own __implements__ (independently from their
-            # class). If this expectation were to go away, a quick
-            # obj.__class__ -> RemoteReferenceSchema cache could be built.
-
             assert ready_deferred is None
             self.stage = 3
-
-            if self.objID < 0:
-                # the target is a bound method, ignore the methodname
-                self.methodSchema = getattr(self.obj, "methodSchema", None)
-                self.methodname = None # TODO: give it something useful
-                if self.broker.requireSchema and not self.methodSchema:
-                    why = "This broker does not accept unconstrained " + \
-                          "method calls"
-                    raise Violation(why)
-                return
-
-            self.methodname = token
-
-            if self.interface:
-                # they are calling an interface+method pair
-                ms = self.interface.get(self.methodname)
-                if not ms:
-                    why = "method '%s' not defined in %s" % \
-                          (self.methodname, self.interface.__remote_name__)
-                    raise Violation(why)
-                self.methodSchema = ms
-
+            self.lookupMethod(token)
             return
 
         if self.stage == 3: # arguments
@@ -571,6 +764,214 @@ class CallUnslicer(slicer.ScopedUnslicer):
         return s
 
 
+class RetainedAnswer(object):
+    """I hold the result of an inbound call that was sent with
+    RETAIN_ANSWER, for the calls which are pipelined onto it. The Broker
+    keeps me until the caller says it has seen the answer."""
+
+    def __init__(self):
+        self.observers = OneShotObserverList()
+        self.resolved = False
+        self.released = False
+
+    def whenResolved(self):
+        return self.observers.whenFired()
+
+    def resolve(self, res):
+        self.resolved = True
+        self.observers.fire(res)
+
+class PromiseCallUnslicer(CallUnslicer):
+    """I receive a 'promise-call' sequence. This is a 'call' with a flags
+    INT after the reqID. A call pipelined onto an earlier answer cannot have
+    its arguments constrained as they arrive, because its target is not
+    known yet. They are checked against the schema before it is invoked."""
+
+    def start(self, count):
+        CallUnslicer.start(self, count)
+        self.flags = None
+        self.answerTarget = None
+
+    def checkToken(self, typebyte, size):
+        if self.stage == 1 and self.flags is None:
+            if typebyte != tokens.INT:
+                raise BananaError("flags must be an INT")
+            return
+        CallUnslicer.checkToken(self, typebyte, size)
+
+    def reportViolation(self, f):
+        if self.flags is not None and self.flags & RETAIN_ANSWER:
+            # calls pipelined onto ours must not wait forever
+            self.broker.resolveRetainedAnswer(self.reqID, f)
+        return CallUnslicer.reportViolation(self, f)
+
+    def receiveChild(self, token, ready_deferred=None):
+        if self.stage == 1 and self.flags is None:
+            assert ready_deferred is None
+            self.flags = token
+            if self.flags & RETAIN_ANSWER:
+                if self.reqID == 0:
+                    raise BananaError("cannot retain the answer to reqID 0")
+                self.broker.retainAnswer(self.reqID)
+            return
+        if self.stage == 1 and self.flags & TARGET_IS_ANSWER:
+            assert ready_deferred is None
+            self.objID = token
+            answer = self.broker.retainedAnswers.get(token)
+            if answer is None:
+                raise Violation("unknown answer %d" % (token,))
+            self.answerTarget = answer
+            self.stage = 2
+            return
+        if self.stage == 2 and self.answerTarget:
+            assert ready_deferred is None
+            # the schema is found when the target is known
+            self.methodname = token
+            self.stage = 3
+            return
+        return CallUnslicer.receiveChild(self, token, ready_deferred)
+
+    def receiveClose(self):
+        delivery, ready_deferred = CallUnslicer.receiveClose(self)
+        delivery.answerTarget = self.answerTarget
+        return delivery, ready_deferred
+
+    def describe(self):
+        if self.answerTarget:
+            s = "<promise-call"
+            s += " reqID=%d" % self.reqID
+            s += " answer=%d" % self.objID
+            if self.stage >= 3:
+                s += " methodname=%s" % self.methodname
+            s += ">"
+            return s
+        return CallUnslicer.describe(self)
+
+
+class CallBatchUnslicer(CallUnslicer):
+    """I receive a 'call-batch' sequence: several calls to a single object.
+    None of them are delivered until the whole sequence has arrived, so if
+    any call is rejected, all of them are, just as a bad argument rejects a
+    whole 'call'. The answers go back in one 'answer-batch' sequence."""
+
+    def start(self, count):
+        # stage 0:firstReqID, 1:count, 2:objID, then for each call
+        # 3:methodname, 4:arguments. Stage 5 means we have all the calls.
+        CallUnslicer.start(self, count)
+        self.firstReqID = None
+        self.count = None
+        self.batch = None
+        self.deliveries = []
+
+    def checkToken(self, typebyte, size):
+        if self.stage in (0, 1):
+            if typebyte != tokens.INT:
+                raise BananaError("request ID and count must be INTs")
+        elif self.stage == 2:
+            if typebyte not in (tokens.INT, tokens.NEG):
+                raise BananaError("object ID must be an INT/NEG")
+        elif self.stage == 3:
+            if typebyte not in (tokens.STRING, tokens.VOCAB):
+                raise BananaError("method name must be a STRING")
+        elif self.stage == 4:
+            if typebyte != tokens.OPEN:
+                raise BananaError("arguments must be an 'arguments' sequence")
+        else:
+            raise BananaError("too many objects given to CallBatchUnslicer")
+
+    def doOpen(self, opentype):
+        assert self.stage == 4
+        unslicer = self.open(opentype)
+        if self.methodSchema:
+            unslicer.setConstraint(self.methodSchema)
+        return unslicer
+
+    def reportViolation(self, f):
+        for delivery, ready_deferred in self.deliveries:
+            del self.broker.activeLocalCalls[delivery.reqID]
+        if self.reqID is not None:
+            self.broker.activeLocalCalls.pop(self.reqID, None)
+        if f.value.args[0] == "ABORT received":
+            return f
+        if self.batch:
+            # nothing in the batch will run, so every call gets the error
+            for i in range(self.count):
+                self.batch.fail(self.firstReqID + i, f)
+        elif self.firstReqID is not None:
+            # we don't know how many calls there were, so the best we can
+            # do is answer the first one
+            self.broker.activeLocalCalls[self.firstReqID] = self
+            self.broker.callFailed(f, self.firstReqID)
+        return f # give up our sequence
+
+    def receiveChild(self, token, ready_deferred=None):
+        assert not isinstance(token, defer.Deferred)
+
+        if self.stage == 0: # firstReqID
+            assert ready_deferred is None
+            if token == 0:
+                raise BananaError("batched calls must have request IDs")
+            self.firstReqID = token
+            self.stage = 1
+            return
+
+        if self.stage == 1: # count
+            assert ready_deferred is None
+            if not 0 < token <= MAX_BATCH_CALLS:
+                raise Violation("bad call-batch size %d" % token)
+            self.count = token
+            self.batch = AnswerBatch(self.broker, self.firstReqID, token)
+            self.stage = 2
+            return
+
+        if self.stage == 2: # objID
+            assert ready_deferred is None
+            self.lookupObject(token)
+            self.stage = 3
+            return
+
+        if self.stage == 3: # methodname
+            assert ready_deferred is None
+            self.reqID = self.firstReqID + len(self.deliveries)
+            assert self.reqID not in self.broker.activeLocalCalls
+            self.broker.activeLocalCalls[self.reqID] = self
+            self.stage = 4
+            self.lookupMethod(token)
+            return
+
+        if self.stage == 4: # arguments
+            assert isinstance(token, ArgumentUnslicer)
+            delivery = InboundDelivery(self.broker, self.reqID, self.obj,
+                                       self.interface, self.methodname,
+                                       self.methodSchema, token)
+            delivery.batch = self.batch
+            self.deliveries.append((delivery, ready_deferred))
+            self.reqID = None
+            if len(self.deliveries) < self.count:
+                self.stage = 3
+            else:
+                self.stage = 5
+            return
+
+    def receiveClose(self):
+        if self.stage != 5:
+            raise BananaError("'call-batch' sequence ended too early")
+        for delivery, ready_deferred in self.deliveries:
+            self.broker.scheduleCall(delivery, ready_deferred)
+        return None, None
+
+    def describe(self):
+        s = "<call-batch"
+        if self.firstReqID is not None:
+            s += " reqID=%d" % self.firstReqID
+        if self.count is not None:
+            s += " call=%d/%d" % (len(self.deliveries), self.count)
+        if self.obj is not None:
+            s += " obj=%s" % (self.obj,)
+        s += ">"
+        return s
+
+
 class AnswerSlicer(slicer.ScopedSlicer):
     opentype = ('answer',)
 
@@ -694,6 +1095,178 @@ class AnswerUnslicer(slicer.ScopedUnslicer):
 
 
 
+class AnswerBatch(object):
+    """I collect the results of the calls from one 'call-batch', and send
+    them all in a single 'answer-batch' once the last one is known."""
+
+    def __init__(self, broker, firstReqID, count):
+        self.broker = broker
+        self.firstReqID = firstReqID
+        self.entries = [None] * count
+        self.remaining = count
+
+    def answer(self, reqID, res):
+        self._addEntry(reqID, ("answer", res))
+
+    def fail(self, reqID, f):
+        self._addEntry(reqID, ("error", f))
+
+    def _addEntry(self, reqID, entry):
+        which = reqID - self.firstReqID
+        assert self.entries[which] is None
+        self.entries[which] = entry
+        self.remaining -= 1
+        if self.remaining:
+            return
+        try:
+            self.broker.send(AnswerBatchSlicer(self.firstReqID, self.entries))
+        except:
+            f = failure.Failure()
+            log.msg("AnswerBatch unable to send",
+                    facility="foolscap", level=log.UNUSUAL, failure=f)
+
+class AnswerBatchSlicer(slicer.ScopedSlicer):
+    opentype = ('answer-batch',)
+
+    def __init__(self, firstReqID, entries):
+        slicer.ScopedSlicer.__init__(self, None)
+        self.firstReqID = firstReqID
+        self.entries = entries # list of ("answer", res) or ("error", f)
+
+    def sliceBody(self, streamable, banana):
+        yield self.firstReqID
+        yield len(self.entries)
+        for kind, value in self.entries:
+            yield kind
+            yield value
+
+    def describe(self):
+        return "<answer-batch-%s-x%d>" % (self.firstReqID, len(self.entries))
+
+class AnswerBatchUnslicer(slicer.ScopedUnslicer):
+    """I receive the results of a 'call-batch', as a sequence of
+    ("answer", result) or ("error", failure) pairs, and deliver each one to
+    its PendingRequest as soon as it has arrived."""
+
+    fConstraint = FailureConstraint()
+
+    def start(self, count):
+        slicer.ScopedUnslicer.start(self, count)
+        # stage 0:firstReqID, 1:count, then for each result 2:kind, 3:value.
+        # Stage 4 means we have all the results.
+        self.stage = 0
+        self.firstReqID = None
+        self.count = None
+        self.received = 0
+        self.request = None
+        self.constraint = None
+        self._ready_deferreds = []
+
+    def checkToken(self, typebyte, size):
+        if self.stage in (0, 1):
+            if typebyte != tokens.INT:
+                raise BananaError("request ID and count must be INTs")
+        elif self.stage == 2:
+            if typebyte not in (tokens.STRING, tokens.VOCAB):
+                raise BananaError("result kind must be a STRING")
+        elif self.stage == 3:
+            if self.constraint:
+                self.constraint.checkToken(typebyte, size)
+        else:
+            raise BananaError("stop sending me stuff!")
+
+    def doOpen(self, opentype):
+        assert self.stage == 3
+        if self.constraint:
+            self.constraint.checkOpentype(opentype)
+        unslicer = self.open(opentype)
+        if unslicer:
+            if self.constraint:
+                unslicer.setConstraint(self.constraint)
+        return unslicer
+
+    def receiveChild(self, token, ready_deferred=None):
+        if self.stage == 0:
+            assert ready_deferred is None
+            self.firstReqID = token
+            self.stage = 1
+        elif self.stage == 1:
+            assert ready_deferred is None
+            if not 0 < token <= MAX_BATCH_CALLS:
+                raise BananaError("bad answer-batch size %d" % token)
+            self.count = token
+            self.stage = 2
+        elif self.stage == 2:
+            assert ready_deferred is None
+            if token not in ("answer", "error"):
+                raise BananaError("unknown result kind '%s'" % (token,))
+            self.kind = token
+            # may raise Violation for bad reqIDs
+            self.request = self.broker.getRequest(self.firstReqID +
+                                                  self.received)
+            if self.kind == "answer":
+                self.constraint = self.request.constraint
+            else:
+                self.constraint = self.fConstraint
+            self.stage = 3
+        else:
+            if ready_deferred:
+                self._ready_deferreds.append(ready_deferred)
+            self.deliverResult(token)
+            self.received += 1
+            self.request = None
+            self.constraint = None
+            self._ready_deferreds = []
+            if self.received < self.count:
+                self.stage = 2
+            else:
+                self.stage = 4
+
+    def deliverResult(self, token):
+        request = self.request
+        if self.kind == "error":
+            assert not isinstance(token, defer.Deferred)
+            assert not self._ready_deferreds
+            f = token
+            if not self.broker._expose_remote_exception_types:
+                f = wrap_remote_failure(f)
+            request.fail(f)
+            return
+        # this follows AnswerUnslicer.receiveClose
+        if isinstance(token, defer.Deferred):
+            child_deferred = token
+        else:
+            child_deferred = defer.succeed(token)
+        if self._ready_deferreds:
+            d = AsyncAND(self._ready_deferreds)
+        else:
+            d = defer.succeed(None)
+        d.addCallback(lambda res: child_deferred)
+        d.addCallbacks(request.complete, request.fail)
+
+    def reportViolation(self, f):
+        # the rest of the sequence will be discarded, so this result and
+        # all the ones after it are lost
+        if self.firstReqID is not None and self.count is not None:
+            for i in range(self.received, self.count):
+                try:
+                    request = self.broker.getRequest(self.firstReqID + i)
+                except Violation:
+                    continue
+                request.fail(f)
+        return f # give up our sequence
+
+    def receiveClose(self):
+        if self.stage != 4:
+            raise BananaError("'answer-batch' sequence ended too early")
+        return None, None
+
+    def describe(self):
+        if self.firstReqID is None or self.count is None:
+            return "AnswerBatch(req=?)"
+        return "AnswerBatch(req=%d)" % (self.firstReqID + self.received)
+
+
 class ErrorSlicer(slicer.ScopedSlicer):
     opentype = ('error',)
 
@@ -59,6 +59,12 @@ class TubConnector(object):
     along the way. The first hint that yields a connected Broker will stop
     the search.
 
+    The hints are not all tried at once. Hints which recently got the Tub a
+    connection to this target go first, then the rest in the order the FURL
+    lists them. Each attempt gets a head start of staggerDelay seconds
+    before the next hint is tried, unless it fails sooner. A staggerDelay of
+    0 or None starts them all at once.
+
     This is a single-use object. The connection attempt begins as soon as my
     connect() method is called.
 
@@ -72,6 +78,7 @@ class TubConnector(object):
     failureReason = None
     CONNECTION_TIMEOUT = 60
     timer = None
+    staggerTimer = None
 
     def __init__(self, parent, tubref, connectionPlugins):
         self._logparent = log.msg(format="TubConnector created from "
@@ -84,7 +91,8 @@ class TubConnector(object):
         self.tub = parent
         self.target = tubref
         self.connectionPlugins = connectionPlugins
-        self.remainingLocations = list(self.target.getLocations())
+        self.remainingLocations = parent.rankLocationHints(tubref)
+        self.staggerDelay = parent.connectionStaggerDelay
         # attemptedLocations keeps track of where we've already tried to
         # connect, so we don't try them twice, even if they appear in the
         # hints multiple times. this isn't too clever: slight variations of
@@ -138,10 +146,16 @@ class TubConnector(object):
             self.timer.cancel()
             del self.timer
 
+    def stopStaggerTimer(self):
+        if self.staggerTimer:
+            self.staggerTimer.cancel()
+            self.staggerTimer = None
+
     def shutdown(self):
         self.active = False
         self.remainingLocations = []
         self.stopConnectionTimer()
+        self.stopStaggerTimer()
         self.cancelRemainingConnections()
 
     def cancelRemainingConnections(self):
@@ -154,36 +168,57 @@ class TubConnector(object):
             # triggers n.connectionLost(), then self.negotiationFailed()
 
     def connectToAll(self):
+        # start the next hint, and keep going until one of them is still in
+        # progress. That one gets a head start before we try any more.
+        self.stopStaggerTimer()
         while self.remainingLocations:
-            location = self.remainingLocations.pop()
+            location = self.remainingLocations.pop(0)
             if location in self.attemptedLocations:
                 continue
             self.attemptedLocations.append(location)
-            lp = self.log("considering hint: %s" % (location,))
-            d = get_endpoint(location, self.connectionPlugins)
-            # no handler for this hint?: InvalidHintError thrown here
-            def _good_hint(res):
-                self.validHints.append(location)
-                (ep, host) = res
-                self.log("connecting to hint: %s" % (location,),
-                         parent=lp, umid="9iX0eg")
-                return ep.connect(TubConnectorFactory(self, host, lp))
-            d.addCallback(_good_hint)
-            self.pendingConnections.add(d)
-            def _remove(res, d=d):
-                self.pendingConnections.remove(d)
-                return res
-            d.addBoth(_remove)
-            d.addCallback(self._connectionSuccess, location, lp)
-            d.addErrback(self._connectionFailed, location, lp)
+            self.connectToHint(location)
             if self.tub._test_options.get("debug_stall_second_connection"):
                 # for unit tests, hold off on making the second connection
                 # for a moment. This allows the first connection to get to a
                 # known state.
                 reactor.callLater(0.1, self.connectToAll)
                 return
+            if (self.staggerDelay and self.remainingLocations and
+                (self.pendingConnections or self.pendingNegotiations)):
+                self.staggerTimer = reactor.callLater(self.staggerDelay,
+                                                      self.staggerTimerFired)
+                return
         self.checkForFailure()
 
+    def connectToHint(self, location):
+        lp = self.log("considering hint: %s" % (location,))
+        d = get_endpoint(location, self.connectionPlugins)
+        # no handler for this hint?: InvalidHintError thrown here
+        def _good_hint(res):
+            self.validHints.append(location)
+            (ep, host) = res
+            self.log("connecting to hint: %s" % (location,),
+                     parent=lp, umid="9iX0eg")
+            return ep.connect(TubConnectorFactory(self, host, lp))
+        d.addCallback(_good_hint)
+        self.pendingConnections.add(d)
+        def _remove(res):
+            self.pendingConnections.remove(d)
+            return res
+        d.addBoth(_remove)
+        d.addCallback(self._connectionSuccess, location, lp)
+        d.addErrback(self._connectionFailed, location, lp)
+
+    def staggerTimerFired(self):
+        self.staggerTimer = None
+        self.connectToAll()
+
+    def attemptFailed(self):
+        # if the remaining hints are waiting for this attempt's head start
+        # to run out, they needn't wait any longer
+        if self.staggerTimer:
+            self.connectToAll()
+
     def connectionTimedOut(self):
         # this timer is for the overall connection attempt, not each
         # individual endpoint/TCP connector
@@ -211,6 +246,7 @@ class TubConnector(object):
                     umid="2PEowg")
         if not self.failureReason:
             self.failureReason = reason
+        self.attemptFailed()
         self.checkForFailure()
         self.checkForIdle()
 
@@ -225,7 +261,7 @@ class TubConnector(object):
     def redirectReceived(self, newLocation):
         # the redirected connection will disconnect soon, which will trigger
         # negotiationFailed(), so we don't have to do a
-        self.remainingLocations.append(newLocation)
+        self.remainingLocations.insert(0, newLocation)
         self.connectToAll()
 
     def negotiationFailed(self, n, reason):
@@ -241,6 +277,7 @@ class TubConnector(object):
             # don't let mundane things like ConnectionFailed override the
             # actually significant ones like NegotiationError
             self.failureReason = reason
+        self.attemptFailed()
         self.checkForFailure()
         self.checkForIdle()
 
@@ -249,12 +286,16 @@ class TubConnector(object):
         # 'factory' has just completed negotiation, so abandon all the other
         # connection attempts
         self.log("negotiationComplete, %s won" % n)
-        self.pendingNegotiations.pop(n) # this one succeeded
+        hint = self.pendingNegotiations.pop(n) # this one succeeded
+        self.tub.hintSucceeded(self.target, hint)
         self.active = False
         if self.timer:
             self.timer.cancel()
             self.timer = None
-        self.cancelRemainingConnections() # abandon the others
+        # abandon the others, and don't start any more
+        self.remainingLocations = []
+        self.stopStaggerTimer()
+        self.cancelRemainingConnections()
         self.checkForIdle()
 
     def checkForFailure(self):
@@ -286,6 +327,7 @@ class TubConnector(object):
 
     def failed(self):
         self.stopConnectionTimer()
+        self.stopStaggerTimer()
         self.active = False
         self.tub.connectionFailed(self.target, self.failureReason)
         self.tub.connectorFinished(self)
@@ -10,7 +10,7 @@ from zope.interface import implements, Interface
 
 from foolscap.tokens import Violation, BananaError, SIZE_LIMIT, \
      STRING, LIST, INT, NEG, LONGINT, LONGNEG, VOCAB, FLOAT, OPEN, \
-     tokenNames
+     tokenNames, IStreamedString
 
 everythingTaster = {
     # he likes everything
@@ -29,6 +29,14 @@ openTaster = {
     }
 nothingTaster = {}
 
+def _accept(obj, inbound):
+    pass
+
+def _definingClass(obj, name):
+    for cls in type(obj).__mro__:
+        if name in cls.__dict__:
+            return cls
+
 class IConstraint(Interface):
     pass
 class IRemoteMethodConstraint(IConstraint):
@@ -51,6 +59,12 @@ class IRemoteMethodConstraint(IConstraint):
 
         This should either raise Violation or return None."""
         pass
+    def checkRequiredArgs(args, kwargs):
+        """Check only that no required argument is missing. This is called
+        instead of checkAllArgs() on inbound calls whose argument values
+        were fully checked as they were received.
+
+        This should either raise Violation or return None."""
     def getResponseConstraint():
         """Return an IConstraint-providing object to enforce the response
         constraint. This is called on outbound method calls so that when the
@@ -95,6 +109,14 @@ class Constraint(object):
     name = None
     """Used to describe the Constraint in a Violation error message"""
 
+    checkedOnReceive = False
+    """If checkedOnReceive is True, checkToken/checkOpentype and the
+    Unslicer this constraint is given to will have enforced everything that
+    checkObject(obj, True) would, by the time an inbound object is complete.
+    Inbound method arguments that meet such constraints are not checked a
+    second time before the method is invoked.
+    """
+
     def checkToken(self, typebyte, size):
         """Check the token type. Raise an exception if it is not accepted
         right now, or if the body-length limit is exceeded."""
@@ -150,6 +172,12 @@ class Constraint(object):
         raise Violation("unacceptable OPEN type: %s not in my list %s" %
                         (opentype, self.opentypes))
 
+    def makeStringSink(self, size):
+        """Return a sink for the body of an inbound STRING token which has
+        passed checkToken, or None to receive it as a plain string. See
+        StreamedBytesConstraint."""
+        return None
+
     def checkObject(self, obj, inbound):
         """Validate an existing object. Usually objects are validated as
         their tokens come off the wire, but pre-existing objects may be
@@ -174,6 +202,36 @@ class Constraint(object):
         # this default form passes everything
         return
 
+    def compileChecker(self, _memo=None):
+        """Return a function which takes (obj, inbound) and behaves exactly
+        like checkObject(obj, inbound), raising the same Violations, but
+        which has resolved its attributes and its child constraints ahead of
+        time. RemoteMethodSchema does this once for each argument and
+        response constraint, so the constraints should not be modified after
+        the RemoteInterface which uses them has been defined.
+
+        Subclasses provide makeChecker() to build the function. A subclass
+        which overrides checkObject() without also providing makeChecker()
+        is checked with its own checkObject().
+        """
+        if _memo is None:
+            _memo = {}
+        checker = _memo.get(id(self))
+        if checker is None:
+            # a constraint which contains itself uses the plain checkObject
+            # for the inner references
+            _memo[id(self)] = self.checkObject
+            if (_definingClass(self, "makeChecker")
+                is _definingClass(self, "checkObject")):
+                checker = self.makeChecker(_memo)
+            else:
+                checker = self.checkObject
+            _memo[id(self)] = checker
+        return checker
+
+    def makeChecker(self, memo):
+        return _accept
+
     COUNTERBYTES = 64 # max size of opencount
 
     def OPENBYTES(self, dummy):
@@ -195,7 +253,7 @@ class OpenerConstraint(Constraint):
     taster = openTaster
 
 class Any(Constraint):
-    pass # accept everything
+    checkedOnReceive = True # accept everything
 
 # constraints which describe individual banana tokens
 
@@ -214,24 +272,103 @@ class ByteStringConstraint(Constraint):
             self.regexp = re.compile(regexp)
         self.taster = {STRING: self.maxLength,
                        VOCAB: None}
+        # the taster enforces maxLength, but not minLength or regexp
+        self.checkedOnReceive = not (self.minLength or self.regexp)
 
     def checkObject(self, obj, inbound):
-        if not isinstance(obj, str):
+        if not inbound and IStreamedString.providedBy(obj):
+            # this will be sent as a STRING token, but the contents are not
+            # available yet, so only the length can be checked
+            length = obj.size
+        elif not isinstance(obj, str):
             raise Violation("'%r' is not a bytestring" % (obj,))
-        if self.maxLength != None and len(obj) > self.maxLength:
+        else:
+            length = len(obj)
+        if self.maxLength != None and length > self.maxLength:
             raise Violation("string too long (%d > %d)" %
-                            (len(obj), self.maxLength))
-        if len(obj) < self.minLength:
+                            (length, self.maxLength))
+        if length < self.minLength:
             raise Violation("string too short (%d < %d)" %
-                            (len(obj), self.minLength))
-        if self.regexp:
+                            (length, self.minLength))
+        if self.regexp and isinstance(obj, str):
             if not self.regexp.search(obj):
                 raise Violation("regexp failed to match")
 
+    def makeChecker(self, memo):
+        maxLength = self.maxLength
+        minLength = self.minLength
+        search = None
+        if self.regexp:
+            search = self.regexp.search
+        providedBy = IStreamedString.providedBy
+        def check(obj, inbound):
+            # a plain str never provides IStreamedString
+            if obj.__class__ is str:
+                length = len(obj)
+            elif not inbound and providedBy(obj):
+                length = obj.size
+            elif not isinstance(obj, str):
+                raise Violation("'%r' is not a bytestring" % (obj,))
+            else:
+                length = len(obj)
+            if maxLength != None and length > maxLength:
+                raise Violation("string too long (%d > %d)" %
+                                (length, maxLength))
+            if length < minLength:
+                raise Violation("string too short (%d < %d)" %
+                                (length, minLength))
+            if search and isinstance(obj, str):
+                if not search(obj):
+                    raise Violation("regexp failed to match")
+        return check
+
+class StreamedBytesConstraint(ByteStringConstraint):
+    """I accept a bytestring argument without holding the whole thing in
+    memory on the receiving side. The body of the STRING token is handed to
+    a sink, piece by piece, as it arrives off the wire.
+
+    sinkFactory is called with the length of the string, and must return an
+    object with a write(data) method and a finish() method. finish() is
+    called once the whole string has been written, and its return value is
+    what the remote method receives for this argument: for example, a sink
+    might write to a temporary file and return the file, or feed a hash
+    object and return the digest. maxLength limits the size of the string
+    exactly as it does for ByteStringConstraint, and is enforced before the
+    sink is created.
+
+    This is only honored for arguments of a RemoteInterface method. Strings
+    which arrive all at once (or as VOCAB tokens) are written to the sink in
+    a single piece, so the method always sees the sink's result.
+    """
+    name = "StreamedBytesConstraint"
+
+    def __init__(self, sinkFactory, maxLength=None):
+        ByteStringConstraint.__init__(self, maxLength)
+        self.sinkFactory = sinkFactory
+        self.checkedOnReceive = True
+
+    def makeStringSink(self, size):
+        return self.sinkFactory(size)
+
+    def checkObject(self, obj, inbound):
+        if inbound:
+            # this is whatever the sink produced
+            return
+        ByteStringConstraint.checkObject(self, obj, inbound)
+
+    def makeChecker(self, memo):
+        checkString = ByteStringConstraint.makeChecker(self, memo)
+        def check(obj, inbound):
+            if inbound:
+                return
+            checkString(obj, inbound)
+        return check
+
 class IntegerConstraint(Constraint):
     opentypes = [] # redundant
     # taster set in __init__
     name = "IntegerConstraint"
+    checkedOnReceive = True
 
     def __init__(self, maxBytes=-1):
         # -1 means s_int32_t: INT/NEG instead of INT/NEG/LONGINT/LONGNEG
@@ -243,6 +380,27 @@ class IntegerConstraint(Constraint):
             self.taster[LONGINT] = maxBytes
             self.taster[LONGNEG] = maxBytes
 
+    def checkToken(self, typebyte, size):
+        Constraint.checkToken(self, typebyte, size)
+        # the header of an INT or NEG token is the magnitude of the number
+        # itself, so the range that checkObject enforces is checked here,
+        # before the number is accepted. LONGINT/LONGNEG sizes are limited
+        # by the taster.
+        if typebyte == INT:
+            if self.maxBytes == -1:
+                if size >= 2**31:
+                    raise Violation("number too large")
+            elif self.maxBytes != None:
+                if size >= 2**(8*self.maxBytes):
+                    raise Violation("number too large")
+        elif typebyte == NEG:
+            if self.maxBytes == -1:
+                if size > 2**31:
+                    raise Violation("number too large")
+            elif self.maxBytes != None:
+                if size >= 2**(8*self.maxBytes):
+                    raise Violation("number too large")
+
     def checkObject(self, obj, inbound):
         if not isinstance(obj, (int, long)):
             raise Violation("'%r' is not a number" % (obj,))
@@ -253,6 +411,26 @@ class IntegerConstraint(Constraint):
             if abs(obj) >= 2**(8*self.maxBytes):
                 raise Violation("number too large")
 
+    def makeChecker(self, memo):
+        if self.maxBytes == -1:
+            def check(obj, inbound):
+                if not isinstance(obj, (int, long)):
+                    raise Violation("'%r' is not a number" % (obj,))
+                if obj >= 2**31 or obj < -2**31:
+                    raise Violation("number too large")
+        elif self.maxBytes != None:
+            limit = 2**(8*self.maxBytes)
+            def check(obj, inbound):
+                if not isinstance(obj, (int, long)):
+                    raise Violation("'%r' is not a number" % (obj,))
+                if abs(obj) >= limit:
+                    raise Violation("number too large")
+        else:
+            def check(obj, inbound):
+                if not isinstance(obj, (int, long)):
+                    raise Violation("'%r' is not a number" % (obj,))
+        return check
+
 class NumberConstraint(IntegerConstraint):
     """I accept floats, ints, and longs."""
     name = "NumberConstraint"
@@ -267,6 +445,14 @@ class NumberConstraint(IntegerConstraint):
             return
         IntegerConstraint.checkObject(self, obj, inbound)
 
+    def makeChecker(self, memo):
+        checkInteger = IntegerConstraint.makeChecker(self, memo)
+        def check(obj, inbound):
+            if isinstance(obj, float):
+                return
+            checkInteger(obj, inbound)
+        return check
+
 
 
 #TODO
@@ -1,32 +1,94 @@
 # -*- test-case-name: foolscap.test.test_eventual -*-
 
+import time
+from collections import deque
 from twisted.internet import reactor, defer
 from twisted.python import log
 
+# by default, a reactor turn spends at most this many seconds running
+# eventual-sends before it lets the reactor look at its sockets again
+DEFAULT_MAX_TURN_TIME = 0.05
+
+# upper edges (in seconds) of the buckets of the turn-duration histogram.
+# Longer turns are counted under None.
+TURN_DURATION_BUCKETS = (0.001, 0.01, 0.1, 1.0)
+
 class _SimpleCallQueue(object):
-    # XXX TODO: merge epsilon.cooperator in, and make this more complete.
-    def __init__(self):
-        self._events = []
+    """I run the eventual-sends. Each reactor turn runs the calls which were
+    queued before it began, in order, until they are done or a budget runs
+    out: maxTurnTime seconds or maxTurnCalls calls (None means no limit).
+    Then I yield to the reactor and carry on in the next turn. Calls queued
+    while a turn is running always wait for a later turn.
+    """
+
+    def __init__(self, clock=time.time):
+        self._events = deque()
         self._flushObservers = []
         self._timer = None
+        self._clock = clock
+        self.maxTurnTime = DEFAULT_MAX_TURN_TIME
+        self.maxTurnCalls = None
+        self.resetStats()
+
+    def setTurnBudget(self, maxTurnTime=DEFAULT_MAX_TURN_TIME,
+                      maxTurnCalls=None):
+        self.maxTurnTime = maxTurnTime
+        self.maxTurnCalls = maxTurnCalls
 
     def append(self, cb, args, kwargs):
-        self._events.append((cb, args, kwargs))
+        events = self._events
+        events.append((cb, args, kwargs, self._clock()))
+        if len(events) > self._maxDepth:
+            self._maxDepth = len(events)
         if not self._timer:
             self._timer = reactor.callLater(0, self._turn)
 
     def _turn(self):
         self._timer = None
-        # flush all the messages that are currently in the queue. If anything
-        # gets added to the queue while we're doing this, those events will
-        # be put off until the next turn.
-        events, self._events = self._events, []
-        for cb, args, kwargs in events:
+        events = self._events
+        clock = self._clock
+        # anything added to the queue while we're doing this will be put
+        # off until the next turn
+        waiting = count = len(events)
+        if self.maxTurnCalls is not None and self.maxTurnCalls < count:
+            count = self.maxTurnCalls
+        start = now = clock()
+        deadline = None
+        if self.maxTurnTime is not None:
+            deadline = start + self.maxTurnTime
+        maxLatency = self._maxLatency
+        popleft = events.popleft
+        ran = 0
+        while ran < count:
+            if ran and deadline is not None and now >= deadline:
+                break
+            cb, args, kwargs, queued = popleft()
+            if now - queued > maxLatency:
+                maxLatency = now - queued
+            ran += 1
             try:
                 cb(*args, **kwargs)
             except:
                 log.err()
-        if not self._events:
+            now = clock()
+
+        self._maxLatency = maxLatency
+        self._turns += 1
+        self._calls += ran
+        if ran < waiting:
+            self._yields += 1
+        duration = now - start
+        for edge in TURN_DURATION_BUCKETS:
+            if duration <= edge:
+                self._turnDurations[edge] += 1
+                break
+        else:
+            self._turnDurations[None] += 1
+
+        if events:
+            if not self._timer:
+                self._timer = reactor.callLater(0, self._turn)
+        else:
             observers, self._flushObservers = self._flushObservers, []
             for o in observers:
                 o.callback(None)
@@ -40,6 +102,30 @@ class _SimpleCallQueue(object):
         self._flushObservers.append(d)
         return d
 
+    def getStats(self):
+        """Return a dictionary of counters: the current and largest number
+        of queued calls, how many turns and calls have been run, how many
+        turns ended with calls left over because of the budget, the longest
+        any call waited in the queue (in seconds), and a histogram of turn
+        durations."""
+        return {"depth": len(self._events),
+                "max-depth": self._maxDepth,
+                "turns": self._turns,
+                "calls": self._calls,
+                "yields": self._yields,
+                "max-latency": self._maxLatency,
+                "turn-durations": self._turnDurations.copy(),
+                }
+
+    def resetStats(self):
+        self._maxDepth = len(self._events)
+        self._turns = 0
+        self._calls = 0
+        self._yields = 0
+        self._maxLatency = 0
+        self._turnDurations = dict([(edge, 0) for edge in
+                                    TURN_DURATION_BUCKETS + (None,)])
+
 
 _theSimpleQueue = _SimpleCallQueue()
 
@@ -74,3 +160,17 @@ def flushEventualQueue(_ignored=None):
     test method.
     """
     return _theSimpleQueue.flush()
+
+def setTurnBudget(maxTurnTime=DEFAULT_MAX_TURN_TIME, maxTurnCalls=None):
+    """Limit how long each reactor turn may spend running eventual-sends,
+    in seconds (maxTurnTime) or in calls (maxTurnCalls). When either runs
+    out, the rest of the queue waits for the next turn, so a burst of
+    eventually() calls cannot keep the reactor away from its sockets. None
+    disables a limit. Calling this with no arguments restores the
+    defaults."""
+    _theSimpleQueue.setTurnBudget(maxTurnTime, maxTurnCalls)
+
+def getEventualQueueStats():
+    """Return a dictionary of counters describing the eventual-send queue.
+    See _SimpleCallQueue.getStats for the keys."""
+    return _theSimpleQueue.getStats()
@@ -40,6 +40,22 @@ class DeadReferenceError(Exception):
             args.append("(during method=%s:%s)" % (iname, mname))
         return " ".join([str(a) for a in args])
 
+class CallTimeoutError(Exception):
+    """The far end did not answer a callRemote in time."""
+    def __init__(self, timeout=None, remote_tubid=None, request=None):
+        self.timeout = timeout
+        self.remote_tubid = remote_tubid
+        self.request = request
+
+    def __str__(self):
+        args = ["no answer after %s seconds" % self.timeout]
+        if self.remote_tubid:
+            args.append("(to tubid=%s)" % self.remote_tubid)
+        if self.request:
+            iname, mname = self.request.getMethodNameInfo()
+            args.append("(during method=%s:%s)" % (iname, mname))
+        return " ".join(args)
+
 
 class IReferenceable(Interface):
     """This object is remotely referenceable. This means it is represented to
@@ -124,6 +140,19 @@ class IRemoteReference(Interface):
 
          the return value is not accepted by the schema I believe is in use
          by the far end (Violation)
+
+         no answer arrives within the timeout (CallTimeoutError)
+
+        The timeout is set with a _timeout= keyword argument (in seconds,
+        None for no timeout), and otherwise comes from the Tub's
+        'call-timeout' option, which defaults to no timeout. An answer that
+        arrives after the timeout is quietly discarded.
+
+        With _pipeline=True, I return a RemotePromise instead of a
+        Deferred. Calls made with its callRemote() method are sent to the
+        far end right away, if it supports promise pipelining, and are
+        invoked on the result there without a round trip through us. Its
+        when() method returns a Deferred for the result itself.
         """
 
     def callRemoteOnly(name, *args, **kwargs):
@@ -138,3 +167,21 @@ class IRemoteReference(Interface):
         I always return None.
         """
 
+    def callRemoteBatch(calls):
+        """Invoke several methods on the remote object with which I am
+        associated.
+
+        'calls' is a list of (name, args, kwargs) tuples, each describing a
+        call just as callRemote(name, *args, **kwargs) would. I return a list
+        of Deferreds, one per call, which fire just like the ones callRemote
+        returns.
+
+        If the far end supports it, the calls are sent together in a single
+        message, are started in order, and their answers come back together
+        once the last one has finished. Otherwise each call is sent
+        separately. Calls with _callOnly=True or _pipeline=True are always
+        sent separately, ahead of the batch: the first as callRemoteOnly
+        would send them (their place in the list holds None), the second
+        as callRemote would (their place holds a RemotePromise).
+        """
+
@@ -42,6 +42,21 @@ PLAINTEXT, ENCRYPTED, DECIDING, BANANA, ABANDONED = range(5)
 #  2 (0.1.1): no changes to offer or decision
 #             reqID=0 was commandeered for use by callRemoteOnly()
 #  3 (0.1.3): added PING and PONG tokens
+#
+# Optional protocol features are negotiated separately from the version: the
+# offer may include a 'banana-features' line listing the features the sender
+# understands, and the master puts the ones both sides understand into the
+# same line of the decision. Peers which predate this ignore the line, so
+# neither side will use a feature the other did not offer.
+#  auto-vocab: either side may send (add-vocab) sequences at any time
+#  call-cancel: either side may invoke RIBroker.cancel to abandon a
+#               callRemote that it sent earlier
+#  call-batch: either side may send (call-batch) sequences, which are
+#              answered with an (answer-batch)
+#  decref-many: either side may invoke RIBroker.decref_many and
+#               RIBroker.decgift_many to release several references at once
+#  call-pipeline: either side may send (promise-call) sequences, and invoke
+#                 RIBroker.release_answer
 
 class Negotiation(protocol.Protocol):
     """This is the first protocol to speak over the wire. It is responsible
@@ -152,6 +167,9 @@ class Negotiation(protocol.Protocol):
 
     initialVocabTableRange = vocab.getVocabRange()
 
+    bananaFeatures = ("auto-vocab", "call-cancel", "call-batch",
+                      "decref-many", "call-pipeline")
+
     SERVER_TIMEOUT = 120 # You have 2 minutes to complete negotiation, or
                          # else. The only reason this isn't closer to 10s is
                          # that Tor/I2P connection establishment might
@@ -171,6 +189,9 @@ class Negotiation(protocol.Protocol):
                                                    self.maxVersion),
             "initial-vocab-table-range": "%d %d" % self.initialVocabTableRange,
             }
+        if self.bananaFeatures:
+            self.negotiationOffer["banana-features"] = \
+                " ".join(self.bananaFeatures)
         # TODO: for testing purposes, it might be useful to be able to add
         # some keys to this offer
         if self.forceNegotiation is not None:
@@ -759,9 +780,16 @@ class Negotiation(protocol.Protocol):
                                                                vocab_hash)
             decision['banana-decision-version'] = str(self.decision_version)
 
+            # which optional features do we both understand?
+            theirFeatures = offer.get("banana-features", "").split()
+            features = sorted(set(self.bananaFeatures) & set(theirFeatures))
+            if features:
+                decision['banana-features'] = " ".join(features)
+
             # v1: handle vocab table index
             params['banana-decision-version'] = self.decision_version
             params['initial-vocab-table-index'] = vocab_index
+            params['banana-features'] = frozenset(features)
 
         else:
             # otherwise, the other side gets to decide. The next thing they
@@ -1022,8 +1050,14 @@ class Negotiation(protocol.Protocol):
             self.log("no current-connection in decision from %s" %
                      self.theirTubRef, level=UNUSUAL)
 
+        # the master should only pick features that we offered, but ignore
+        # anything else rather than guess at what it means
+        features = decision.get('banana-features', "").split()
+        features = frozenset(features) & frozenset(self.bananaFeatures)
+
         params = { 'banana-decision-version': ver,
                    'initial-vocab-table-index': vocab_index,
+                   'banana-features': features,
                    }
         return params
 
@@ -1043,6 +1077,7 @@ class Negotiation(protocol.Protocol):
         max_vocab = self.initialVocabTableRange[1]
         params = { 'banana-decision-version': self.maxVersion,
                    'initial-vocab-table-index': max_vocab,
+                   'banana-features': frozenset(self.bananaFeatures),
                    }
         return params
 
@@ -17,6 +17,7 @@ from foolscap.referenceable import SturdyRef
 from foolscap.tokens import PBError, BananaError, WrongTubIdError, \
      WrongNameError, NoLocationError
 from foolscap.reconnector import Reconnector
+from foolscap.timerwheel import TimerWheel
 from foolscap.logging import log as flog
 from foolscap.logging import log
 from foolscap.logging import publish as flog_publish
@@ -173,6 +174,23 @@ class Tub(service.MultiService):
     brokerClass = broker.Broker
     keepaliveTimeout = 4*60 # ping when connection has been idle this long
     disconnectTimeout = None # disconnect after this much idle time
+    # the idle timers of all connections share one TimerWheel, which ticks
+    # this often (or more often, if the timeouts are shorter)
+    timerWheelResolution = 1.0
+    # outbound flow control for each Broker, None means Banana's default
+    sendHighWater = None
+    sendLowWater = None
+    # inbound calls each Broker starts per reactor turn, None means default
+    inboundCallsPerTurn = None
+    # running inbound calls each Broker allows, None means no limit
+    maxInboundCallsPerConnection = None
+    # seconds to wait for each callRemote answer, None means forever
+    callTimeout = None
+    # seconds a TubConnector gives each location hint before trying the
+    # next one, None or 0 means try them all at once
+    connectionStaggerDelay = 0.25
+    # how many recently successful hints to remember for each target Tub
+    RECENT_HINTS = 4
     tubID = None
 
     def __init__(self, certData=None, certFile=None, _test_options={}):
@@ -249,6 +267,8 @@ class Tub(service.MultiService):
 
         self._connectionHandlers = {"tcp": tcp.default()}
         self._activeConnectors = []
+        self._timerWheel = None
+        self._recentHints = {} # maps tubID to hints, most recent first
 
         self._pending_getReferences = [] # list of (d, furl) pairs
 
@@ -287,8 +307,40 @@ class Tub(service.MultiService):
             self.logRemoteFailures = value
         elif name == "keepaliveTimeout":
             self.keepaliveTimeout = value
+            # new connections get a TimerWheel that suits the new timeout,
+            # while existing ones stay on the old wheel
+            self._timerWheel = None
         elif name == "disconnectTimeout":
             self.disconnectTimeout = value
+            self._timerWheel = None
+        elif name == "send-high-water":
+            # when a connection's transport is slower than we are, stop
+            # serializing outbound messages once this many bytes are waiting
+            # for it
+            self.sendHighWater = int(value)
+        elif name == "send-low-water":
+            # and start again when it has drained to this many bytes
+            self.sendLowWater = int(value)
+        elif name == "inbound-calls-per-turn":
+            # start at most this many queued inbound calls at once, before
+            # letting the reactor do something else
+            self.inboundCallsPerTurn = int(value)
+        elif name == "max-inbound-calls-per-connection":
+            # a connection with this many remote_ methods still running
+            # (e.g. waiting on their returned Deferreds) queues any further
+            # calls until some of them finish. None removes the limit.
+            if value is not None:
+                value = int(value)
+            self.maxInboundCallsPerConnection = value
+        elif name == "call-timeout":
+            # errback any callRemote that has not been answered after this
+            # many seconds, unless it was given its own _timeout=
+            self.callTimeout = value
+        elif name == "connection-stagger-delay":
+            # when connecting to a FURL with several location hints, give
+            # each hint this many seconds to connect before trying the next
+            # one as well. None or 0 tries them all at once.
+            self.connectionStaggerDelay = value
         elif name == "logport-furlfile":
             self.setLogPortFURLFile(value)
         elif name == "log-gatherer-furl":
@@ -521,11 +573,36 @@ class Tub(service.MultiService):
         connect to this Tub."""
         return self.listeners[:]
 
+    def getTimerWheel(self):
+        if self._timerWheel is None:
+            resolution = self.timerWheelResolution
+            for timeout in (self.keepaliveTimeout, self.disconnectTimeout):
+                if timeout is not None:
+                    resolution = min(resolution, timeout / 10.0)
+            self._timerWheel = TimerWheel(resolution)
+        return self._timerWheel
+
     def getTubID(self):
         return self.tubID
     def getShortTubID(self):
         return self.tubID[:4]
 
+    def rankLocationHints(self, tubref):
+        """Return the location hints of this TubRef in the order a
+        TubConnector should try them: the ones that most recently got us a
+        connection to it first, then the rest in the order given."""
+        hints = list(tubref.getLocations())
+        recent = [h for h in self._recentHints.get(tubref.getTubID(), [])
+                  if h in hints]
+        return recent + [h for h in hints if h not in recent]
+
+    def hintSucceeded(self, tubref, hint):
+        recent = self._recentHints.setdefault(tubref.getTubID(), [])
+        if hint in recent:
+            recent.remove(hint)
+        recent.insert(0, hint)
+        del recent[self.RECENT_HINTS:]
+
     def connectorStarted(self, c):
         assert self.running
         self._activeConnectors.append(c)
@@ -570,6 +647,8 @@ class Tub(service.MultiService):
         why = Failure(error.ConnectionDone("Tub.stopService was called"))
         for b in self.brokers.values():
             b.shutdown(why, fireDisconnectWatchers=False)
+        if self._timerWheel:
+            self._timerWheel.stop()
 
         d = defer.DeferredList(dl)
         d.addCallback(lambda _: service.MultiService.stopService(self))
@@ -860,8 +939,7 @@ class Tub(service.MultiService):
         if tubref.getTubID() == self.tubID:
             b = self._createLoopbackBroker(tubref)
             # _createLoopbackBroker will call brokerAttached, which will add
-            # it to self.brokers
-            # TODO: stash this in self.brokers, so we don't create multiples
+            # it to self.brokers, so later lookups will reuse it
             return defer.succeed(b)
 
         d = defer.Deferred()
@@ -954,19 +1032,23 @@ class Tub(service.MultiService):
                 del self.brokers[tubref]
 
     def debug_listBrokers(self):
-        # return a list of (tubref, inbound, outbound) tuples. The tubref
-        # tells you which broker this is, 'inbound' is a list of
-        # InboundDelivery objects (one per outstanding inbound message), and
-        # 'outbound' is a list of PendingRequest objects (one per message
-        # that's waiting on a remote broker to complete).
+        # return a list of (tubref, inbound, outbound, stats) tuples. The
+        # tubref tells you which broker this is, 'inbound' is a list of
+        # (InboundDelivery, ready_deferred) tuples (one per inbound message
+        # that has not been started yet), 'outbound' is a list of
+        # PendingRequest objects (one per message that's waiting on a remote
+        # broker to complete), and 'stats' is a dictionary from
+        # Broker.getInboundQueueStats with the queue depth and the number of
+        # inbound calls still running.
         output = []
         all_brokers = self.brokers.items()
         for tubref,_broker in all_brokers:
-            inbound = _broker.inboundDeliveryQueue[:]
+            inbound = list(_broker.inboundDeliveryQueue)
             outbound = [pr
                         for (reqID, pr) in
                         sorted(_broker.waitingForAnswers.items()) ]
-            output.append( (str(tubref), inbound, outbound) )
+            stats = _broker.getInboundQueueStats()
+            output.append( (str(tubref), inbound, outbound, stats) )
         output.sort(lambda x,y: cmp( (len(x[1]), len(x[2])),
                                      (len(y[1]), len(y[2])) ))
         return output
@@ -5,6 +5,7 @@
 # live in call.py
 
 import weakref
+from operator import attrgetter
 from zope.interface import interface
 from zope.interface import implements
 from twisted.python.components import registerAdapter
@@ -21,6 +22,7 @@ from foolscap.remoteinterface import getRemoteInterface, \
 from foolscap.schema import constraintMap
 from foolscap.copyable import Copyable, RemoteCopy
 from foolscap.eventual import eventually, fireEventually
+from foolscap.observer import OneShotObserverList
 from foolscap.furl import decode_furl
 
 class OnlyReferenceable(object):
@@ -29,33 +31,74 @@ class OnlyReferenceable(object):
     def processUniqueID(self):
         return id(self)
 
+class DispatchTable(object):
+    """I describe how remote calls are dispatched to instances of one class:
+    which RemoteInterface they provide, and for each method name, a function
+    that fetches the remote_ method from an instance along with the
+    RemoteMethodSchema that constrains it (or None if the class has no
+    RemoteInterface). I am built once, the first time an instance is used.
+    """
+
+    def __init__(self, interface, cls):
+        self.interface = interface
+        self.interfaceName = None
+        self.methods = {}
+        if interface:
+            self.interfaceName = interface.__remote_name__
+            for name in interface.names(all=True):
+                ms = interface.get(name)
+                if ms:
+                    self.methods[name] = (attrgetter("remote_" + name), ms)
+        else:
+            for attr in dir(cls):
+                if attr.startswith("remote_"):
+                    self.methods[attr[len("remote_"):]] = (attrgetter(attr),
+                                                           None)
+
+    def getMethodSchema(self, methodname):
+        entry = self.methods.get(methodname)
+        if entry:
+            return entry[1]
+        return None
+
+# maps class to DispatchTable
+_dispatchTables = {}
+
 class Referenceable(OnlyReferenceable):
     implements(ipb.IReferenceable, ipb.IRemotelyCallable)
-    _interface = None
-    _interfaceName = None
-
-    # TODO: this code wants to be in an adapter, not a base class. Also, it
-    # would be nice to cache this across the class: if every instance has the
-    # same interfaces, they will have the same values of _interface and
-    # _interfaceName, and it feels silly to store this data separately for
-    # each instance. Perhaps we could compare the instance's interface list
-    # with that of the class and only recompute this stuff if they differ.
+    _dispatchTable = None
+
+    # TODO: this code wants to be in an adapter, not a base class.
+
+    def getDispatchTable(self):
+        table = self._dispatchTable
+        if table is None:
+            cls = self.__class__
+            if "__provides__" in self.__dict__:
+                # this instance declares interfaces of its own, so it cannot
+                # share the table of its class
+                table = DispatchTable(getRemoteInterface(self), cls)
+            else:
+                table = _dispatchTables.get(cls)
+                if table is None:
+                    table = DispatchTable(getRemoteInterface(self), cls)
+                    _dispatchTables[cls] = table
+            self._dispatchTable = table
+        return table
 
     def getInterface(self):
-        if not self._interface:
-            self._interface = getRemoteInterface(self)
-            if self._interface:
-                self._interfaceName = self._interface.__remote_name__
-            else:
-                self._interfaceName = None
-        return self._interface
+        return self.getDispatchTable().interface
 
     def getInterfaceName(self):
-        self.getInterface()
-        return self._interfaceName
+        return self.getDispatchTable().interfaceName
 
     def doRemoteCall(self, methodname, args, kwargs):
-        meth = getattr(self, "remote_%s" % methodname)
+        entry = self.getDispatchTable().methods.get(methodname)
+        if entry:
+            # this honors remote_ methods set on the instance itself
+            meth = entry[0](self)
+        else:
+            meth = getattr(self, "remote_%s" % methodname)
         res = meth(*args, **kwargs)
         return res
 
@@ -296,6 +339,7 @@ class RemoteReferenceTracker(object):
         self.interface = getRemoteInterfaceByName(interfaceName)
         self.received_count = 0
         self.ref = None
+        self.callPlans = {} # maps method name to call.CallPlan
 
     def __repr__(self):
         s = "<RemoteReferenceTracker(clid=%d,url=%s)>" % (self.clid, self.url)
@@ -337,6 +381,11 @@ class RemoteReferenceTracker(object):
         # _handleRefLost. In this case, don't decref anything.
 
 
+# the underscore options that callRemote() accepts
+_CALL_OPTIONS = frozenset(["_callOnly", "_timeout", "_pipeline",
+                           "_methodConstraint", "_resultConstraint",
+                           "_useSchema"])
+
 class RemoteReferenceOnly(object):
     implements(ipb.IRemoteReference)
 
@@ -410,6 +459,12 @@ class RemoteReferenceOnly(object):
 class RemoteReference(RemoteReferenceOnly):
     def callRemote(self, _name, *args, **kwargs):
         # Note: for consistency, *all* failures are reported asynchronously.
+        if kwargs.get("_pipeline"):
+            try:
+                return self._callRemote(_name, *args, **kwargs)
+            except:
+                broker = self.tracker.broker
+                return RemotePromise(broker, None, defer.fail())
         return defer.maybeDeferred(self._callRemote, _name, *args, **kwargs)
 
     def callRemoteOnly(self, _name, *args, **kwargs):
@@ -421,27 +476,93 @@ class RemoteReference(RemoteReferenceOnly):
         del d
         return None
 
+    def callRemoteBatch(self, calls):
+        # each call gets its own Deferred, exactly as if it had been sent
+        # with callRemote, but they all travel in one 'call-batch'
+        broker = self.tracker.broker
+        results = []
+        batch = []
+        for (_name, args, kwargs) in calls:
+            # these do not get their answers back with the batch, so they
+            # are sent on their own
+            if kwargs.get("_callOnly"):
+                kwargs = kwargs.copy()
+                del kwargs["_callOnly"]
+                results.append(self.callRemoteOnly(_name, *args, **kwargs))
+                continue
+            if kwargs.get("_pipeline") or not broker.useCallBatch:
+                results.append(self.callRemote(_name, *args, **kwargs))
+                continue
+            kwargs = kwargs.copy()
+            timeout = kwargs.pop("_timeout", broker.callTimeout)
+            kwargs.pop("_callOnly", None)
+            kwargs.pop("_pipeline", None)
+            try:
+                req = self._prepareRequest(None, _name, args, kwargs)
+            except:
+                results.append(defer.fail())
+                continue
+            batch.append((req, timeout, args, kwargs))
+            results.append(req.deferred)
+        for i in range(0, len(batch), call.MAX_BATCH_CALLS):
+            self._sendBatch(batch[i:i+call.MAX_BATCH_CALLS])
+        return results
+
+    def _sendBatch(self, batch):
+        broker = self.tracker.broker
+        try:
+            # newRequestID() could fail with a DeadReferenceError
+            firstReqID = broker.newRequestID()
+        except:
+            f = failure.Failure()
+            for (req, timeout, args, kwargs) in batch:
+                req.fail(f)
+            return
+        # the far end derives each reqID from the first one, so these must
+        # be consecutive
+        requests = []
+        calls = []
+        for (req, timeout, args, kwargs) in batch:
+            if requests:
+                req.reqID = broker.newRequestID()
+            else:
+                req.reqID = firstReqID
+            broker.addRequest(req, timeout)
+            requests.append(req)
+            calls.append((req.methodName, args, kwargs))
+        slicer = call.CallBatchSlicer(firstReqID, self.tracker.clid, calls)
+        def _failed(f):
+            # none of the calls were delivered
+            for req in requests:
+                if req.active:
+                    req.fail(f)
+        try:
+            d = broker.send(slicer)
+            d.addErrback(_failed)
+        except:
+            _failed(failure.Failure())
+
     def _callRemote(self, _name, *args, **kwargs):
-        req = None
+        if kwargs and not _CALL_OPTIONS.isdisjoint(kwargs):
+            return self._callRemoteWithOptions(_name, args, kwargs)
+        # the common case: everything about the method was worked out the
+        # first time it was called
         broker = self.tracker.broker
+        # newRequestID() could fail with a DeadReferenceError
+        reqID = broker.newRequestID()
+        plan = self._getCallPlan(_name)
+        req = plan.newRequest(reqID, self, args, kwargs)
+        slicer = call.CallSlicer(reqID, self.tracker.clid, plan.methodName,
+                                 args, kwargs)
+        self._sendRequest(broker, req, broker.callTimeout, slicer)
+        return req.deferred
 
-        # remember that "none" is not a valid constraint, so we use it to
-        # mean "not set by the caller", which means we fall back to whatever
-        # the RemoteInterface says. Using None would mean an AnyConstraint,
-        # which is not the same thing.
-        methodConstraintOverride = kwargs.get("_methodConstraint", "none")
-        resultConstraint = kwargs.get("_resultConstraint", "none")
-        useSchema = kwargs.get("_useSchema", True)
-        callOnly = kwargs.get("_callOnly", False)
-
-        if "_methodConstraint" in kwargs:
-            del kwargs["_methodConstraint"]
-        if "_resultConstraint" in kwargs:
-            del kwargs["_resultConstraint"]
-        if "_useSchema" in kwargs:
-            del kwargs["_useSchema"]
-        if "_callOnly" in kwargs:
-            del kwargs["_callOnly"]
+    def _callRemoteWithOptions(self, _name, args, kwargs):
+        broker = self.tracker.broker
+
+        callOnly = kwargs.pop("_callOnly", False)
+        timeout = kwargs.pop("_timeout", broker.callTimeout)
+        pipeline = kwargs.pop("_pipeline", False)
 
         if callOnly:
             if broker.disconnected:
@@ -452,50 +573,30 @@ class RemoteReference(RemoteReferenceOnly):
             # newRequestID() could fail with a DeadReferenceError
             reqID = broker.newRequestID()
 
-        # in this section, we validate the outbound arguments against our
-        # notion of what the other end will accept (the RemoteInterface)
-
-        # first, figure out which method they want to invoke
-        (interfaceName,
-         methodName,
-         methodSchema) = self._getMethodInfo(_name)
-
-        req = call.PendingRequest(reqID, self, interfaceName, methodName)
-        # TODO: consider adding a stringified stack trace to that
-        # PendingRequest creation, so that DeadReferenceError can emit even
-        # more information about the call which failed
-
-        # for debugging: these are put into the messages emitted when
-        # logRemoteFailures is turned on
-        req.interfaceName = interfaceName
-        req.methodName = methodName
-
-        if methodConstraintOverride != "none":
-            methodSchema = methodConstraintOverride
-
-        if useSchema and methodSchema:
-            # check args against the arg constraint. This could fail if
-            # any arguments are of the wrong type
-            try:
-                methodSchema.checkAllArgs(args, kwargs, False)
-            except Violation, v:
-                v.setLocation("%s.%s(%s)" % (interfaceName, methodName,
-                                             v.getLocation()))
-                raise
+        req = self._prepareRequest(reqID, _name, args, kwargs)
+        methodName = req.methodName
 
-            # the Interface gets to constraint the return value too, so
-            # make a note of it to use later
-            req.setConstraint(methodSchema.getResponseConstraint())
+        clid = self.tracker.clid
+        retained = pipeline and broker.useCallPipeline
+        if retained:
+            # ask the far end to keep the result, so we can pipeline calls
+            # onto it before the answer gets back to us
+            slicer = call.PromiseCallSlicer(reqID, call.RETAIN_ANSWER, clid,
+                                            methodName, args, kwargs)
+        else:
+            slicer = call.CallSlicer(reqID, clid, methodName, args, kwargs)
 
-        # if the caller specified a _resultConstraint, that overrides
-        # the schema's one
-        if resultConstraint != "none":
-            # overrides schema
-            req.setConstraint(IConstraint(resultConstraint))
+        # if callOnly, the PendingRequest will never know about the broker,
+        # and will therefore never ask to be removed from it
+        self._sendRequest(broker, req, timeout, slicer, not callOnly)
 
-        clid = self.tracker.clid
-        slicer = call.CallSlicer(reqID, clid, methodName, args, kwargs)
+        if pipeline:
+            if not retained:
+                reqID = None
+            return RemotePromise(broker, reqID, req.deferred)
+        return req.deferred
 
+    def _sendRequest(self, broker, req, timeout, slicer, track=True):
         # up to this point, we are not committed to sending anything to the
         # far end. The various phases of commitment are:
 
@@ -518,10 +619,8 @@ class RemoteReference(RemoteReferenceOnly):
         # commitment point 1. We assume that if this call raises an
         # exception, the broker will be sure to not track the dead
         # PendingRequest
-        if not callOnly:
-            broker.addRequest(req)
-            # if callOnly, the PendingRequest will never know about the
-            # broker, and will therefore never ask to be removed from it
+        if track:
+            broker.addRequest(req, timeout)
 
         # TODO: there is a decidability problem here: if the reqID made
         # it through, the other end will send us an answer (possibly an
@@ -560,7 +659,56 @@ class RemoteReference(RemoteReferenceOnly):
         #  method result violated our results schema
         # if none of those occurred, the callback will be run
 
-        return req.deferred
+    def _getCallPlan(self, name):
+        plans = self.tracker.callPlans
+        plan = plans.get(name)
+        if plan is None:
+            # _getMethodInfo raises Violation for methods our
+            # RemoteInterface does not offer, so those are never remembered
+            plan = call.CallPlan(*self._getMethodInfo(name))
+            plans[name] = plan
+        return plan
+
+    def _prepareRequest(self, reqID, _name, args, kwargs):
+        # remember that "none" is not a valid constraint, so we use it to
+        # mean "not set by the caller", which means we fall back to whatever
+        # the RemoteInterface says. Using None would mean an AnyConstraint,
+        # which is not the same thing.
+        methodConstraintOverride = kwargs.pop("_methodConstraint", "none")
+        resultConstraint = kwargs.pop("_resultConstraint", "none")
+        useSchema = kwargs.pop("_useSchema", True)
+
+        # in this section, we validate the outbound arguments against our
+        # notion of what the other end will accept (the RemoteInterface)
+
+        # first, figure out which method they want to invoke
+        plan = self._getCallPlan(_name)
+        methodSchema = plan.methodSchema
+
+        # TODO: consider adding a stringified stack trace to the
+        # PendingRequest, so that DeadReferenceError can emit even more
+        # information about the call which failed. The interface and method
+        # names are put into the messages emitted when logRemoteFailures is
+        # turned on.
+        req = call.PendingRequest(reqID, self, plan.interfaceName,
+                                  plan.methodName)
+
+        if methodConstraintOverride != "none":
+            methodSchema = methodConstraintOverride
+
+        if useSchema and methodSchema:
+            plan.checkArgs(methodSchema, args, kwargs)
+            # the Interface gets to constraint the return value too, so
+            # make a note of it to use later
+            req.setConstraint(methodSchema.getResponseConstraint())
+
+        # if the caller specified a _resultConstraint, that overrides
+        # the schema's one
+        if resultConstraint != "none":
+            # overrides schema
+            req.setConstraint(IConstraint(resultConstraint))
+
+        return req
 
     def _getMethodInfo(self, name):
         assert type(name) is str
@@ -579,6 +727,110 @@ class RemoteReference(RemoteReferenceOnly):
         return interfaceName, methodName, methodSchema
 
 
+class RemotePromise(object):
+    """I stand for the result of a callRemote(_pipeline=True) that has not
+    been answered yet.
+
+    Calls made with my callRemote() are pipelined: if the far end
+    understands it, they are sent right away, as 'call this method on the
+    result of request N', and the far end makes them as soon as that result
+    is ready, without waiting for us to see it. Otherwise, and once my own
+    answer has arrived, they are sent to the result in the usual way.
+    """
+
+    def __init__(self, broker, reqID, deferred):
+        self.broker = broker
+        self.reqID = reqID # None if the far end is not keeping the answer
+        self._observers = OneShotObserverList()
+        self._resolved = False
+        deferred.addBoth(self._resolve)
+
+    def __repr__(self):
+        return "<RemotePromise for reqID %s>" % (self.reqID,)
+
+    def _resolve(self, res):
+        self._resolved = True
+        self._observers.fire(res)
+        if self.reqID is not None and self.broker.remote_broker:
+            # any calls we pipelined onto it have already been sent
+            self.broker.remote_broker.callRemoteOnly("release_answer",
+                                                     reqID=self.reqID)
+        return None
+
+    def when(self):
+        """Return a Deferred that fires (in a later turn) with the result of
+        the call I stand for, or with its Failure."""
+        return self._observers.whenFired()
+
+    def callRemote(self, _name, *args, **kwargs):
+        if kwargs.get("_pipeline"):
+            try:
+                return self._callRemote(_name, *args, **kwargs)
+            except:
+                return RemotePromise(self.broker, None, defer.fail())
+        return defer.maybeDeferred(self._callRemote, _name, *args, **kwargs)
+
+    def _callRemote(self, _name, *args, **kwargs):
+        broker = self.broker
+        if self._resolved or self.reqID is None:
+            return self._callWhenResolved(_name, args, kwargs)
+        callOnly = kwargs.pop("_callOnly", False)
+        pipeline = kwargs.pop("_pipeline", False)
+        timeout = kwargs.pop("_timeout", broker.callTimeout)
+        methodSchema = kwargs.pop("_methodConstraint", "none")
+        resultConstraint = kwargs.pop("_resultConstraint", "none")
+        useSchema = kwargs.pop("_useSchema", True)
+        if callOnly:
+            if broker.disconnected:
+                # DeadReferenceError is silently consumed
+                return
+            # nobody will see the answer, so it cannot be retained either
+            reqID = 0
+            pipeline = False
+        else:
+            # newRequestID() could fail with a DeadReferenceError
+            reqID = broker.newRequestID()
+        req = call.PendingRequest(reqID, self, None, _name)
+        # we do not know the RemoteInterface of our result, so unless the
+        # caller gave us a schema, the far end checks the arguments against
+        # its own once the result is ready
+        if useSchema and methodSchema not in ("none", None):
+            try:
+                methodSchema.checkAllArgs(args, kwargs, False)
+            except Violation, v:
+                v.setLocation("%s(%s)" % (_name, v.getLocation()))
+                raise
+            req.setConstraint(methodSchema.getResponseConstraint())
+        if resultConstraint != "none":
+            req.setConstraint(IConstraint(resultConstraint))
+        flags = call.TARGET_IS_ANSWER
+        if pipeline:
+            flags |= call.RETAIN_ANSWER
+        slicer = call.PromiseCallSlicer(reqID, flags, self.reqID,
+                                        _name, args, kwargs)
+        if not callOnly:
+            broker.addRequest(req, timeout)
+        try:
+            d = broker.send(slicer)
+            d.addErrback(req.fail)
+        except:
+            req.fail(failure.Failure())
+        if callOnly:
+            return None
+        if pipeline:
+            return RemotePromise(broker, reqID, req.deferred)
+        return req.deferred
+
+    def _callWhenResolved(self, _name, args, kwargs):
+        pipeline = kwargs.pop("_pipeline", False)
+        d = self.when()
+        def _send(target):
+            return target.callRemote(_name, *args, **kwargs)
+        d.addCallback(_send)
+        if pipeline:
+            return RemotePromise(self.broker, None, d)
+        return d
+
 class RemoteMethodReferenceTracker(RemoteReferenceTracker):
     def getRef(self):
         if self.ref is None:
@@ -763,9 +1015,7 @@ class TheirReferenceUnslicer(slicer.LeafUnslicer):
     def ackGift(self, rref):
         # giftID==0 means they aren't doing reference counting
         if self.giftID != 0:
-            rb = self.broker.remote_broker
-            # if we lose the connection, they'll decref the gift anyway
-            rb.callRemoteOnly("decgift", giftID=self.giftID, count=1)
+            self.broker.releaseGift(self.giftID, 1)
         return rref
 
     def describe(self):
@@ -189,6 +189,7 @@ class RemoteMethodSchema(object):
             self.argConstraints[argname] = constraint
             if not isinstance(constraint, Optional):
                 self.required.append(argname)
+        self.compileCheckers()
 
     def initFromMethod(self, method):
         # call this with the Interface's prototype method: the one that has
@@ -223,6 +224,19 @@ class RemoteMethodSchema(object):
         # call the method, its 'return' value is the return constraint
         self.responseConstraint = IConstraint(method())
         self.options = {} # return, wait, reliable, etc
+        self.compileCheckers()
+
+    def compileCheckers(self):
+        # checkAllArgs and checkResults run on every call, so the
+        # constraints are compiled once, when the schema is created
+        self.argCheckers = {}
+        for argname, c in self.argConstraints.items():
+            if isinstance(c, Optional):
+                c = c.constraint
+            self.argCheckers[argname] = c.compileChecker()
+        self.responseChecker = None
+        if self.responseConstraint:
+            self.responseChecker = self.responseConstraint.compileChecker()
 
 
     def getPositionalArgConstraint(self, argnum):
@@ -274,14 +288,18 @@ class RemoteMethodSchema(object):
                                 % (argname,))
             allargs[argname] = argvalue
 
+        argCheckers = self.argCheckers
         for argname, argvalue in allargs.items():
-            accept, constraint = self.getKeywordArgConstraint(argname)
-            if not accept:
-                # this argument will be ignored by the far end. TODO: emit a
-                # warning
-                pass
+            check = argCheckers.get(argname)
+            if check is None:
+                accept, constraint = self.getKeywordArgConstraint(argname)
+                if not accept:
+                    # this argument will be ignored by the far end. TODO:
+                    # emit a warning
+                    pass
+                check = constraint.checkObject
             try:
-                constraint.checkObject(argvalue, inbound)
+                check(argvalue, inbound)
             except Violation, v:
                 v.setLocation("%s=" % argname)
                 raise
@@ -290,11 +308,19 @@ class RemoteMethodSchema(object):
             if argname not in allargs:
                 raise Violation("missing required argument '%s'" % argname)
 
+    def checkRequiredArgs(self, args, kwargs):
+        # the ArgumentUnslicer has already rejected extra, unknown, and
+        # duplicated arguments, and checked each value
+        positional = self.argumentNames[:len(args)]
+        for argname in self.required:
+            if argname not in kwargs and argname not in positional:
+                raise Violation("missing required argument '%s'" % argname)
+
     def checkResults(self, results, inbound):
-        if self.responseConstraint:
+        if self.responseChecker:
             # this might raise a Violation. The caller will annotate its
             # location appropriately: they have more information than we do.
-            self.responseConstraint.checkObject(results, inbound)
+            self.responseChecker(results, inbound)
 
 class UnconstrainedMethod(object):
     """I am a method constraint that accepts any arguments and any return
@@ -316,6 +342,8 @@ class UnconstrainedMethod(object):
         return (True, Any())
     def checkAllArgs(self, args, kwargs, inbound):
         pass # accept everything
+    def checkRequiredArgs(self, args, kwargs):
+        pass
     def getResponseConstraint(self):
         return Any()
     def checkResults(self, results, inbound):
@@ -19,6 +19,8 @@
 primitive constraints:
    - types.StringType: string with maxLength=1k
    - String(maxLength=1000): string with arbitrary maxLength
+   - StreamedBytes(sinkFactory, maxLength=None): string argument which is
+     written to a sink as it arrives, instead of being held in memory
    - types.BooleanType: boolean
    - types.IntType: integer that fits in s_int32_t
    - types.LongType: integer with abs(num) < 2**8192 (fits in 1024 bytes)
@@ -59,6 +61,7 @@ from foolscap.tokens import Violation, UnknownSchemaType, BananaError, \
 
 # make constraints available in a single location
 from foolscap.constraint import Constraint, Any, ByteStringConstraint, \
+     StreamedBytesConstraint, \
      IntegerConstraint, NumberConstraint, IConstraint, Optional, Shared
 from foolscap.slicers.unicode import UnicodeConstraint
 from foolscap.slicers.bool import BooleanConstraint
@@ -69,7 +72,8 @@ from foolscap.slicers.tuple import TupleConstraint
 from foolscap.slicers.none import Nothing
 #  we don't import RemoteMethodSchema from remoteinterface.py, because
 #  remoteinterface.py needs to import us (for addToConstraintTypeMap)
-ignored = [Constraint, Any, ByteStringConstraint, UnicodeConstraint,
+ignored = [Constraint, Any, ByteStringConstraint, StreamedBytesConstraint,
+           UnicodeConstraint,
            IntegerConstraint, NumberConstraint, BooleanConstraint,
            DictConstraint, ListConstraint, SetConstraint, TupleConstraint,
            Nothing, Optional, Shared,
@@ -123,6 +127,20 @@ class PolyConstraint(Constraint):
             raise Violation("object type %s does not satisfy any of %s"
                             % (type(obj), self.alternatives))
 
+    def makeChecker(self, memo):
+        alternatives = self.alternatives
+        checkers = [c.compileChecker(memo) for c in alternatives]
+        def check(obj, inbound):
+            for checkOne in checkers:
+                try:
+                    checkOne(obj, inbound)
+                    return
+                except Violation:
+                    pass
+            raise Violation("object type %s does not satisfy any of %s"
+                            % (type(obj), alternatives))
+        return check
+
 ChoiceOf = PolyConstraint
 
 def AnyStringConstraint(*args, **kwargs):
@@ -132,6 +150,7 @@ def AnyStringConstraint(*args, **kwargs):
 # keep the old meaning, for now. Eventually StringConstraint should become an
 # AnyStringConstraint
 StringConstraint = ByteStringConstraint
+StreamedBytes = StreamedBytesConstraint
 
 constraintMap = {
     str: ByteStringConstraint(),
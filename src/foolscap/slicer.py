@@ -146,6 +146,10 @@ class UnslicerClass(type):
 class BaseUnslicer(object):
     __metaclass__ = UnslicerClass
     opentype = None
+    # large STRING tokens are normally delivered to receiveChild as a str.
+    # Unslicers which set this can be given a memoryview of the receive
+    # buffer instead, which saves a copy of the body.
+    acceptsStringBuffers = False
     implements(tokens.IUnslicer)
 
     def __init__(self):
@@ -197,6 +201,19 @@ class BaseUnslicer(object):
 
         return self.open(opentype)
 
+    def getStringSink(self, size):
+        """Called when a STRING token of 'size' bytes, which checkToken has
+        accepted, starts to arrive before its whole body is available.
+        Return None to have the body delivered to receiveChild as a single
+        string, as usual. Otherwise return a sink: an object with a
+        .write(data) method, which will be called with successive pieces of
+        the body as they arrive, and a .finish() method, which is called
+        after the last piece. The value returned by .finish() is delivered
+        to receiveChild in place of the string. Exceptions raised by the
+        sink will drop the connection.
+        """
+        return None
+
     def receiveChild(self, obj, ready_deferred=None):
         """Unslicers for containers should accumulate their children's
         ready_deferreds, then combine them in an AsyncAND when receiveClose()
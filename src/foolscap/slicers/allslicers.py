@@ -17,6 +17,7 @@ from foolscap.slicers.dict import DictSlicer, DictUnslicer, OrderedDictSlicer
 from foolscap.slicers.vocab import ReplaceVocabSlicer, ReplaceVocabUnslicer
 from foolscap.slicers.vocab import ReplaceVocabularyTable, AddToVocabularyTable
 from foolscap.slicers.vocab import AddVocabSlicer, AddVocabUnslicer
+from foolscap.slicers.filebody import FileBodySlicer
 from foolscap.slicers.root import RootSlicer, RootUnslicer
 
 # appease pyflakes
@@ -34,5 +35,6 @@ unused = [
     ReplaceVocabSlicer, ReplaceVocabUnslicer,
     ReplaceVocabularyTable, AddToVocabularyTable,
     AddVocabSlicer, AddVocabUnslicer,
+    FileBodySlicer,
     RootSlicer, RootUnslicer,
     ]
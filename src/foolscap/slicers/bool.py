@@ -57,6 +57,7 @@ class BooleanConstraint(OpenerConstraint):
     opentypes = [("boolean",)]
     _myint = IntegerConstraint()
     name = "BooleanConstraint"
+    checkedOnReceive = True
 
     def __init__(self, value=None):
         # self.value is a joke. This allows you to use a schema of
@@ -70,3 +71,13 @@ class BooleanConstraint(OpenerConstraint):
         if self.value != None:
             if obj != self.value:
                 raise Violation("not %s" % self.value)
+
+    def makeChecker(self, memo):
+        value = self.value
+        def check(obj, inbound):
+            if type(obj) != bool:
+                raise Violation("not a bool")
+            if value != None:
+                if obj != value:
+                    raise Violation("not %s" % value)
+        return check
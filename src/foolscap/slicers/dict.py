@@ -135,6 +135,8 @@ class DictConstraint(OpenerConstraint):
         self.keyConstraint = IConstraint(keyConstraint)
         self.valueConstraint = IConstraint(valueConstraint)
         self.maxKeys = maxKeys
+        self.checkedOnReceive = (self.keyConstraint.checkedOnReceive and
+                                 self.valueConstraint.checkedOnReceive)
     def checkObject(self, obj, inbound):
         if not isinstance(obj, dict):
             raise Violation, "'%s' (%s) is not a Dictionary" % (obj,
@@ -145,3 +147,19 @@ class DictConstraint(OpenerConstraint):
         for key, value in obj.iteritems():
             self.keyConstraint.checkObject(key, inbound)
             self.valueConstraint.checkObject(value, inbound)
+
+    def makeChecker(self, memo):
+        maxKeys = self.maxKeys
+        checkKey = self.keyConstraint.compileChecker(memo)
+        checkValue = self.valueConstraint.compileChecker(memo)
+        def check(obj, inbound):
+            if not isinstance(obj, dict):
+                raise Violation, "'%s' (%s) is not a Dictionary" % (obj,
+                                                                    type(obj))
+            if maxKeys != None and len(obj) > maxKeys:
+                raise Violation, "Dict keys=%d > maxKeys=%d" % (len(obj),
+                                                                maxKeys)
+            for key, value in obj.iteritems():
+                checkKey(key, inbound)
+                checkValue(value, inbound)
+        return check
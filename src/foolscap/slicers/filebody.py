@@ -0,0 +1,78 @@
+# -*- test-case-name: foolscap.test.test_banana -*-
+
+import os
+from zope.interface import implements
+from foolscap.tokens import BananaError, IStreamedString, StringBodyChunk
+from foolscap.slicer import BaseSlicer
+
+class FileBody:
+    """I wrap a file-like object (or an iterator of strings) so that its
+    contents are sent as a single bytestring, without reading the whole
+    thing into memory first. The data is read in chunkSize pieces as the
+    transport accepts it, so callRemote('put', FileBody(f)) can move a large
+    file with bounded memory.
+
+    The length of the string must be known before it is sent. If size= is
+    not provided, the source must be a seekable file, and everything from
+    its current position to the end will be sent. Iterators always require
+    size=. If the source then provides more or less data than promised, the
+    connection is dropped, because the STRING token cannot be abandoned
+    halfway through.
+
+    On the receiving side this arrives as an ordinary string: use a
+    StreamedBytes constraint to keep it out of memory there too.
+    """
+    implements(IStreamedString)
+
+    chunkSize = 64*1024
+
+    def __init__(self, source, size=None, chunkSize=None):
+        self.source = source
+        if chunkSize is not None:
+            self.chunkSize = chunkSize
+        if size is None:
+            here = source.tell()
+            source.seek(0, os.SEEK_END)
+            size = source.tell() - here
+            source.seek(here)
+        self.size = size
+
+    def __repr__(self):
+        return "<FileBody (%d bytes)>" % self.size
+
+    def iterChunks(self):
+        read = getattr(self.source, "read", None)
+        if read is None:
+            for data in self.source:
+                yield data
+            return
+        remaining = self.size
+        while remaining:
+            data = read(min(self.chunkSize, remaining))
+            if not data:
+                return
+            remaining -= len(data)
+            yield data
+
+class FileBodySlicer(BaseSlicer):
+    # this produces a bare STRING token, not an OPEN sequence
+    sendOpen = False
+    trackReferences = False
+    slices = FileBody
+
+    def slice(self, streamable, banana):
+        self.streamable = streamable
+        remaining = self.obj.size
+        banana.sendStringHeader(remaining)
+        for data in self.obj.iterChunks():
+            if len(data) > remaining:
+                raise BananaError("%r provided more data than promised"
+                                  % self.obj)
+            remaining -= len(data)
+            yield StringBodyChunk(data)
+        if remaining:
+            raise BananaError("%r ended %d bytes early"
+                              % (self.obj, remaining))
+
+    def describe(self):
+        return "<FileBody>"
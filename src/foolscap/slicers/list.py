@@ -125,6 +125,9 @@ class ListConstraint(OpenerConstraint):
         self.constraint = IConstraint(constraint)
         self.maxLength = maxLength
         self.minLength = minLength
+        # ListUnslicer does not enforce minLength
+        self.checkedOnReceive = (self.constraint.checkedOnReceive
+                                 and not minLength)
 
     def checkObject(self, obj, inbound):
         if not isinstance(obj, list):
@@ -135,3 +138,18 @@ class ListConstraint(OpenerConstraint):
             raise Violation("list too short")
         for o in obj:
             self.constraint.checkObject(o, inbound)
+
+    def makeChecker(self, memo):
+        maxLength = self.maxLength
+        minLength = self.minLength
+        checkItem = self.constraint.compileChecker(memo)
+        def check(obj, inbound):
+            if not isinstance(obj, list):
+                raise Violation("not a list")
+            if maxLength is not None and len(obj) > maxLength:
+                raise Violation("list too long")
+            if len(obj) < minLength:
+                raise Violation("list too short")
+            for o in obj:
+                checkItem(o, inbound)
+        return check
@@ -28,6 +28,7 @@ class Nothing(OpenerConstraint):
     strictTaster = True
     opentypes = [("none",)]
     name = "Nothing"
+    checkedOnReceive = True
 
     def checkObject(self, obj, inbound):
         if obj is not None:
@@ -1,6 +1,7 @@
 # -*- test-case-name: foolscap.test.test_banana -*-
 
 import types
+from collections import deque
 from zope.interface import implements
 from twisted.internet.defer import Deferred
 from foolscap import tokens
@@ -22,7 +23,7 @@ class RootSlicer:
 
     def __init__(self, protocol):
         self.protocol = protocol
-        self.sendQueue = []
+        self.sendQueue = deque()
 
     def allowStreaming(self, streamable):
         self.streamableInGeneral = streamable
@@ -74,7 +75,7 @@ class RootSlicer:
             self.objectSentDeferred.callback(None)
             self.objectSentDeferred = None
         if self.sendQueue:
-            (obj, self.objectSentDeferred) = self.sendQueue.pop()
+            (obj, self.objectSentDeferred) = self.sendQueue.popleft()
             self.streamable = self.streamableInGeneral
             return obj
         if self.protocol.debugSend:
@@ -117,7 +118,7 @@ class RootSlicer:
             self.objectSentDeferred = None
         for obj, d in self.sendQueue:
             d.errback(why)
-        self.sendQueue = []
+        self.sendQueue = deque()
 
 class ScopedRootSlicer(RootSlicer):
     # this combines RootSlicer with foolscap.slicer.ScopedSlicer . The funny
@@ -172,3 +172,22 @@ class SetConstraint(OpenerConstraint):
         if self.constraint:
             for o in obj:
                 self.constraint.checkObject(o, inbound)
+
+    def makeChecker(self, memo):
+        mutable = self.mutable
+        maxLength = self.maxLength
+        checkItem = self.constraint.compileChecker(memo)
+        def check(obj, inbound):
+            if not isinstance(obj, (set, frozenset)):
+                raise Violation("not a set")
+            if (mutable == True and
+                not isinstance(obj, set)):
+                raise Violation("obj is a set, but not a mutable one")
+            if (mutable == False and
+                not isinstance(obj, frozenset)):
+                raise Violation("obj is a set, but not an immutable one")
+            if maxLength is not None and len(obj) > maxLength:
+                raise Violation("set is too large")
+            for o in obj:
+                checkItem(o, inbound)
+        return check
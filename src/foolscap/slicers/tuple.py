@@ -104,6 +104,9 @@ class TupleUnslicer(BaseUnslicer):
     def receiveClose(self):
         if self.debug:
             print "%s[%d].receiveClose" % (self, self.count)
+        if (self.constraints is not None
+            and len(self.list) < len(self.constraints)):
+            raise Violation("wrong size tuple")
         self.finished = 1
 
         if self.num_unreferenceable_children:
@@ -128,6 +131,10 @@ class TupleConstraint(OpenerConstraint):
 
     def __init__(self, *elemConstraints):
         self.constraints = [IConstraint(e) for e in elemConstraints]
+        self.checkedOnReceive = True
+        for c in self.constraints:
+            if not c.checkedOnReceive:
+                self.checkedOnReceive = False
     def checkObject(self, obj, inbound):
         if not isinstance(obj, tuple):
             raise Violation("not a tuple")
@@ -135,3 +142,15 @@ class TupleConstraint(OpenerConstraint):
             raise Violation("wrong size tuple")
         for i in range(len(self.constraints)):
             self.constraints[i].checkObject(obj[i], inbound)
+
+    def makeChecker(self, memo):
+        checkers = [c.compileChecker(memo) for c in self.constraints]
+        size = len(checkers)
+        def check(obj, inbound):
+            if not isinstance(obj, tuple):
+                raise Violation("not a tuple")
+            if len(obj) != size:
+                raise Violation("wrong size tuple")
+            for checkItem, o in zip(checkers, obj):
+                checkItem(o, inbound)
+        return check
@@ -1,6 +1,7 @@
 # -*- test-case-name: foolscap.test.test_banana -*-
 
 import re
+from codecs import utf_8_decode
 from twisted.internet.defer import Deferred
 from foolscap.tokens import BananaError, STRING, VOCAB, Violation
 from foolscap.slicer import BaseSlicer, LeafUnslicer
@@ -17,6 +18,8 @@ class UnicodeUnslicer(LeafUnslicer):
     opentype = ("unicode",)
     string = None
     constraint = None
+    # a large body is decoded straight out of the receive buffer
+    acceptsStringBuffers = True
 
     def setConstraint(self, constraint):
         if isinstance(constraint, Any):
@@ -35,7 +38,10 @@ class UnicodeUnslicer(LeafUnslicer):
         assert ready_deferred is None
         if self.string != None:
             raise BananaError("already received a string")
-        self.string = unicode(obj, "UTF-8")
+        if isinstance(obj, memoryview):
+            self.string = utf_8_decode(obj, "strict", True)[0]
+        else:
+            self.string = unicode(obj, "UTF-8")
 
     def receiveClose(self):
         return self.string, None
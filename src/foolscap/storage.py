@@ -23,6 +23,7 @@ from pickle import whichmodule  # used by FunctionSlicer
 from foolscap import slicer, banana, tokens
 from foolscap.tokens import BananaError
 from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
 from twisted.python import reflect
 from foolscap.slicers.dict import OrderedDictSlicer
 from foolscap.slicers.root import ScopedRootSlicer, ScopedRootUnslicer
@@ -408,7 +409,10 @@ class SerializerTransport:
 
 def serialize(obj, outstream=None, root_class=StorageRootSlicer, banana=None):
     """Serialize an object graph into a sequence of bytes. Returns a Deferred
-    that fires with the sequence of bytes."""
+    that fires with the sequence of bytes. If outstream= is provided, the
+    bytes are written to its .write() method as they are produced (in
+    pieces of about Banana.outputFlushThreshold bytes), and the Deferred
+    fires with outstream instead."""
     if banana:
         b = banana
     else:
@@ -434,8 +438,32 @@ def serialize(obj, outstream=None, root_class=StorageRootSlicer, banana=None):
         d.addCallback(lambda res: outstream)
     return d
 
+# input streams are read in pieces of this size
+READ_SIZE = 64*1024
+
+def _feed(b, str_or_instream):
+    """Deliver serialized bytes to a Banana. str_or_instream can be a
+    string, a file-like object with a .read() method (including an mmap),
+    or an iterator of strings. Streams are read READ_SIZE bytes at a time,
+    and Banana discards each token once it has been parsed, so memory use
+    is bounded by the largest token rather than by the whole input."""
+    if isinstance(str_or_instream, str):
+        b.dataReceived(str_or_instream)
+        return
+    read = getattr(str_or_instream, "read", None)
+    if read is not None:
+        chunks = iter(lambda: read(READ_SIZE), "")
+    else:
+        chunks = iter(str_or_instream)
+    for data in chunks:
+        if b.connectionAbandoned:
+            break
+        b.dataReceived(data)
+
 def unserialize(str_or_instream, banana=None, root_class=StorageRootUnslicer):
-    """Unserialize a sequence of bytes back into an object graph."""
+    """Unserialize a sequence of bytes back into an object graph. The bytes
+    can be provided as a string, a file-like object, or an iterator of
+    strings."""
     if banana:
         b = banana
     else:
@@ -443,10 +471,7 @@ def unserialize(str_or_instream, banana=None, root_class=StorageRootUnslicer):
         b.unslicerClass = root_class
     b.connectionMade()
     d = b.prepare() # this will fire with the unserialized object
-    if isinstance(str_or_instream, str):
-        b.dataReceived(str_or_instream)
-    else:
-        raise RuntimeError("input streams not implemented yet")
+    _feed(b, str_or_instream)
     def _report_error(res):
         if b.disconnectReason:
             return b.disconnectReason
@@ -456,3 +481,130 @@ def unserialize(str_or_instream, banana=None, root_class=StorageRootUnslicer):
     d.addCallback(_report_error)
     return d
 
+class _ChunkTransport:
+    def __init__(self):
+        self.chunks = []
+    def write(self, data):
+        self.chunks.append(data)
+    def loseConnection(self, why="ignored"):
+        pass
+
+class SyncStorageBanana(StorageBanana):
+    """I am a StorageBanana that can be used over and over again, to
+    serialize and unserialize one object at a time without waiting for a
+    Deferred. Building a new Banana (and its root slicer and unslicer) for
+    each small object costs far more than encoding the object, so
+    serialize_sync() and unserialize_sync() keep a few of these around.
+
+    Everything happens inside the call: the Deferreds that Banana uses
+    internally have fired by the time it returns, and no reactor turn is
+    needed. If a slicer yields a Deferred of its own, the object cannot be
+    serialized this way, and BananaError is raised.
+    """
+
+    def __init__(self, slicerClass=None, unslicerClass=None):
+        StorageBanana.__init__(self)
+        if slicerClass:
+            self.slicerClass = slicerClass
+        if unslicerClass:
+            self.unslicerClass = unslicerClass
+        self.transport = _ChunkTransport()
+        self.connectionMade()
+
+    def _resetReferences(self, root):
+        # the scoped roots remember every object seen so far, but each
+        # serialized string must stand alone
+        references = getattr(root, "references", None)
+        if references:
+            references.clear()
+
+    def serializeOne(self, obj, outstream=None):
+        self.openCount = 0
+        self._resetReferences(self.rootSlicer)
+        results = []
+        if outstream is not None:
+            transport, self.transport = (self.transport,
+                                         SerializerTransport(outstream))
+        d = self.send(obj)
+        d.addBoth(results.append)
+        if outstream is not None:
+            self.transport = transport
+        chunks = self.transport.chunks
+        self.transport.chunks = []
+        if not results:
+            # a slicer is waiting on a Deferred. We are stuck partway
+            # through the object, so this Banana must not be used again.
+            self.transport = None
+            raise BananaError("%r cannot be serialized synchronously"
+                              % (obj,))
+        if isinstance(results[0], Failure):
+            results[0].raiseException()
+        if outstream is not None:
+            return outstream
+        return "".join(chunks)
+
+    def unserializeOne(self, str_or_instream):
+        self.initReceive()
+        self.receiveStack = [self.rootUnslicer]
+        self.objectCounter = 0
+        self.objects = {}
+        self._resetReferences(self.rootUnslicer)
+        self.results = []
+        _feed(self, str_or_instream)
+        results = self.results
+        del self.results
+        if self.violation:
+            self.violation.raiseException()
+        if not results:
+            raise BananaError("incomplete serialized object")
+        if len(results) > 1:
+            raise BananaError("expected one serialized object, got %d"
+                              % len(results))
+        return results[0]
+
+    def receiveChild(self, obj, ready_deferred):
+        if ready_deferred:
+            raise BananaError("%r cannot be unserialized synchronously"
+                              % (obj,))
+        self.results.append(obj)
+
+# idle SyncStorageBananas, a few for each (slicerClass, unslicerClass).
+# Each call takes one out of the pool while it works, so a nested call
+# (from inside a slicer, say) simply gets a Banana of its own.
+_syncPool = {}
+_syncPoolSize = 4
+
+def _getSyncBanana(key):
+    pool = _syncPool.get(key)
+    if pool:
+        return pool.pop()
+    return SyncStorageBanana(*key)
+
+def _returnSyncBanana(key, b):
+    pool = _syncPool.setdefault(key, [])
+    if len(pool) < _syncPoolSize:
+        pool.append(b)
+
+def serialize_sync(obj, outstream=None, root_class=StorageRootSlicer):
+    """Serialize an object graph into a sequence of bytes, and return them
+    directly (or write them to outstream, and return that). This is much
+    faster than serialize() for small objects. It raises BananaError if
+    some slicer has to wait for a Deferred, and re-raises any other
+    serialization error (such as the Violation for an object that cannot
+    be serialized)."""
+    key = (root_class, None)
+    b = _getSyncBanana(key)
+    data = b.serializeOne(obj, outstream)
+    _returnSyncBanana(key, b)
+    return data
+
+def unserialize_sync(str_or_instream, root_class=StorageRootUnslicer):
+    """Unserialize a sequence of bytes back into an object graph, and
+    return it directly. The bytes (a string, file-like object, or iterator
+    of strings, as for unserialize) must hold exactly one complete
+    object."""
+    key = (None, root_class)
+    b = _getSyncBanana(key)
+    obj = b.unserializeOne(str_or_instream)
+    _returnSyncBanana(key, b)
+    return obj
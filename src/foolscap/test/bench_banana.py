@@ -36,11 +36,143 @@ class B(object):
             self.banana.dataReceived(o[i:i+CHOMP])
         # print results
 
-import sys
+def _current_rss():
+    # in kB, like ru_maxrss on Linux
+    f = open("/proc/self/statm")
+    resident = int(f.read().split()[1])
+    f.close()
+    return resident * resource.getpagesize() // 1024
+
+def peak_rss_huge_string_decode(N, acceptBuffers=False):
+    """Return how far decoding an N-byte string raises the RSS above where
+    it started (in kB). The decode runs in a forked child, which starts out
+    with a peak RSS equal to its current RSS. With acceptBuffers=True the
+    root unslicer takes the body as a memoryview."""
+    b = B()
+    b.setup_huge_string(N)
+    b.banana.receiveStack[-1].acceptsStringBuffers = acceptBuffers
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        before = _current_rss()
+        b.bench_huge_string_decode(N)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(w, "%d" % max(after - before, 0))
+        os._exit(0)
+    os.close(w)
+    result = int(os.read(r, 100))
+    os.close(r)
+    os.waitpid(pid, 0)
+    return result
+
+def _int2b128_bytewise(integer, stream):
+    # the pre-table header encoder, kept here for comparison
+    if integer == 0:
+        stream(chr(0))
+        return
+    while integer:
+        stream(chr(integer & 0x7f))
+        integer = integer >> 7
+
+def _b1282int_pow(st):
+    i = 0
+    place = 0
+    for char in st:
+        i = i + (ord(char) * (128 ** place))
+        place = place + 1
+    return i
+
+def bench_small_headers(N=200000):
+    """Report tokens/sec for encoding and decoding the small headers that
+    dominate real traffic, with the old per-byte code and the table-driven
+    code."""
+    values = [i % 20000 for i in range(N)]
+    def _report(name, start):
+        elapsed = time.time() - start
+        print "%-28s %10d tokens/sec" % (name, N / elapsed)
+
+    start = time.time()
+    for v in values:
+        pieces = []
+        _int2b128_bytewise(v, pieces.append)
+        "".join(pieces)
+    _report("encode (bytewise)", start)
+
+    start = time.time()
+    int2b128str = banana.int2b128str
+    for v in values:
+        int2b128str(v)
+    _report("encode (table)", start)
+
+    encoded = [banana.int2b128str(v) for v in values]
+    start = time.time()
+    for e in encoded:
+        _b1282int_pow(e)
+    _report("decode (128**place)", start)
+
+    start = time.time()
+    b1282int = banana.b1282int
+    for e in encoded:
+        b1282int(e)
+    _report("decode (table)", start)
+
+    b = storage.StorageBanana()
+    b.transport = TestTransport()
+    b.connectionMade()
+    start = time.time()
+    sendToken = b.sendToken
+    for v in values:
+        sendToken(v)
+    b.flushOutput()
+    _report("Banana.sendToken(int)", start)
+
+def bench_small_records(N=20000):
+    """Report records/sec for serializing and unserializing small records
+    with the Deferred-based functions and with the synchronous ones."""
+    record = {"name": "record", "size": 1234, "tags": ["a", "b"],
+              "mtime": 1.5}
+    def _report(name, start):
+        elapsed = time.time() - start
+        print "%-28s %10d records/sec" % (name, N / elapsed)
+
+    results = []
+    start = time.time()
+    for i in xrange(N):
+        storage.serialize(record).addCallback(results.append)
+    _report("serialize", start)
+    data = results[0]
+
+    start = time.time()
+    for i in xrange(N):
+        storage.unserialize(data).addCallback(results.append)
+    _report("unserialize", start)
+
+    start = time.time()
+    serialize_sync = storage.serialize_sync
+    for i in xrange(N):
+        serialize_sync(record)
+    _report("serialize_sync", start)
+
+    start = time.time()
+    unserialize_sync = storage.unserialize_sync
+    for i in xrange(N):
+        unserialize_sync(data)
+    _report("unserialize_sync", start)
+
+import os, resource, sys, time
 from twisted.internet import reactor
+from foolscap import banana
 from pyutil import benchutil
+bench_small_headers()
+bench_small_records()
 b = B()
 for N in 10**3, 10**4, 10**5, 10**6, 10**7:
     print "%8d" % N,
     sys.stdout.flush()
-    benchutil.rep_bench(b.bench_huge_string_decode, N, b.setup_huge_string)
+    benchutil.rep_bench(b.bench_huge_string_decode, N,
+                        initfunc=b.setup_huge_string, runreps=10)
+for N in 10**6, 10**7, 10**8:
+    print "%9d bytes: peak RSS +%d kB (str), +%d kB (memoryview)" % \
+          (N, peak_rss_huge_string_decode(N),
+           peak_rss_huge_string_decode(N, acceptBuffers=True))
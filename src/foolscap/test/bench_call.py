@@ -0,0 +1,180 @@
+from zope.interface import implements
+from foolscap.api import RemoteInterface, Referenceable
+from foolscap.schema import ListOf, DictOf, TupleOf, ChoiceOf, Optional
+from foolscap.test.common import TargetMixin
+
+class RIDeep(RemoteInterface):
+    def store(records=ListOf(DictOf(str, ListOf(int, maxLength=100)),
+                             maxLength=10000),
+              tag=str):
+        return int
+
+class Deep(Referenceable):
+    implements(RIDeep)
+    def remote_store(self, records, tag):
+        return len(records)
+
+class RIMixed(RemoteInterface):
+    def add(a=int, b=int):
+        return int
+    def put(name=str, size=int, flags=ListOf(bool, maxLength=10),
+            owner=Optional(ChoiceOf(None, str), None)):
+        return TupleOf(int, str)
+
+class Adder(Referenceable):
+    implements(RIMixed)
+    def remote_add(self, a, b):
+        return a + b
+
+def make_records(rows, keys=10, ints=10):
+    return [dict([("key%d" % k, range(ints)) for k in range(keys)])
+            for r in range(rows)]
+
+class Loopback(TargetMixin):
+    """A pair of Brokers connected by loopback transports, as in the unit
+    tests, driven by iterating the reactor by hand."""
+    def __init__(self, target):
+        self.setUp()
+        self.setupBrokers()
+        self.rref, self.target = self.setupTarget(target, True)
+
+    def wait(self, d):
+        results = []
+        d.addBoth(results.append)
+        while not results:
+            reactor.iterate()
+        if isinstance(results[0], failure.Failure):
+            results[0].raiseException()
+        return results[0]
+
+def bench_check_args(N=200):
+    """Report calls/sec for checking the arguments of an inbound call with
+    a deep ListOf(DictOf(str, ListOf(int))) schema: the full checkAllArgs()
+    which _doCall used to repeat, and the checkRequiredArgs() it now uses
+    when the arguments were fully checked as they arrived."""
+    ms = RIDeep["store"]
+    for rows in 10, 100, 1000:
+        args, kwargs = (make_records(rows),), {"tag": "t"}
+        start = time.time()
+        for i in xrange(N):
+            ms.checkAllArgs(args, kwargs, True)
+        full = N / (time.time() - start)
+        start = time.time()
+        for i in xrange(N):
+            ms.checkRequiredArgs(args, kwargs)
+        required = N / (time.time() - start)
+        print "%5d rows: checkAllArgs %9d calls/sec, " \
+              "checkRequiredArgs %9d calls/sec" % (rows, full, required)
+
+def _interpreted_checkAllArgs(ms, args, kwargs, inbound):
+    # RemoteMethodSchema.checkAllArgs as it was before the argument
+    # constraints were compiled
+    allargs = dict(zip(ms.argumentNames, args))
+    allargs.update(kwargs)
+    for argname, argvalue in allargs.items():
+        accept, constraint = ms.getKeywordArgConstraint(argname)
+        constraint.checkObject(argvalue, inbound)
+
+def bench_compiled(N=20000):
+    """Report calls/sec for checking outbound arguments and results with
+    the interpreted constraints (checkObject) and with the compiled ones
+    that RemoteMethodSchema now uses."""
+    records = make_records(10)
+    cases = [("add", RIMixed["add"], (1, 2), {}, 3),
+             ("put", RIMixed["put"], ("name", 1234),
+              {"flags": [True, False], "owner": "me"}, (0, "ok")),
+             ("store(10 rows)", RIDeep["store"], (records,), {"tag": "t"},
+              10),
+             ]
+    for (name, ms, args, kwargs, result) in cases:
+        n = N
+        if name.startswith("store"):
+            n = N // 100
+        start = time.time()
+        for i in xrange(n):
+            _interpreted_checkAllArgs(ms, args, kwargs, False)
+            ms.responseConstraint.checkObject(result, False)
+        interpreted = n / (time.time() - start)
+        start = time.time()
+        for i in xrange(n):
+            ms.checkAllArgs(args, kwargs, False)
+            ms.checkResults(result, False)
+        compiled = n / (time.time() - start)
+        print "%-16s interpreted %9d calls/sec, compiled %9d calls/sec" % \
+              (name, interpreted, compiled)
+
+def bench_deep_calls(N=20):
+    """Report calls/sec for callRemote() over loopback Brokers, with
+    arguments of a deep ListOf(DictOf(str, ListOf(int))) schema."""
+    lb = Loopback(Deep())
+    for rows in 10, 100, 1000:
+        records = make_records(rows)
+        start = time.time()
+        for i in xrange(N):
+            lb.wait(lb.rref.callRemote("store", records, tag="t"))
+        elapsed = time.time() - start
+        print "%5d rows: %8.1f calls/sec" % (rows, N / elapsed)
+
+def bench_small_calls(N=20000):
+    """Report calls/sec for small callRemote("add", 1, 2) calls over
+    loopback Brokers: the cost of issuing them, and the round-trip rate
+    one at a time and with many in flight."""
+    lb = Loopback(Adder())
+    rref = lb.rref
+    lb.wait(rref.callRemote("add", 1, 2)) # warm up
+
+    start = time.time()
+    dl = [rref.callRemote("add", 1, 2) for i in xrange(N)]
+    issued = N / (time.time() - start)
+    lb.wait(defer.DeferredList(dl))
+    print "%-24s %9d calls/sec" % ("callRemote() issue", issued)
+
+    n = N // 10
+    start = time.time()
+    for i in xrange(n):
+        lb.wait(rref.callRemote("add", 1, 2))
+    print "%-24s %9d calls/sec" % ("one at a time", n / (time.time() - start))
+
+    start = time.time()
+    for i in xrange(0, N, 100):
+        lb.wait(defer.DeferredList([rref.callRemote("add", i, j)
+                                    for j in xrange(100)]))
+    print "%-24s %9d calls/sec" % ("100 in flight", N / (time.time() - start))
+
+def bench_tub_loopback(N=2000):
+    """Report calls/sec for callRemote() to references on our own Tub,
+    whose loopback Brokers pass tokens, and with them forced to encode and
+    parse bytes as a TCP connection would."""
+    from foolscap.api import Tub
+    from foolscap import broker
+    tub = Tub()
+    tub.startService()
+    tub.setLocation("127.0.0.1:0")
+    adder = tub.registerReference(Adder())
+    deep = tub.registerReference(Deep())
+    records = make_records(10)
+    wait = Loopback.wait.im_func
+    for passTokens in True, False:
+        broker.LoopbackTransport.passTokens = passTokens
+        tub.brokers.clear()
+        mode = passTokens and "tokens" or "bytes"
+        for (label, url, method, n, args) in [
+            ("add", adder, "add", N, (1, 2)),
+            ("store(10 rows)", deep, "store", N // 10, (records, "t"))]:
+            rref = wait(None, tub.getReference(url))
+            start = time.time()
+            for i in xrange(0, n, 100):
+                wait(None, defer.DeferredList([rref.callRemote(method, *args)
+                                               for j in xrange(100)]))
+            print "%-8s %-16s %9d calls/sec" % (mode, label,
+                                               n / (time.time() - start))
+    broker.LoopbackTransport.passTokens = True
+
+import time
+from twisted.internet import reactor, defer
+from twisted.python import failure
+bench_tub_loopback()
+bench_small_calls()
+bench_compiled()
+bench_check_args()
+bench_deep_calls()
@@ -7,15 +7,17 @@ from twisted.internet import defer
 
 from foolscap.tokens import ISlicer, Violation, BananaError
 from foolscap.tokens import BananaFailure, tokenNames, \
-     OPEN, CLOSE, ABORT, INT, LONGINT, NEG, LONGNEG, FLOAT, STRING
+     OPEN, CLOSE, ABORT, INT, LONGINT, NEG, LONGNEG, FLOAT, STRING, \
+     PING, PONG, ERROR
 from foolscap import slicer, schema, storage, banana, vocab
 from foolscap.eventual import fireEventually, flushEventualQueue
 from foolscap.slicers.allslicers import RootSlicer, DictUnslicer, TupleUnslicer
 from foolscap.constraint import IConstraint
 from foolscap.banana import int2b128, long_to_bytes
+from foolscap.slicers.filebody import FileBody
 
 import StringIO
-import struct
+import struct, random
 from decimal import Decimal
 
 #log.startLogging(sys.stderr)
@@ -169,13 +171,16 @@ class UnbananaTestMixin:
         results = []
         d = self.banana.prepare()
         d.addCallback(results.append)
-        self.banana.dataReceived(data)
+        self.feed(data)
         # we expect everything here to be synchronous
         if len(results) == 1:
             return results[0]
         self.failUnless(self.banana.violation or self.banana.disconnectReason)
         return None
 
+    def feed(self, data):
+        self.banana.dataReceived(data)
+
     def shouldFail(self, tokens):
         obj = self.do(tokens)
         self.failUnless(obj is None, "object was produced: %s" % obj)
@@ -248,12 +253,15 @@ class TestBananaMixin:
     def clearOutput(self):
         self.banana.transport = TestTransport()
 
+    def feed(self, stream):
+        self.banana.dataReceived(stream)
+
     def decode(self, stream):
         self.banana.violation = None
         results = []
         d = self.banana.prepare()
         d.addCallback(results.append)
-        self.banana.dataReceived(stream)
+        self.feed(stream)
         # we expect everything here to be synchronous
         if len(results) == 1:
             return results[0]
@@ -330,6 +338,20 @@ class TestBananaMixin:
 def join(*args):
     return "".join(args)
 
+class RandomChunksMixin:
+    # deliver each stream in randomly-sized pieces, so that tokens (and
+    # their headers) are split across dataReceived calls at every possible
+    # point. The seed is fixed so that failures can be reproduced.
+    maxChunkSize = 8
+    def feed(self, stream):
+        # also send every split STRING through the _StringBody path
+        self.banana.largeStringThreshold = 1
+        r = random.Random(len(stream))
+        while stream:
+            size = r.randint(1, self.maxChunkSize)
+            chunk, stream = stream[:size], stream[size:]
+            self.banana.dataReceived(chunk)
+
 
 
 class BrokenDictUnslicer(DictUnslicer):
@@ -1320,6 +1342,320 @@ class ByteStream(TestBananaMixin, unittest.TestCase):
         d.addCallback(self.wantEqual, expected)
         return d
 
+class CountingTransport(TestTransport):
+    def __init__(self):
+        TestTransport.__init__(self)
+        self.writes = []
+    def write(self, data):
+        self.writes.append(data)
+        TestTransport.write(self, data)
+
+class Headers(unittest.TestCase):
+    def setUp(self):
+        self.size = banana.HEADER_TABLE_SIZE
+    def tearDown(self):
+        banana.setHeaderTableSize(self.size)
+
+    def bytewise(self, integer):
+        # the original per-byte encoder, used as a reference
+        if integer == 0:
+            return chr(0)
+        s = ""
+        while integer:
+            s += chr(integer & 0x7f)
+            integer = integer >> 7
+        return s
+
+    def check(self, integer):
+        encoded = banana.int2b128str(integer)
+        self.failUnlessEqual(encoded, self.bytewise(integer))
+        self.failUnlessEqual(banana.b1282int(encoded), integer)
+        pieces = []
+        int2b128(integer, pieces.append)
+        self.failUnlessEqual("".join(pieces), encoded)
+
+    def test_encode(self):
+        size = banana.HEADER_TABLE_SIZE
+        for i in range(0, 300) + [size-1, size, size+1, 2**31, 2**64+3]:
+            self.check(i)
+
+    def test_negative(self):
+        self.failUnlessRaises(AssertionError, banana.int2b128str, -1)
+
+    def test_table_size(self):
+        banana.setHeaderTableSize(4)
+        self.failUnlessEqual(banana.HEADER_TABLE_SIZE, 4)
+        for i in range(10):
+            self.check(i)
+        self.failUnlessEqual(banana.b1282int("\x00\x00\x01"), 2**14)
+
+class AutoVocab(TestBananaMixin, unittest.TestCase):
+    def setUp(self):
+        TestBananaMixin.setUp(self)
+        self.added = []
+        self.banana.useAutoVocabulary = True
+        self.banana.addToOutgoingVocabulary = self.added.append
+
+    def test_threshold(self):
+        b = self.banana
+        for i in range(b.autoVocabThreshold - 1):
+            b.maybeVocabizeString("method_name")
+        self.failUnlessEqual(self.added, [])
+        b.maybeVocabizeString("method_name")
+        self.failUnlessEqual(self.added, ["method_name"])
+        self.failIf("method_name" in b.autoVocabCandidates)
+
+    def test_length_limits(self):
+        b = self.banana
+        for i in range(5):
+            b.maybeVocabizeString("ab")
+            b.maybeVocabizeString("x" * (b.autoVocabMaxLength+1))
+        self.failUnlessEqual(self.added, [])
+        self.failUnlessEqual(b.autoVocabCandidates, {})
+
+    def test_disabled(self):
+        b = self.banana
+        b.useAutoVocabulary = False
+        for i in range(5):
+            b.maybeVocabizeString("method_name")
+        self.failUnlessEqual(self.added, [])
+
+    def test_aging(self):
+        b = self.banana
+        b.autoVocabTrackerSize = 4
+        b.maybeVocabizeString("popular")
+        b.maybeVocabizeString("popular")
+        for s in ["one", "two", "three", "four"]:
+            b.maybeVocabizeString(s)
+        # the tracker filled up, so the singletons were forgotten and the
+        # popular string survived with half its count
+        self.failUnlessEqual(b.autoVocabCandidates, {"popular": 1,
+                                                     "four": 1})
+
+    def test_eviction(self):
+        b = self.banana
+        b.autoVocabMaxEntries = 2
+        for s in ["aaa", "bbb"]:
+            index = b.allocateEntryInOutgoingVocabTable(s)
+            b.outgoingVocabTableWasAmended(index, s)
+        self.failUnlessEqual(b.outgoingVocabulary, {"aaa": 0, "bbb": 1})
+        b.addedVocabUses["aaa"] = 5
+        index = b.allocateEntryInOutgoingVocabTable("ccc")
+        self.failUnlessEqual(index, 1)
+        self.failUnlessEqual(b.outgoingVocabulary, {"aaa": 0})
+        self.failUnlessEqual(b.addedVocabUses, {"aaa": 2})
+
+class OutputBuffer(TestBananaMixin, unittest.TestCase):
+
+    def test_one_write_per_object(self):
+        obj = [1, "two", [3.0, -4, 2**40]]
+        self.banana.transport = CountingTransport()
+        d = self.banana.send(obj)
+        def _check(res):
+            t = self.banana.transport
+            self.failUnlessEqual(len(t.writes), 1)
+            stats = self.banana.getOutputStats()
+            self.failUnlessEqual(stats["flushes"], 1)
+            self.failUnlessEqual(stats["bytes"], len(t.getvalue()))
+            self.failUnlessEqual(stats["bytes-per-flush"],
+                                 float(len(t.getvalue())))
+            self.failUnlessEqual(self.banana.outputBuffer, [])
+            self.makeBanana()
+            self.failUnlessEqual(self.shouldDecode(t.getvalue()), obj)
+        d.addCallback(_check)
+        return d
+
+    def test_threshold(self):
+        obj = ["a"*20, "b"*20, "c"*20]
+        expected = join(bOPEN("list", 0),
+                         bSTR("a"*20), bSTR("b"*20), bSTR("c"*20),
+                        bCLOSE(0))
+        self.banana.transport = CountingTransport()
+        self.banana.outputFlushThreshold = 10
+        d = self.banana.send(obj)
+        def _check(res):
+            t = self.banana.transport
+            self.failUnless(len(t.writes) > 1, t.writes)
+            self.failUnlessEqual(self.banana.outputLargestFlush,
+                                 max([len(w) for w in t.writes]))
+            self.wantEqual(t.getvalue(), expected)
+        d.addCallback(_check)
+        return d
+
+    def test_ping(self):
+        # PING and PONG are sent from outside produce(), so they must not
+        # linger in the buffer
+        self.banana.transport = CountingTransport()
+        self.banana.sendPING(5)
+        self.banana.sendPONG(5)
+        t = self.banana.transport
+        self.failUnlessEqual(t.writes, ["\x05\x8e", "\x05\x8f"])
+
+class ProducerTransport(CountingTransport):
+    # a transport which pauses its producer after pauseAfter writes
+    producer = None
+    pauseAfter = None
+    def __init__(self):
+        CountingTransport.__init__(self)
+        self.registrations = 0
+    def registerProducer(self, producer, streaming):
+        assert self.producer is None
+        assert streaming
+        self.producer = producer
+        self.registrations += 1
+    def unregisterProducer(self):
+        assert self.producer is not None
+        self.producer = None
+    def write(self, data):
+        CountingTransport.write(self, data)
+        if self.pauseAfter is not None and len(self.writes) >= self.pauseAfter:
+            self.pauseAfter = None
+            self.producer.pauseProducing()
+
+class FlowControl(TestBananaMixin, unittest.TestCase):
+    def setUp(self):
+        TestBananaMixin.setUp(self)
+        self.banana.transport = ProducerTransport()
+        self.banana.outputFlushThreshold = 100
+        self.obj = ["%02d" % i + "x"*48 for i in range(40)]
+
+    def test_small(self):
+        # small objects register while they are written, and unregister
+        # once we are idle, so the transport can still close
+        d = self.banana.send(["a", "b"])
+        def _check(res):
+            t = self.banana.transport
+            self.failUnlessEqual(t.registrations, 1)
+            self.failUnlessEqual(t.producer, None)
+            self.failIf(self.banana.registeredAsProducer)
+        d.addCallback(_check)
+        return d
+
+    def test_register_lost(self):
+        # a TLS transport that has lost its connection stops the producer
+        # instead of registering it
+        t = self.banana.transport
+        t.registerProducer = lambda producer, streaming: \
+                             producer.stopProducing()
+        d = self.banana.send(["a", "b"])
+        def _check(res):
+            self.failIf(self.banana.registeredAsProducer)
+            self.failUnlessEqual(t.producer, None)
+        d.addCallback(_check)
+        return d
+
+    def test_many_small(self):
+        # a stream of small objects to a slow peer is held back too
+        self.banana.sendHighWater = 500
+        self.banana.sendLowWater = 200
+        t = self.banana.transport
+        t.pauseAfter = 1
+        objs = ["%03d" % i + "x"*20 for i in range(100)]
+        dl = [self.banana.send(obj) for obj in objs]
+        self.failUnlessEqual(len(t.writes), 1)
+        self.failUnless(self.banana.paused)
+        self.failUnless(self.banana.pendingBytes < 600)
+        t.pauseAfter = None
+        self.banana.resumeProducing()
+        d = defer.gatherResults(dl)
+        def _check(res):
+            self.failUnlessEqual(t.producer, None)
+            # the same bytes as without flow control
+            self.makeBanana()
+            return defer.gatherResults([self.banana.send(obj)
+                                        for obj in objs])
+        d.addCallback(_check)
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(t.getvalue(),
+                                           self.banana.transport.getvalue()))
+        return d
+
+    def test_error_while_paused(self):
+        # held output, including the ERROR itself, is written out before
+        # the connection is closed
+        t = self.banana.transport
+        t.pauseAfter = 1
+        self.banana.send(self.obj)
+        self.failUnless(self.banana.pendingWrites)
+        banana.Banana.sendError(self.banana, "oops")
+        self.failUnlessEqual(t.producer, None)
+        self.failUnlessEqual(self.banana.pendingBytes, 0)
+        self.failUnless(t.getvalue().endswith(banana.int2b128str(4) + ERROR
+                                              + "oops"))
+
+    def test_register(self):
+        d = self.banana.send(self.obj)
+        def _check(res):
+            t = self.banana.transport
+            # registered while the list was being sent, then unregistered
+            self.failUnlessEqual(t.registrations, 1)
+            self.failUnlessEqual(t.producer, None)
+            self.failIf(self.banana.registeredAsProducer)
+        d.addCallback(_check)
+        return d
+
+    def test_pause(self):
+        self.banana.sendHighWater = 500
+        self.banana.sendLowWater = 200
+        t = self.banana.transport
+        t.pauseAfter = 1
+        d = self.banana.send(self.obj)
+        sent = []
+        d.addCallback(sent.append)
+        # the transport paused us after the first write. We kept producing
+        # until sendHighWater bytes were held, then stopped.
+        self.failIf(sent)
+        self.failUnlessEqual(len(t.writes), 1)
+        self.failUnless(self.banana.paused)
+        self.failUnless(self.banana.pendingBytes >= 500)
+        self.failUnless(self.banana.pendingBytes < 700)
+        stats = self.banana.getOutputStats()
+        self.failUnlessEqual(stats["transport-pauses"], 1)
+        self.failUnlessEqual(stats["send-pauses"], 1)
+        self.failUnlessEqual(stats["pending-bytes"],
+                             self.banana.pendingBytes)
+
+        # resuming writes everything that was held, then finishes the list
+        t.pauseAfter = None
+        self.banana.resumeProducing()
+        self.failUnlessEqual(self.banana.pendingBytes, 0)
+        self.failIf(self.banana.paused)
+        self.failUnlessEqual(t.producer, None)
+        def _check(res):
+            self.failUnlessEqual(self.banana.getOutputStats()["send-pauses"],
+                                 1)
+            self.makeBanana()
+            self.failUnlessEqual(self.shouldDecode(t.getvalue()), self.obj)
+        d.addCallback(_check)
+        return d
+
+    def test_low_water(self):
+        self.banana.sendHighWater = 500
+        self.banana.sendLowWater = 200
+        t = self.banana.transport
+        t.pauseAfter = 1
+        self.banana.send(self.obj)
+        held = self.banana.pendingBytes
+        # the transport accepts a couple of writes, then pauses again. We
+        # stay paused until it has taken all but sendLowWater bytes.
+        t.pauseAfter = 3
+        self.banana.resumeProducing()
+        self.failUnless(self.banana.pendingBytes < held)
+        self.failUnless(self.banana.pendingBytes > 200)
+        self.failUnless(self.banana.paused)
+        self.failUnlessEqual(self.banana.getOutputStats()["transport-pauses"],
+                             2)
+        self.banana.resumeProducing()
+        self.failIf(self.banana.paused)
+
+    def test_lose_connection(self):
+        # a transport won't close while a producer is registered
+        self.banana.transport.pauseAfter = 1
+        self.banana.send(self.obj)
+        self.failUnless(self.banana.transport.producer)
+        self.banana.handleError("bye")
+        self.failUnlessEqual(self.banana.transport.producer, None)
+
 class InboundByteStream(TestBananaMixin, unittest.TestCase):
 
     def check(self, obj, stream):
@@ -1438,6 +1774,14 @@ class InboundByteStream2(TestBananaMixin, unittest.TestCase):
                       "<RootUnslicer>",
                       schema.StringConstraint(10))
 
+    def testConstrainedVocabString(self):
+        # a VOCAB token must meet the size limit of the string it expands to
+        self.banana.incomingVocabulary = {1: "a"*10, 2: "a"*11}
+        self.conform2("\x01\x87", "a"*10, schema.StringConstraint(10))
+        self.banana.incomingVocabulary = {1: "a"*10, 2: "a"*11}
+        self.violate2("\x02\x87", "<RootUnslicer>",
+                      schema.StringConstraint(10))
+
     def NOTtestFoo(self):
         if 0:
             a100 = chr(100) + "\x82" + "a"*100
@@ -1997,6 +2341,260 @@ class Sliceable(unittest.TestCase):
 
 
 
+class DecodeTestChunked(RandomChunksMixin, DecodeTest):
+    pass
+
+class DecodeFailureTestChunked(RandomChunksMixin, DecodeFailureTest):
+    pass
+
+class InboundByteStreamChunked(RandomChunksMixin, InboundByteStream):
+    pass
+
+class InboundByteStream2Chunked(RandomChunksMixin, InboundByteStream2):
+    pass
+
+class ThereAndBackAgainChunked(RandomChunksMixin, ThereAndBackAgain):
+    pass
+
+class ReceiveBuffer(TestBananaMixin, unittest.TestCase):
+    def testCompact(self):
+        self.banana.bufferCompactThreshold = 100
+        strings = ["a%d" % i + "a"*50 for i in range(5)]
+        stream = join(bOPEN("list", 0),
+                      *([bSTR(s) for s in strings] + [bCLOSE(0)]))
+        results = []
+        self.banana.prepare().addCallback(results.append)
+        # stop in the middle of the fourth string
+        split = (len(stream) - len(bCLOSE(0)) - len(bSTR(strings[4]))
+                 - 20)
+        self.banana.dataReceived(stream[:split])
+        self.failIf(results)
+        # the consumed tokens were discarded, leaving only the partial one
+        self.failUnlessEqual(self.banana.bufferOffset, 0)
+        self.failUnlessEqual(str(self.banana.buffer),
+                             bSTR(strings[3])[:-20])
+        self.banana.dataReceived(stream[split:])
+        self.failUnlessEqual(results, [strings])
+        self.failUnlessEqual(self.banana.bufferOffset, 0)
+        self.failUnlessEqual(len(self.banana.buffer), 0)
+
+    def testSplitHeader(self):
+        s = "a" * 1000 # two-byte header
+        stream = banana.int2b128str(len(s)) + STRING + s
+        results = []
+        self.banana.prepare().addCallback(results.append)
+        self.banana.dataReceived(stream[:1])
+        self.failIf(results)
+        self.failUnlessEqual(str(self.banana.buffer), stream[:1])
+        self.banana.dataReceived(stream[1:])
+        self.failUnlessEqual(results, [s])
+
+    def testLargeString(self):
+        self.banana.largeStringThreshold = 1000
+        s = "".join([chr(i % 256) for i in range(5000)])
+        stream = join(bOPEN("list", 0), bINT(1),
+                      banana.int2b128str(len(s)), STRING, s,
+                      bINT(2), bCLOSE(0))
+        results = []
+        self.banana.prepare().addCallback(results.append)
+        for i in range(0, len(stream), 700):
+            self.banana.dataReceived(stream[i:i+700])
+            if self.banana.stringSink is not None:
+                # the body is not copied into the receive buffer
+                self.failIf(len(self.banana.buffer) > 700)
+        self.failUnlessEqual(results, [[1, s, 2]])
+        self.failUnlessEqual(type(results[0][1]), str)
+        self.failUnlessEqual(self.banana.stringSink, None)
+
+    def testLargeStringBuffer(self):
+        self.banana.largeStringThreshold = 1000
+        self.banana.receiveStack[-1].acceptsStringBuffers = True
+        s = "a" * 5000
+        stream = banana.int2b128str(len(s)) + STRING + s
+        results = []
+        self.banana.prepare().addCallback(results.append)
+        self.banana.dataReceived(stream[:100])
+        self.banana.dataReceived(stream[100:])
+        self.failUnlessEqual(len(results), 1)
+        self.failUnless(isinstance(results[0], memoryview))
+        self.failUnlessEqual(results[0].tobytes(), s)
+
+    def testLargeStringSizeUntrusted(self):
+        # nothing is allocated for the body until it arrives, so a header
+        # that claims a huge size costs only what is actually sent
+        self.banana.largeStringThreshold = 1000
+        stream = banana.int2b128str(2**30) + STRING + "a" * 5000
+        for acceptBuffers in (False, True):
+            self.banana.receiveStack[-1].acceptsStringBuffers = acceptBuffers
+            self.banana.prepare()
+            self.banana.dataReceived(stream[:100])
+            self.banana.dataReceived(stream[100:])
+            sink = self.banana.stringSink
+            if acceptBuffers:
+                self.failUnlessEqual(len(sink.body), 5000)
+            else:
+                self.failUnlessEqual(sum(map(len, sink.pieces)), 5000)
+            self.banana.stringSink = None
+
+    def testLargeUnicode(self):
+        # UnicodeUnslicer decodes a large body without turning it into a
+        # str first
+        self.banana.largeStringThreshold = 1000
+        u = u"\u263a" * 2000
+        body = u.encode("UTF-8")
+        stream = join(bOPEN("unicode", 0), banana.int2b128str(len(body)),
+                      STRING, body, bCLOSE(0))
+        results = []
+        self.banana.prepare().addCallback(results.append)
+        for i in range(0, len(stream), 700):
+            self.banana.dataReceived(stream[i:i+700])
+        self.failUnlessEqual(results, [u])
+        self.failUnlessEqual(type(results[0]), unicode)
+
+    def testStringSink(self):
+        pieces = []
+        class Sink:
+            def write(self, data):
+                pieces.append(data)
+            def finish(self):
+                return "sunk"
+        sizes = []
+        def getStringSink(size):
+            sizes.append(size)
+            return Sink()
+        self.banana.receiveStack[-1].getStringSink = getStringSink
+        s = "a" * 300
+        stream = banana.int2b128str(len(s)) + STRING + s
+        results = []
+        self.banana.prepare().addCallback(results.append)
+        for i in range(0, len(stream), 100):
+            self.banana.dataReceived(stream[i:i+100])
+        self.failUnlessEqual(sizes, [300])
+        self.failUnlessEqual("".join(pieces), s)
+        self.failUnlessEqual(len(pieces), 4)
+        self.failUnlessEqual(results, ["sunk"])
+        self.failUnlessEqual(self.banana.stringSink, None)
+
+    def testLargeStringComplete(self):
+        # a body which is already complete is sliced out of the buffer
+        self.banana.largeStringThreshold = 1000
+        s = "a" * 5000
+        obj = self.shouldDecode(banana.int2b128str(len(s)) + STRING + s)
+        self.failUnlessEqual(obj, s)
+        self.failUnlessEqual(self.banana.stringSink, None)
+
+
+class CountingReader(StringIO.StringIO):
+    def __init__(self, data, onRead=None):
+        StringIO.StringIO.__init__(self, data)
+        self.reads = 0
+        self.onRead = onRead
+    def read(self, size=-1):
+        self.reads += 1
+        if self.onRead:
+            self.onRead(self.reads)
+        return StringIO.StringIO.read(self, size)
+
+class FileBodyTest(TestBananaMixin, unittest.TestCase):
+    data = "".join([chr(i % 256) for i in range(1000)])
+
+    def testFile(self):
+        f = CountingReader(self.data)
+        d = self.encode(FileBody(f, chunkSize=100))
+        def _check(stream):
+            self.wantEqual(stream,
+                           banana.int2b128str(1000) + STRING + self.data)
+            self.failUnlessEqual(f.reads, 10)
+            self.failUnlessEqual(self.shouldDecode(stream), self.data)
+        d.addCallback(_check)
+        return d
+
+    def testRemainder(self):
+        # only the part after the current position is sent
+        f = StringIO.StringIO(self.data)
+        f.seek(900)
+        d = self.encode(FileBody(f))
+        d.addCallback(self.shouldDecode)
+        d.addCallback(self.failUnlessEqual, self.data[900:])
+        return d
+
+    def testIterator(self):
+        chunks = [self.data[i:i+300] for i in range(0, 1000, 300)]
+        d = self.encode([1, FileBody(iter(chunks), size=1000), 2])
+        d.addCallback(self.shouldDecode)
+        d.addCallback(self.failUnlessEqual, [1, self.data, 2])
+        return d
+
+    def testPaused(self):
+        def _onRead(reads):
+            if reads == 2:
+                self.banana.paused = True
+        f = CountingReader(self.data, _onRead)
+        d = self.encode(FileBody(f, chunkSize=100))
+        # nothing more is read while the transport is paused
+        self.failUnlessEqual(f.reads, 2)
+        self.failUnlessEqual(len(self.banana.transport.getvalue()),
+                             len(banana.int2b128str(1000)) + 1 + 200)
+        self.banana.paused = False
+        self.banana.produce()
+        def _check(stream):
+            self.failUnlessEqual(f.reads, 10)
+            self.failUnlessEqual(self.shouldDecode(stream), self.data)
+        d.addCallback(_check)
+        return d
+
+    def testPausedControl(self):
+        # PING, PONG, and ERROR tokens cannot go into the middle of a STRING
+        # body, so they wait until it is complete
+        def _onRead(reads):
+            if reads == 2:
+                self.banana.paused = True
+        f = CountingReader(self.data, _onRead)
+        d = self.encode(FileBody(f, chunkSize=100))
+        lost = []
+        self.banana.transport.loseConnection = lambda: lost.append(True)
+        # StorageBanana does not send errors, but a real connection does
+        b = self.banana
+        b.sendError = lambda msg: banana.Banana.sendError(b, msg)
+        self.banana.dataReceived(banana.int2b128str(7) + PING)
+        self.banana.sendPING()
+        self.banana.sendError("oops")
+        header = banana.int2b128str(1000) + STRING
+        self.failUnlessEqual(self.banana.transport.getvalue(),
+                             header + self.data[:200])
+        self.failIf(lost)
+        self.banana.paused = False
+        self.banana.produce()
+        def _check(stream):
+            self.failUnlessEqual(stream,
+                                 header + self.data
+                                 + banana.int2b128str(7) + PONG + PING
+                                 + banana.int2b128str(4) + ERROR + "oops")
+            self.failUnlessEqual(lost, [True])
+        d.addCallback(_check)
+        return d
+
+    def testShort(self):
+        # the STRING can't be abandoned halfway, so the connection is dropped
+        body = FileBody(iter(["abc"]), size=10)
+        d = self.encode(body)
+        def _fail(f):
+            self.failUnless(f.check(BananaError))
+            self.failUnless("ended 7 bytes early" in str(f), f)
+            self.flushLoggedErrors(BananaError)
+        d.addCallbacks(lambda res: self.fail("should have failed"), _fail)
+        return d
+
+    def testConstraint(self):
+        c = schema.ByteStringConstraint(100)
+        c.checkObject(FileBody(iter([]), size=100), False)
+        self.failUnlessRaises(Violation, c.checkObject,
+                              FileBody(iter([]), size=101), False)
+        # inbound, it must have become a real string
+        self.failUnlessRaises(Violation, c.checkObject,
+                              FileBody(iter([]), size=100), True)
+
+
 # TODO: vocab test:
 #  send a bunch of strings
 #  send an object that stalls
@@ -2,6 +2,9 @@
 import gc
 import re
 import sys
+from StringIO import StringIO
+from hashlib import sha1
+from zope.interface import implements
 
 if False:
     from twisted.python import log
@@ -12,14 +15,23 @@ from twisted.trial import unittest
 from twisted.internet.main import CONNECTION_LOST, CONNECTION_DONE
 from twisted.python.failure import Failure
 from twisted.application import service
-
-from foolscap.tokens import Violation
-from foolscap.eventual import flushEventualQueue
-from foolscap.test.common import HelperTarget, TargetMixin, ShouldFailMixin
+from twisted.internet import defer
+
+from foolscap.tokens import Violation, INT, NEG
+from foolscap.banana import int2b128str
+from foolscap import broker, call
+from foolscap.eventual import flushEventualQueue, fireEventually
+from foolscap.referenceable import TubRef
+from foolscap.test.common import HelperTarget, TargetMixin, ShouldFailMixin, \
+     PollMixin
 from foolscap.test.common import RIMyTarget, Target, TargetWithoutInterfaces, \
      BrokenTarget, MakeTubsMixin
-from foolscap.api import RemoteException, DeadReferenceError
-from foolscap.call import CopiedFailure
+from foolscap.api import RemoteException, DeadReferenceError, Tub, \
+     CallTimeoutError, RemoteInterface, Referenceable, StreamedBytes, \
+     FileBody
+from foolscap.call import CopiedFailure, InboundDelivery
+from foolscap.remoteinterface import RemoteMethodSchema
+from foolscap.schema import ListOf, DictOf, TupleOf, StringConstraint
 from foolscap.logging import log as flog
 
 class Unsendable:
@@ -391,6 +403,219 @@ class TestCall(TargetMixin, ShouldFailMixin, unittest.TestCase):
         return d
     testStallOrdering.timeout = 5
 
+    def test_timeout(self):
+        rr, target = self.setupTarget(HelperTarget())
+        d = self.shouldFail(CallTimeoutError, "test_timeout",
+                            "no answer after 0.1 seconds",
+                            rr.callRemote, "hang", _timeout=0.1)
+        def _check((f,)):
+            self.failUnlessIn("(during method=None:hang)", str(f.value))
+            self.failUnlessEqual(self.callingBroker.waitingForAnswers, {})
+            # the answer arrives too late, and is dropped without fuss
+            target.d.callback("late")
+            return rr.callRemote("echo", 1)
+        d.addCallback(_check)
+        d.addCallback(self.failUnlessEqual, 1)
+        def _late(ign):
+            self.failUnlessEqual(self.callingBroker.abandonedRequests, set())
+            self.failIf(self.callingBroker.disconnected)
+        d.addCallback(_late)
+        return d
+    test_timeout.timeout = 5
+
+    def test_timeout_default(self):
+        rr, target = self.setupTarget(HelperTarget())
+        self.callingBroker.callTimeout = 0.1
+        d = self.shouldFail(CallTimeoutError, "test_timeout_default", None,
+                            rr.callRemote, "hang")
+        d.addCallback(lambda ign: target.d.callback("late"))
+        calls = []
+        def _call(ign):
+            calls.append(rr.callRemote("hang", _timeout=None))
+        d.addCallback(_call)
+        d.addCallback(self.stall, 0.2)
+        def _check(ign):
+            # the call without a timeout is still waiting
+            self.failIf(calls[0].called)
+            # and so that the decref sent when rr goes away does not leave
+            # a timer behind
+            self.callingBroker.callTimeout = None
+            target.d.callback(2)
+            return calls[0]
+        d.addCallback(_check)
+        d.addCallback(self.failUnlessEqual, 2)
+        return d
+    test_timeout_default.timeout = 5
+
+    def test_timeout_answered(self):
+        rr, target = self.setupTarget(HelperTarget())
+        d = rr.callRemote("echo", 3, _timeout=0.1)
+        d.addCallback(self.failUnlessEqual, 3)
+        d.addCallback(self.stall, 0.2)
+        def _check(ign):
+            broker = self.callingBroker
+            self.failUnlessEqual(broker.requestDeadlines, [])
+            self.failUnlessEqual(broker.requestTimer, None)
+            self.failUnlessEqual(broker.abandonedRequests, set())
+        d.addCallback(_check)
+        return d
+    test_timeout_answered.timeout = 5
+
+    def giveUpWhileAnswering(self, giveUp):
+        # call giveUp(req) just after the answer to req has started to
+        # arrive, but before it is complete
+        broker = self.callingBroker
+        getRequest = broker.getRequest
+        self.abandoned = []
+        def _getRequest(reqID):
+            req = getRequest(reqID)
+            if not self.abandoned:
+                self.abandoned.append(req)
+                giveUp(req)
+            return req
+        broker.getRequest = _getRequest
+
+    def checkAnswerDiscarded(self, ign):
+        broker = self.callingBroker
+        reqID = self.abandoned[0].reqID
+        self.failIf(reqID in broker.waitingForAnswers)
+        self.failIf(reqID in broker.abandonedRequests)
+        self.failIf(broker.disconnected)
+
+    def test_cancel_while_answering(self):
+        rr, target = self.setupTarget(HelperTarget())
+        calls = []
+        self.giveUpWhileAnswering(lambda req: calls[0].cancel())
+        calls.append(rr.callRemote("echo", "a" * 300000))
+        d = self.shouldFail(defer.CancelledError,
+                            "test_cancel_while_answering", None,
+                            lambda: calls[0])
+        d.addCallback(lambda ign: self.poll(lambda: target.obj))
+        d.addCallback(fireEventually)
+        d.addCallback(self.checkAnswerDiscarded)
+        return d
+    test_cancel_while_answering.timeout = 5
+
+    def test_timeout_while_answering(self):
+        rr, target = self.setupTarget(HelperTarget())
+        self.giveUpWhileAnswering(self.callingBroker.timeoutRequest)
+        d = self.shouldFail(CallTimeoutError, "test_timeout_while_answering",
+                            None, rr.callRemote, "echo", "a" * 300000,
+                            _timeout=60)
+        d.addCallback(fireEventually)
+        d.addCallback(self.checkAnswerDiscarded)
+        return d
+    test_timeout_while_answering.timeout = 5
+
+    def test_timeout_while_failing(self):
+        # the same, for an error that arrives while we give up
+        rr, target = self.setupTarget(Target())
+        self.giveUpWhileAnswering(self.callingBroker.timeoutRequest)
+        d = self.shouldFail(CallTimeoutError, "test_timeout_while_failing",
+                            None, rr.callRemote, "fail", _timeout=60)
+        d.addCallback(fireEventually)
+        d.addCallback(self.checkAnswerDiscarded)
+        return d
+    test_timeout_while_failing.timeout = 5
+
+    def test_timeout_answered_many(self):
+        rr, target = self.setupTarget(HelperTarget())
+        dl = [rr.callRemote("echo", i, _timeout=60) for i in range(40)]
+        self.failUnlessEqual(len(self.callingBroker.requestDeadlines), 40)
+        d = defer.gatherResults(dl)
+        d.addCallback(self.failUnlessEqual, range(40))
+        def _check(ign):
+            # the deadlines of answered requests do not pile up
+            broker = self.callingBroker
+            self.failUnlessEqual(broker.requestDeadlines, [])
+            self.failUnlessEqual(broker.requestTimer, None)
+        d.addCallback(_check)
+        return d
+
+    def test_abandoned_limit(self):
+        broker = self.callingBroker
+        broker.maxAbandonedRequests = 4
+        for reqID in range(1, 6):
+            broker.abandonRequest(reqID)
+        # the oldest half were forgotten
+        self.failUnlessEqual(broker.abandonedRequests, set([3, 4, 5]))
+        self.failUnless(isinstance(broker.getRequest(5),
+                                   call.DiscardedRequest))
+        self.failUnlessRaises(Violation, broker.getRequest, 1)
+        self.failUnlessEqual(broker.abandonedRequests, set([3, 4]))
+
+    def test_cancel(self):
+        self.callingBroker.useCallCancel = True
+        rr, target = self.setupTarget(HelperTarget())
+        d1 = rr.callRemote("hang")
+        d = self.poll(lambda: target.d is not None)
+        def _cancel(ign):
+            d1.cancel()
+            return self.shouldFail(defer.CancelledError, "test_cancel", None,
+                                   lambda: d1)
+        d.addCallback(_cancel)
+        # the remote_hang Deferred is cancelled too, and its CancelledError
+        # comes back and is dropped
+        d.addCallback(lambda ign:
+                      self.poll(lambda: not self.callingBroker.abandonedRequests))
+        def _check(ign):
+            self.failUnless(target.d.called)
+            self.failUnlessEqual(self.targetBroker.activeLocalCalls, {})
+            self.failUnlessEqual(self.targetBroker.runningLocalCalls, {})
+            self.failIf(self.callingBroker.waitingForAnswers)
+            return rr.callRemote("echo", 1)
+        d.addCallback(_check)
+        d.addCallback(self.failUnlessEqual, 1)
+        return d
+    test_cancel.timeout = 5
+
+    def test_cancel_queued(self):
+        # a call that was cancelled before it started is never started
+        self.callingBroker.useCallCancel = True
+        self.targetBroker.maxInboundCalls = 1
+        rr, target = self.setupTarget(HelperTarget())
+        d0 = rr.callRemote("hang")
+        d1 = rr.callRemote("echo", 2)
+        d = self.poll(lambda: self.targetBroker.inboundDeliveryQueue)
+        def _cancel(ign):
+            d1.cancel()
+            return self.shouldFail(defer.CancelledError, "test_cancel_queued",
+                                   None, lambda: d1)
+        d.addCallback(_cancel)
+        d.addCallback(lambda ign:
+                      self.poll(lambda: self.targetBroker.cancelledLocalCalls))
+        def _finish(ign):
+            target.d.callback(3)
+            return d0
+        d.addCallback(_finish)
+        d.addCallback(self.failUnlessEqual, 3)
+        d.addCallback(lambda ign:
+                      self.poll(lambda: not self.callingBroker.abandonedRequests))
+        def _check(ign):
+            self.failIf(hasattr(target, "obj"))
+            self.failUnlessEqual(self.targetBroker.activeLocalCalls, {})
+            self.failUnlessEqual(self.targetBroker.cancelledLocalCalls, set())
+        d.addCallback(_check)
+        return d
+    test_cancel_queued.timeout = 5
+
+    def test_cancel_local(self):
+        # without the call-cancel feature, the far end is not told, and its
+        # eventual answer is discarded
+        rr, target = self.setupTarget(HelperTarget())
+        d1 = rr.callRemote("hang")
+        d1.cancel()
+        d = self.shouldFail(defer.CancelledError, "test_cancel_local", None,
+                            lambda: d1)
+        d.addCallback(lambda ign: self.poll(lambda: target.d is not None))
+        d.addCallback(lambda ign: target.d.callback(4))
+        d.addCallback(lambda ign:
+                      self.poll(lambda: not self.callingBroker.abandonedRequests))
+        d.addCallback(lambda ign: rr.callRemote("echo", 5))
+        d.addCallback(self.failUnlessEqual, 5)
+        return d
+    test_cancel_local.timeout = 5
+
     def testDisconnect_during_call(self):
         rr, target = self.setupTarget(HelperTarget())
         d = rr.callRemote("hang")
@@ -520,6 +745,34 @@ class TestCall(TargetMixin, ShouldFailMixin, unittest.TestCase):
         d.addCallback(_check)
         return d
 
+    def test_call_plan(self):
+        # the first call of each method leaves a CallPlan on the tracker,
+        # which later calls reuse
+        rr, target = self.setupTarget(Target(), True)
+        plans = rr.tracker.callPlans
+        d = rr.callRemote("add", a=1, b=2)
+        def _first(res):
+            self.failUnlessEqual(res, 3)
+            plan = plans["add"]
+            self.failUnlessIdentical(plan.methodSchema, RIMyTarget["add"])
+            d2 = rr.callRemote("add", 3, 4)
+            d2.addCallback(self.failUnlessEqual, 7)
+            d2.addCallback(lambda res:
+                           self.failUnlessIdentical(plans["add"], plan))
+            return d2
+        d.addCallback(_first)
+        # methods which the RemoteInterface does not offer are not kept
+        d.addCallback(lambda res:
+                      self.shouldFail(Violation, "test_call_plan",
+                                      "does not offer bogus",
+                                      rr.callRemote, "bogus"))
+        d.addCallback(lambda res: self.failIf("bogus" in plans))
+        # arguments are still checked on every call
+        d.addCallback(lambda res:
+                      self.shouldFail(Violation, "test_call_plan",
+                                      "RIMyTarget.add(b=)",
+                                      rr.callRemote, "add", 1, "two"))
+        return d
 
 class TestCallOnly(TargetMixin, unittest.TestCase):
     def setUp(self):
@@ -541,6 +794,639 @@ class TestCallOnly(TargetMixin, unittest.TestCase):
         return d
     testCallOnly.timeout = 2
 
+class FakeArguments:
+    def __init__(self, *args):
+        self.args = list(args)
+        self.kwargs = {}
+
+class InboundQueueMixin:
+    def setUp(self):
+        self.broker = broker.Broker(TubRef("inbound"))
+        self.broker.inboundCallsPerTurn = 3
+        self.calls = []
+
+    def schedule(self, value, ready_deferred=None):
+        delivery = InboundDelivery(self.broker, 0, self.calls.append,
+                                   None, None, None, FakeArguments(value))
+        self.broker.scheduleCall(delivery, ready_deferred)
+
+    def _check(self, ign, expected):
+        self.failUnlessEqual(self.calls, expected)
+        return fireEventually()
+
+class InboundQueue(InboundQueueMixin, unittest.TestCase):
+    def test_budget(self):
+        for i in range(8):
+            self.schedule(i)
+        self.failUnlessEqual(self.calls, [])
+        d = fireEventually()
+        d.addCallback(self._check, [0, 1, 2])
+        d.addCallback(self._check, [0, 1, 2, 3, 4, 5])
+        d.addCallback(self._check, range(8))
+        return d
+
+    def test_ready(self):
+        # calls behind an unready one must wait for it, already-fired
+        # ready_deferreds are started without waiting
+        ready = defer.Deferred()
+        self.schedule(0, defer.succeed(None))
+        self.schedule(1, ready)
+        self.schedule(2)
+        d = fireEventually()
+        d.addCallback(self._check, [0])
+        def _fire(ign):
+            ready.callback(None)
+            self.failUnlessEqual(self.calls, [0, 1])
+            return fireEventually()
+        d.addCallback(_fire)
+        d.addCallback(self._check, [0, 1, 2])
+        return d
+
+    def test_one_turn_per_burst(self):
+        turns = []
+        doNextCall = self.broker.doNextCall
+        def _doNextCall():
+            turns.append(len(self.calls))
+            doNextCall()
+        self.broker.doNextCall = _doNextCall
+        self.broker.inboundCallsPerTurn = 100
+        for i in range(50):
+            self.schedule(i)
+        d = flushEventualQueue()
+        def _check(ign):
+            self.failUnlessEqual(self.calls, range(50))
+            self.failUnlessEqual(turns, [0])
+        d.addCallback(_check)
+        return d
+
+class InboundLimit(InboundQueueMixin, unittest.TestCase):
+    def setUp(self):
+        InboundQueueMixin.setUp(self)
+        self.broker.maxInboundCalls = 2
+        self.hanging = []
+
+    def hang(self, value):
+        self.calls.append(value)
+        d = defer.Deferred()
+        self.hanging.append(d)
+        return d
+
+    def schedule(self, value, ready_deferred=None):
+        delivery = InboundDelivery(self.broker, 0, self.hang,
+                                   None, None, None, FakeArguments(value))
+        self.broker.scheduleCall(delivery, ready_deferred)
+
+    def _stats(self, ign, queued, inflight):
+        self.failUnlessEqual(self.broker.getInboundQueueStats(),
+                             {"queued": queued, "in-flight": inflight,
+                              "max-in-flight": 2})
+
+    def test_limit(self):
+        for i in range(4):
+            self.schedule(i)
+        d = fireEventually()
+        d.addCallback(self._check, [0, 1])
+        d.addCallback(self._stats, 2, 2)
+        # nothing changes until one of them finishes
+        d.addCallback(self._check, [0, 1])
+        d.addCallback(lambda ign: self.hanging[1].callback(None))
+        d.addCallback(self._stats, 2, 1)
+        d.addCallback(fireEventually)
+        d.addCallback(self._check, [0, 1, 2])
+        d.addCallback(self._stats, 1, 2)
+        def _finish(ign):
+            self.hanging[0].errback(ValueError("oops"))
+            self.hanging[2].callback(None)
+            self.flushLoggedErrors(ValueError)
+        d.addCallback(_finish)
+        d.addCallback(fireEventually)
+        d.addCallback(self._check, [0, 1, 2, 3])
+        d.addCallback(self._stats, 0, 1)
+        return d
+
+class InboundLimitOption(unittest.TestCase):
+    def test_option(self):
+        t = Tub()
+        t.setOption("max-inbound-calls-per-connection", 5)
+        b = broker.Broker(TubRef("inbound"))
+        b.setTub(t)
+        self.failUnlessEqual(b.maxInboundCalls, 5)
+        t.brokers[b.remote_tubref] = b
+        [(tubref, inbound, outbound, stats)] = t.debug_listBrokers()
+        self.failUnlessEqual(stats, {"queued": 0, "in-flight": 0,
+                                     "max-in-flight": 5})
+
+class AutoVocab(TargetMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+        self.callingBroker.useAutoVocabulary = True
+        self.targetBroker.useAutoVocabulary = True
+
+    def echo_many(self, rr, values):
+        results = []
+        d = flushEventualQueue()
+        for v in values:
+            d.addCallback(lambda ign, v=v: rr.callRemote("echo", v))
+            d.addCallback(results.append)
+        d.addCallback(lambda ign: results)
+        return d
+
+    def test_promote(self):
+        rr, target = self.setupTarget(HelperTarget(), True)
+        values = ["repeated value"] * 6
+        d = self.echo_many(rr, values)
+        def _check(results):
+            self.failUnlessEqual(results, values)
+            out = self.callingBroker.outgoingVocabulary
+            self.failUnless("repeated value" in out, out)
+            self.failUnless("echo" in out, out)
+            incoming = self.targetBroker.incomingVocabulary
+            self.failUnlessEqual(incoming[out["repeated value"]],
+                                 "repeated value")
+            # the target also learned to abbreviate its answers
+            self.failUnless("repeated value" in
+                            self.targetBroker.outgoingVocabulary)
+        d.addCallback(_check)
+        return d
+
+    def test_evict(self):
+        self.callingBroker.autoVocabMaxEntries = 3
+        rr, target = self.setupTarget(HelperTarget(), True)
+        values = []
+        for i in range(6):
+            values.extend(["string number %d" % i] * 4)
+        values.extend(["string number 0"] * 4)
+        d = self.echo_many(rr, values)
+        def _check(results):
+            self.failUnlessEqual(results, values)
+            b = self.callingBroker
+            self.failUnless(len(b.addedVocabUses) <= 3, b.addedVocabUses)
+            incoming = self.targetBroker.incomingVocabulary
+            for string, index in b.outgoingVocabulary.items():
+                self.failUnlessEqual(incoming[index], string)
+            self.failUnless(len(incoming) <= 3, incoming)
+        d.addCallback(_check)
+        return d
+
+class CallBatch(TargetMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+        self.callingBroker.useCallBatch = True
+        self.sent = {self.callingBroker: [], self.targetBroker: []}
+        for b in self.sent:
+            def _send(obj, b=b, send=b.send):
+                self.sent[b].append(obj)
+                return send(obj)
+            b.send = _send
+
+    def gather(self, dl):
+        # results in call order, with a Failure for each call that failed
+        d = defer.DeferredList(dl, consumeErrors=True)
+        d.addCallback(lambda res: [value for (success, value) in res])
+        return d
+
+    def test_batch(self):
+        rr, target = self.setupTarget(Target(), True)
+        dl = rr.callRemoteBatch([("add", (1, 2), {}),
+                                 ("fail", (), {}),
+                                 ("add", (), {"a": 3, "b": 4}),
+                                 ])
+        d = self.gather(dl)
+        def _check(results):
+            self.failUnlessEqual(results[0], 3)
+            self.failUnless(results[1].check(ValueError), results[1])
+            self.failUnlessEqual(results[2], 7)
+            self.failUnlessEqual(target.calls, [(1, 2), (3, 4)])
+            # one sequence each way
+            self.failUnlessEqual([type(s) for s in self.sent[self.callingBroker]],
+                                 [call.CallBatchSlicer])
+            self.failUnlessEqual([type(s) for s in self.sent[self.targetBroker]],
+                                 [call.AnswerBatchSlicer])
+            self.failIf(self.callingBroker.waitingForAnswers)
+            self.failUnlessEqual(self.targetBroker.activeLocalCalls, {})
+        d.addCallback(_check)
+        return d
+
+    def test_local_failure(self):
+        # a call which fails our own schema check is left out of the batch
+        rr, target = self.setupTarget(Target(), True)
+        dl = rr.callRemoteBatch([("add", (1, 2), {}),
+                                 ("add", ("one", 2), {}),
+                                 ("missing", (), {}),
+                                 ("add", (5, 6), {}),
+                                 ])
+        d = self.gather(dl)
+        def _check(results):
+            self.failUnlessEqual(results[0], 3)
+            self.failUnless(results[1].check(Violation), results[1])
+            self.failUnless(results[2].check(Violation), results[2])
+            self.failUnlessEqual(results[3], 11)
+            self.failUnlessEqual(target.calls, [(1, 2), (5, 6)])
+            self.failUnlessEqual(len(self.sent[self.callingBroker]), 1)
+        d.addCallback(_check)
+        return d
+
+    def test_remote_violation(self):
+        # if the far end rejects one call, none of them are run
+        rr, target = self.setupTarget(Target(), True)
+        dl = rr.callRemoteBatch([("add", (1, 2), {}),
+                                 ("add", ("one", 2), {"_useSchema": False}),
+                                 ("add", (5, 6), {}),
+                                 ])
+        d = self.gather(dl)
+        def _check(results):
+            for r in results:
+                self.failUnless(r.check(Violation), r)
+            self.failUnlessEqual(target.calls, [])
+            self.failIf(self.callingBroker.waitingForAnswers)
+            self.failUnlessEqual(self.targetBroker.activeLocalCalls, {})
+        d.addCallback(_check)
+        return d
+
+    def test_options(self):
+        # _callOnly and _pipeline calls cannot share the batch's answer, so
+        # they are sent on their own
+        rr, target = self.setupTarget(Target(), True)
+        results = rr.callRemoteBatch([("add", (1, 2), {}),
+                                      ("add", (3, 4), {"_callOnly": True}),
+                                      ("add", (5, 6), {"_pipeline": True,
+                                                       "_callOnly": False}),
+                                      ("add", (7, 8), {"_callOnly": False,
+                                                       "_pipeline": False}),
+                                      ])
+        self.failUnlessEqual(results[1], None)
+        d = defer.gatherResults([results[0], results[2].when(), results[3]])
+        def _check(res):
+            self.failUnlessEqual(res, [3, 11, 15])
+            self.failUnlessEqual(sorted(target.calls),
+                                 [(1, 2), (3, 4), (5, 6), (7, 8)])
+            # the first and last still went together
+            self.failUnlessEqual([type(s) for s in self.sent[self.callingBroker]],
+                                 [call.CallSlicer, call.CallSlicer,
+                                  call.CallBatchSlicer])
+        d.addCallback(fireEventually)
+        d.addCallback(_check)
+        return d
+
+    def test_not_negotiated(self):
+        self.callingBroker.useCallBatch = False
+        rr, target = self.setupTarget(Target(), True)
+        dl = rr.callRemoteBatch([("add", (1, 2), {}),
+                                 ("add", (3, 4), {}),
+                                 ])
+        d = self.gather(dl)
+        def _check(results):
+            self.failUnlessEqual(results, [3, 7])
+            self.failUnlessEqual([type(s) for s in self.sent[self.callingBroker]],
+                                 [call.CallSlicer, call.CallSlicer])
+        d.addCallback(_check)
+        # options behave the same way as when batches are used
+        d.addCallback(lambda ign: rr.callRemoteBatch(
+            [("add", (5, 6), {"_callOnly": True})]))
+        d.addCallback(self.failUnlessEqual, [None])
+        d.addCallback(lambda ign: self.poll(lambda: (5, 6) in target.calls))
+        return d
+
+class Chain(Referenceable):
+    def __init__(self, name, next=None):
+        self.name = name
+        self.next = next
+    def remote_next(self):
+        if self.next is None:
+            raise ValueError("%s is the end of the chain" % self.name)
+        return self.next
+    def remote_getName(self):
+        return self.name
+    def remote_setName(self, name):
+        self.name = name
+
+class Pipelining(TargetMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+        self.callingBroker.useCallPipeline = True
+        self.targetBroker.useCallPipeline = True
+        self.sent = []
+        def _send(obj, send=self.callingBroker.send):
+            # record calls, but not the ones to the Broker itself (decref,
+            # release_answer)
+            if isinstance(obj, call.CallSlicer) and obj.clid != 0:
+                self.sent.append(obj)
+            return send(obj)
+        self.callingBroker.send = _send
+
+    def makeChain(self):
+        c = Chain("c")
+        b = Chain("b", c)
+        a = Chain("a", b)
+        rr, target = self.setupTarget(a)
+        return rr
+
+    def test_pipeline(self):
+        rr = self.makeChain()
+        p1 = rr.callRemote("next", _pipeline=True)
+        p2 = p1.callRemote("next", _pipeline=True)
+        d = p2.callRemote("getName")
+        # all three calls went out before any answer came back
+        self.failUnlessEqual([type(s) for s in self.sent],
+                             [call.PromiseCallSlicer] * 3)
+        d.addCallback(self.failUnlessEqual, "c")
+        d.addCallback(lambda ign: p1.when())
+        def _check_p1(b_rref):
+            # once the answer is in, calls go straight to the result
+            del self.sent[:]
+            return b_rref.callRemote("getName")
+        d.addCallback(_check_p1)
+        d.addCallback(self.failUnlessEqual, "b")
+        d.addCallback(lambda ign: p1.callRemote("getName"))
+        d.addCallback(self.failUnlessEqual, "b")
+        def _check_direct(ign):
+            self.failUnlessEqual([type(s) for s in self.sent],
+                                 [call.CallSlicer] * 2)
+        d.addCallback(_check_direct)
+        # both retained answers are released
+        d.addCallback(lambda ign:
+                      self.poll(lambda: not self.targetBroker.retainedAnswers))
+        return d
+
+    def test_broken(self):
+        # calls pipelined onto a failed call fail the same way
+        rr, target = self.setupTarget(Chain("a"))
+        p1 = rr.callRemote("next", _pipeline=True)
+        d = p1.callRemote("getName")
+        def _check(res):
+            self.failUnless(isinstance(res, Failure), res)
+            self.failUnless(res.check(ValueError), res)
+            self.failUnlessSubstring("a is the end of the chain", str(res))
+        d.addBoth(_check)
+        d.addCallback(lambda ign:
+                      self.poll(lambda: not self.targetBroker.retainedAnswers))
+        return d
+
+    def test_not_referenceable(self):
+        rr, target = self.setupTarget(Chain("a"))
+        p1 = rr.callRemote("getName", _pipeline=True)
+        d = p1.callRemote("getName")
+        def _check(res):
+            self.failUnless(isinstance(res, Failure), res)
+            self.failUnless(res.check(Violation), res)
+        d.addBoth(_check)
+        return d
+
+    def test_call_only(self):
+        rr = self.makeChain()
+        p1 = rr.callRemote("next", _pipeline=True)
+        d = p1.callRemote("setName", "B", _callOnly=True)
+        d.addCallback(self.failUnlessEqual, None)
+        # nothing waits for an answer to it
+        self.failUnlessEqual(len(self.callingBroker.waitingForAnswers), 1)
+        d.addCallback(lambda ign: p1.callRemote("getName"))
+        d.addCallback(self.failUnlessEqual, "B")
+        return d
+
+    def test_method_constraint(self):
+        rr = self.makeChain()
+        p1 = rr.callRemote("next", _pipeline=True)
+        schema = RemoteMethodSchema(_response=str, name=str)
+        del self.sent[:]
+        d = p1.callRemote("setName", 12, _methodConstraint=schema)
+        def _check(res):
+            self.failUnless(isinstance(res, Failure), res)
+            self.failUnless(res.check(Violation), res)
+            # the arguments were checked before anything was sent
+            self.failUnlessEqual(self.sent, [])
+        d.addBoth(_check)
+        # the response is checked against the schema's constraint
+        d.addCallback(lambda ign: p1.callRemote("setName", "B",
+                                                _methodConstraint=schema))
+        def _check_response(res):
+            self.failUnless(isinstance(res, Failure), res)
+            self.failUnless(res.check(Violation), res)
+        d.addBoth(_check_response)
+        d.addCallback(lambda ign: p1.callRemote("getName"))
+        d.addCallback(self.failUnlessEqual, "B")
+        return d
+
+    def test_not_negotiated(self):
+        self.callingBroker.useCallPipeline = False
+        rr = self.makeChain()
+        p1 = rr.callRemote("next", _pipeline=True)
+        p2 = p1.callRemote("next", _pipeline=True)
+        d = p2.callRemote("getName")
+        self.failUnlessEqual([type(s) for s in self.sent], [call.CallSlicer])
+        d.addCallback(self.failUnlessEqual, "c")
+        def _check(ign):
+            self.failUnlessEqual([type(s) for s in self.sent],
+                                 [call.CallSlicer] * 3)
+            self.failUnlessEqual(self.targetBroker.retainedAnswers, {})
+        d.addCallback(_check)
+        return d
+
+class HashSink:
+    # a sink which keeps only a hash of what it is given
+    instances = []
+    def __init__(self, size):
+        self.size = size
+        self.writes = 0
+        self.hasher = sha1()
+        HashSink.instances.append(self)
+    def write(self, data):
+        self.writes += 1
+        self.hasher.update(data)
+    def finish(self):
+        return (self.size, self.hasher.hexdigest())
+
+class RIUploader(RemoteInterface):
+    def put(data=StreamedBytes(HashSink, maxLength=100000), name=str):
+        return None
+
+class Uploader(Referenceable):
+    implements(RIUploader)
+    def __init__(self):
+        self.uploads = []
+    def remote_put(self, data, name):
+        self.uploads.append((name, data))
+
+class StreamedArguments(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+        HashSink.instances = []
+        # deliver everything sent to the target in small pieces
+        t = self.callingBroker.transport
+        write = t._write
+        def _write(data):
+            for i in range(0, len(data), 1000):
+                write(data[i:i+1000])
+        t._write = _write
+
+    def test_streamed(self):
+        rr, target = self.setupTarget(Uploader(), True)
+        data = "".join([chr(i % 256) for i in range(50000)])
+        d = rr.callRemote("put", data, name="big")
+        def _check(res):
+            self.failUnlessEqual(target.uploads,
+                                 [("big", (50000, sha1(data).hexdigest()))])
+            self.failUnlessEqual(len(HashSink.instances), 1)
+            self.failUnless(HashSink.instances[0].writes > 1)
+        d.addCallback(_check)
+        return d
+
+    def test_keyword(self):
+        rr, target = self.setupTarget(Uploader(), True)
+        data = "a" * 5000
+        d = rr.callRemote("put", name="kw", data=data)
+        def _check(res):
+            self.failUnlessEqual(target.uploads,
+                                 [("kw", (5000, sha1(data).hexdigest()))])
+            # the name was not given to a sink
+            self.failUnlessEqual(len(HashSink.instances), 1)
+        d.addCallback(_check)
+        return d
+
+    def test_single_piece(self):
+        # a short string arrives all at once, but still goes to the sink
+        rr, target = self.setupTarget(Uploader(), True)
+        d = rr.callRemote("put", "small", name="small")
+        def _check(res):
+            self.failUnlessEqual(target.uploads,
+                                 [("small", (5, sha1("small").hexdigest()))])
+            self.failUnlessEqual(HashSink.instances[0].writes, 1)
+        d.addCallback(_check)
+        return d
+
+    def test_filebody(self):
+        # the sender reads the file in pieces, the receiver hashes them
+        rr, target = self.setupTarget(Uploader(), True)
+        data = "".join([chr(i % 251) for i in range(80000)])
+        d = rr.callRemote("put", FileBody(StringIO(data), chunkSize=4096),
+                          name="file")
+        def _check(res):
+            self.failUnlessEqual(target.uploads,
+                                 [("file", (80000, sha1(data).hexdigest()))])
+            self.failUnless(HashSink.instances[0].writes > 1)
+        d.addCallback(_check)
+        return d
+
+    def test_filebody_too_large(self):
+        # FileBody sizes are checked against the constraint before sending
+        rr, target = self.setupTarget(Uploader(), True)
+        body = FileBody(StringIO("a" * 100001))
+        d = self.shouldFail(Violation, "test_filebody_too_large",
+                            "string too long",
+                            rr.callRemote, "put", body, name="x")
+        return d
+
+    def test_too_large(self):
+        # the sender doesn't know the interface, so the target's checkToken
+        # has to reject the string before any sink is created
+        rr, target = self.setupTarget(Uploader(), False)
+        d = self.shouldFail(Violation, "test_too_large", "token too large",
+                            rr.callRemote, "put", "a" * 100001, name="x")
+        def _check(res):
+            self.failUnlessEqual(target.uploads, [])
+            self.failUnlessEqual(HashSink.instances, [])
+        d.addCallback(_check)
+        return d
+
+class RIRecords(RemoteInterface):
+    def store(records=ListOf(DictOf(str, int)), tag=str):
+        return int
+    def named(name=StringConstraint(regexp="^[a-z]+$")):
+        return None
+    def pair(p=TupleOf(int, int)):
+        return int
+
+class Records(Referenceable):
+    implements(RIRecords)
+    def remote_store(self, records, tag):
+        return len(records)
+    def remote_named(self, name):
+        return None
+    def remote_pair(self, p):
+        return p[0] + p[1]
+
+class ArgumentChecks(TargetMixin, ShouldFailMixin, unittest.TestCase):
+    # arguments which were fully checked as they arrived are not checked
+    # again before the method is invoked
+
+    def setUp(self):
+        TargetMixin.setUp(self)
+        self.setupBrokers()
+        self.fullChecks = []
+        def _spy(schema):
+            checkAllArgs = schema.checkAllArgs
+            def _checkAllArgs(args, kwargs, inbound):
+                if inbound:
+                    self.fullChecks.append(schema.name)
+                return checkAllArgs(args, kwargs, inbound)
+            schema.checkAllArgs = _checkAllArgs
+            self.addCleanup(delattr, schema, "checkAllArgs")
+        for name in ("store", "named", "pair"):
+            _spy(RIRecords[name])
+
+    def test_checked(self):
+        rr, target = self.setupTarget(Records(), True)
+        d = rr.callRemote("store", [{"a": 1}, {"b": 2, "c": 3}], tag="t")
+        d.addCallback(self.failUnlessEqual, 2)
+        d.addCallback(lambda res: rr.callRemote("pair", (1, 2)))
+        d.addCallback(self.failUnlessEqual, 3)
+        d.addCallback(lambda res: self.failUnlessEqual(self.fullChecks, []))
+        return d
+
+    def test_missing(self):
+        rr, target = self.setupTarget(Records(), True)
+        d = self.shouldFail(Violation, "test_missing",
+                            "missing required argument 'tag'",
+                            rr.callRemote, "store", records=[],
+                            _useSchema=False)
+        return d
+
+    def test_regexp(self):
+        # the regexp can only be checked once the string has arrived
+        rr, target = self.setupTarget(Records(), True)
+        d = self.shouldFail(Violation, "test_regexp", "regexp failed to match",
+                            rr.callRemote, "named", "BAD", _useSchema=False)
+        d.addCallback(lambda res:
+                      self.failUnlessEqual(self.fullChecks, ["named"]))
+        return d
+
+    def test_short_tuple(self):
+        rr, target = self.setupTarget(Records(), True)
+        d = self.shouldFail(Violation, "test_short_tuple", "wrong size tuple",
+                            rr.callRemote, "pair", (1,), _useSchema=False)
+        return d
+
+    def test_int_range(self):
+        # our own Banana sends numbers this large as LONGINT, which an int
+        # constraint rejects, but a hostile peer can put them in the header
+        # of an INT or NEG token instead
+        b = self.callingBroker
+        sendToken = b.sendToken
+        def _sendToken(obj):
+            if isinstance(obj, (int, long)) and abs(obj) > 2**31:
+                typebyte = (obj > 0) and INT or NEG
+                b._write(int2b128str(abs(obj)) + typebyte)
+            else:
+                sendToken(obj)
+        b.sendToken = _sendToken
+        rr, target = self.setupTarget(Records(), True)
+        d = self.shouldFail(Violation, "test_int_range", "number too large",
+                            rr.callRemote, "pair", (2**100, 1),
+                            _useSchema=False)
+        d.addCallback(lambda res:
+                      self.shouldFail(Violation, "test_int_range",
+                                      "number too large",
+                                      rr.callRemote, "store",
+                                      [{"a": -2**40}], tag="t",
+                                      _useSchema=False))
+        # the largest NEG that fits in an int is accepted
+        d.addCallback(lambda res: rr.callRemote("pair", (-2**31, 1)))
+        d.addCallback(self.failUnlessEqual, -2**31 + 1)
+        return d
+
 class ExamineFailuresMixin:
     def _examine_raise(self, r, should_be_remote):
         f = r[0]
@@ -795,7 +1681,12 @@ class TubFailures(ExamineFailuresMixin, ShouldFailMixin, MakeTubsMixin,
         d.addCallback(self._examine_raise, False)
         return d
 
-class ReferenceCounting(ShouldFailMixin, MakeTubsMixin, unittest.TestCase):
+class Maker(Referenceable):
+    def remote_make(self, count):
+        return [Target() for i in range(count)]
+
+class ReferenceCounting(ShouldFailMixin, MakeTubsMixin, PollMixin,
+                        unittest.TestCase):
     def setUp(self):
         self.s = service.MultiService()
         self.target_tub, self.source_tub = self.makeTubs(2)
@@ -864,3 +1755,37 @@ class ReferenceCounting(ShouldFailMixin, MakeTubsMixin, unittest.TestCase):
         d.addCallback(_check_shared)
         return d
 
+    def test_decref_many(self):
+        # references dropped in the same turn are released with one message
+        d = self.setupTarget(Maker())
+        decrefs = []
+        def _send(rref):
+            self.rref = rref
+            tb = self.target_tub.brokers.values()[0]
+            self.failUnless(tb.useDecrefMany)
+            self.before = len(tb.myReferenceByCLID)
+            orig = tb.remote_decref_many
+            def _decref_many(refs):
+                decrefs.append(refs)
+                return orig(refs)
+            tb.remote_decref_many = _decref_many
+            return rref.callRemote("make", 5)
+        d.addCallback(_send)
+        def _drop(rrefs):
+            tb = self.target_tub.brokers.values()[0]
+            self.failUnlessEqual(len(tb.myReferenceByCLID), self.before+5)
+            # returning something else releases the RemoteReferences
+            return len(rrefs)
+        d.addCallback(_drop)
+        d.addCallback(lambda ign: self.poll(lambda: decrefs))
+        def _check(ign):
+            tb = self.target_tub.brokers.values()[0]
+            self.failUnlessEqual(len(decrefs), 1)
+            self.failUnlessEqual(sorted([count for (clid, count)
+                                         in decrefs[0]]), [1]*5)
+            self.failUnlessEqual(len(tb.myReferenceByCLID), self.before)
+        d.addCallback(_check)
+        d.addCallback(lambda ign: self.poll(lambda: len(
+            self.source_tub.brokers.values()[0].yourReferenceByCLID) == 1))
+        return d
+
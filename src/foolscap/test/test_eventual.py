@@ -2,6 +2,7 @@
 from twisted.trial import unittest
 
 from foolscap.eventual import eventually, fireEventually, flushEventualQueue
+from foolscap.eventual import _SimpleCallQueue
 
 class TestEventual(unittest.TestCase):
 
@@ -40,3 +41,99 @@ class TestEventual(unittest.TestCase):
         d = flushEventualQueue()
         d.addCallback(_check)
         return d
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+class Budget(unittest.TestCase):
+
+    def run_turns(self, q, calls, clock=None):
+        # queue 'calls' calls, and record which turn each one ran in
+        self.turns = []
+        self.order = []
+        def _call(i):
+            self.order.append(i)
+            self.turns.append(q.getStats()["turns"])
+            if clock:
+                clock.now += 1.0
+        for i in range(calls):
+            q.append(_call, (i,), {})
+        return q.flush()
+
+    def test_call_budget(self):
+        q = _SimpleCallQueue()
+        q.setTurnBudget(None, 2)
+        d = self.run_turns(q, 5)
+        def _check(res):
+            self.failUnlessEqual(self.order, range(5))
+            self.failUnlessEqual(self.turns, [0, 0, 1, 1, 2])
+            stats = q.getStats()
+            self.failUnlessEqual(stats["turns"], 3)
+            self.failUnlessEqual(stats["calls"], 5)
+            self.failUnlessEqual(stats["yields"], 2)
+            self.failUnlessEqual(stats["depth"], 0)
+            self.failUnlessEqual(stats["max-depth"], 5)
+        d.addCallback(_check)
+        return d
+
+    def test_time_budget(self):
+        clock = FakeClock()
+        q = _SimpleCallQueue(clock)
+        q.setTurnBudget(1.5)
+        d = self.run_turns(q, 5, clock)
+        def _check(res):
+            self.failUnlessEqual(self.order, range(5))
+            self.failUnlessEqual(self.turns, [0, 0, 1, 1, 2])
+            stats = q.getStats()
+            self.failUnlessEqual(stats["yields"], 2)
+            # the last call waited while the first four ran
+            self.failUnlessEqual(stats["max-latency"], 4.0)
+            self.failUnlessEqual(stats["turn-durations"],
+                                 {0.001: 0, 0.01: 0, 0.1: 0, 1.0: 1,
+                                  None: 2})
+        d.addCallback(_check)
+        return d
+
+    def test_slow_call(self):
+        # a single call that overruns the time budget still makes progress
+        clock = FakeClock()
+        q = _SimpleCallQueue(clock)
+        q.setTurnBudget(0.5)
+        d = self.run_turns(q, 3, clock)
+        def _check(res):
+            self.failUnlessEqual(self.turns, [0, 1, 2])
+        d.addCallback(_check)
+        return d
+
+    def test_later_turn(self):
+        # calls queued during a turn wait for the next one, even when the
+        # budget has room for them
+        q = _SimpleCallQueue()
+        q.setTurnBudget(None, None)
+        turns = []
+        def _call(i):
+            turns.append(q.getStats()["turns"])
+            if i:
+                q.append(_call, (i-1,), {})
+        q.append(_call, (2,), {})
+        d = q.flush()
+        def _check(res):
+            self.failUnlessEqual(turns, [0, 1, 2])
+            self.failUnlessEqual(q.getStats()["yields"], 0)
+        d.addCallback(_check)
+        return d
+
+    def test_reset_stats(self):
+        q = _SimpleCallQueue()
+        d = self.run_turns(q, 3)
+        def _check(res):
+            q.resetStats()
+            stats = q.getStats()
+            self.failUnlessEqual(stats["turns"], 0)
+            self.failUnlessEqual(stats["max-depth"], 0)
+            self.failUnlessEqual(sum(stats["turn-durations"].values()), 0)
+        d.addCallback(_check)
+        return d
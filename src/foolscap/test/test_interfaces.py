@@ -1,6 +1,6 @@
 # -*- test-case-name: foolscap.test.test_interfaces -*-
 
-from zope.interface import implementsOnly
+from zope.interface import implementsOnly, alsoProvides
 from twisted.trial import unittest
 
 from foolscap import schema, remoteinterface
@@ -110,6 +110,49 @@ class TestInterface(TargetMixin, unittest.TestCase):
         iface = getRemoteInterface(t)
         self.failIf(iface)
 
+    def testDispatchTable(self):
+        # instances of one class share a DispatchTable
+        t1, t2 = Target(), Target()
+        table = t1.getDispatchTable()
+        self.failUnlessIdentical(t2.getDispatchTable(), table)
+        self.failUnlessIdentical(table.interface, RIMyTarget)
+        self.failUnlessEqual(table.interfaceName, "RIMyTarget")
+        self.failUnlessIdentical(table.getMethodSchema("add"),
+                                 RIMyTarget["add"])
+        self.failUnlessEqual(table.getMethodSchema("missing"), None)
+        self.failUnlessIdentical(t1.getInterface(), RIMyTarget)
+
+        table2 = Target2().getDispatchTable()
+        self.failIfIdentical(table2, table)
+        self.failUnlessIdentical(table2.interface, RIMyTarget2)
+
+        t3 = TargetWithoutInterfaces()
+        table3 = t3.getDispatchTable()
+        self.failUnlessEqual(table3.interface, None)
+        self.failUnlessEqual(t3.getInterfaceName(), None)
+        self.failUnless("add" in table3.methods)
+        self.failUnlessEqual(table3.getMethodSchema("add"), None)
+
+    def testDispatchInstanceInterface(self):
+        # an instance which declares its own RemoteInterface gets its own
+        # DispatchTable
+        plain = TargetWithoutInterfaces()
+        t = TargetWithoutInterfaces()
+        alsoProvides(t, RIMyTarget)
+        self.failUnlessIdentical(t.getInterface(), RIMyTarget)
+        self.failUnlessEqual(plain.getInterface(), None)
+        self.failIfIdentical(t.getDispatchTable(), plain.getDispatchTable())
+
+    def testDispatchInstanceMethod(self):
+        # remote_ methods set on the instance are still honored
+        self.setupBrokers()
+        t = Target()
+        t.remote_add = lambda a, b: a*b
+        rr, target = self.setupTarget(t)
+        d = rr.callRemote("add", a=3, b=4)
+        d.addCallback(self.failUnlessEqual, 12)
+        return d
+
     def testStack(self):
         # when you violate your outbound schema, the Failure you get should
         # have a stack trace that includes the actual callRemote invocation.
@@ -56,6 +56,10 @@ class Keepalives(MakeTubsMixin, unittest.TestCase):
         d.addCallback(self.stall, 2)
         def _count_pings(rref):
             b = rref.tracker.broker
+            # the idle checks use the Tub's shared TimerWheel
+            self.failUnless(b.timerWheel is
+                            self.services[1].getTimerWheel())
+            self.failUnlessEqual(b.idleTimer, None)
             # we're only watching one side here (the initiating side,
             # services[0]). Either side could produce a PING that the other
             # side responds to with a PONG, depending upon how the timers
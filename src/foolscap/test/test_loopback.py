@@ -1,11 +1,15 @@
 
+from cStringIO import StringIO
 from twisted.trial import unittest
 from twisted.internet import defer
-from foolscap.test.common import HelperTarget, MakeTubsMixin
+from foolscap.api import FileBody, Violation
+from foolscap.referenceable import RemoteReference
+from foolscap.test.common import HelperTarget, Target, MakeTubsMixin, \
+     ShouldFailMixin
 from foolscap.eventual import flushEventualQueue
 
 
-class ConnectToSelf(MakeTubsMixin, unittest.TestCase):
+class ConnectToSelf(MakeTubsMixin, ShouldFailMixin, unittest.TestCase):
     def setUp(self):
         self.makeTubs(1)
 
@@ -34,3 +38,66 @@ class ConnectToSelf(MakeTubsMixin, unittest.TestCase):
         d.addCallback(_connected)
         d.addCallback(_check)
         return d
+
+    def getRef(self, target):
+        tub = self.services[0]
+        return tub.getReference(tub.registerReference(target))
+
+    def testBrokerCached(self):
+        tub = self.services[0]
+        d = self.getRef(HelperTarget("bob"))
+        def _connected(ref):
+            self.failUnlessEqual(len(tub.brokers), 1)
+            b = tub.brokers.values()[0]
+            self.failUnless(ref.tracker.broker is b)
+            self.failUnless(b.passTokens)
+            d2 = self.getRef(HelperTarget("alice"))
+            d2.addCallback(lambda ref2: ref2.callRemote("set", 1))
+            d2.addCallback(lambda res: b)
+            return d2
+        d.addCallback(_connected)
+        def _check(b):
+            self.failUnlessEqual(tub.brokers.values(), [b])
+            # tokens were passed, not bytes
+            self.failUnlessEqual(b.getOutputStats()["bytes"], 0)
+        d.addCallback(_check)
+        return d
+
+    def testCopies(self):
+        target = HelperTarget("bob")
+        other = HelperTarget("alice")
+        obj = {"list": [1, -2, 2**70, -2**70, 1.5, "s", u"unicode"],
+               "tuple": (True, None), "ref": other}
+        d = self.getRef(target)
+        d.addCallback(lambda ref: ref.callRemote("set", obj))
+        def _check(res):
+            got = target.obj
+            self.failIf(got is obj)
+            self.failIf(got["list"] is obj["list"])
+            self.failUnlessEqual(got["list"], obj["list"])
+            self.failUnlessEqual(got["tuple"], obj["tuple"])
+            # Referenceables still arrive as RemoteReferences
+            self.failUnless(isinstance(got["ref"], RemoteReference))
+        d.addCallback(_check)
+        return d
+
+    def testStreamed(self):
+        target = HelperTarget("bob")
+        data = "".join([chr(i % 256) for i in range(100000)])
+        d = self.getRef(target)
+        d.addCallback(lambda ref: ref.callRemote(
+            "set", FileBody(StringIO(data), chunkSize=4096)))
+        d.addCallback(lambda res: self.failUnlessEqual(target.obj, data))
+        return d
+
+    def testViolation(self):
+        target = Target()
+        d = self.getRef(target)
+        def _connected(ref):
+            # skip the outbound check, so the receiving side must catch it
+            return self.shouldFail(Violation, "testViolation", None,
+                                   ref.callRemote, "add", a=1, b="two",
+                                   _useSchema=False)
+        d.addCallback(_connected)
+        d.addCallback(lambda res: self.failUnlessEqual(target.calls, []))
+        return d
@@ -1,11 +1,14 @@
 
+from zope.interface import implementer
 from twisted.trial import unittest
 
 from twisted.internet import protocol, defer
 from twisted.application import internet
-from foolscap import negotiate, tokens
+from foolscap import negotiate, tokens, ipb
 from foolscap.api import Referenceable, Tub, BananaError
 from foolscap.util import allocate_tcp_port
+from foolscap.referenceable import SturdyRef
+from foolscap.connections import tcp
 from foolscap.test.common import (BaseMixin,
                                   tubid_low, certData_low,
                                   certData_high)
@@ -151,7 +154,10 @@ class Parallel(BaseMixin, unittest.TestCase):
         self.p1, self.p2 = allocate_tcp_port(), allocate_tcp_port()
         tub.listenOn("tcp:%d:interface=127.0.0.1" % self.p1, lo1)
         tub.listenOn("tcp:%d:interface=127.0.0.1" % self.p2, lo2)
-        tub.setLocation("127.0.0.1:%d" % self.p1, "127.0.0.1:%d" % self.p2)
+        # hints are tried in order, so the second listener is listed first:
+        # its connection must already be in progress (and stalled, in
+        # whichever phase the test wants) when the first one is started
+        tub.setLocation("127.0.0.1:%d" % self.p2, "127.0.0.1:%d" % self.p1)
         self.target = Target()
         return tub.registerReference(self.target)
 
@@ -281,6 +287,85 @@ class ThreeInParallel(BaseMixin, unittest.TestCase):
         return d
     test1.timeout = 10
 
+@implementer(ipb.IConnectionHintHandler)
+class CountingHandler:
+    # handles "counted:HOST:PORT" hints with plain TCP
+    def __init__(self):
+        self.asked = 0
+    def hint_to_endpoint(self, hint, reactor):
+        self.asked += 1
+        return tcp.default().hint_to_endpoint("tcp:" + hint.split(":", 1)[1],
+                                              reactor)
+
+class Staggered(BaseMixin, unittest.TestCase):
+    def makeServers(self, *hints):
+        self.tub = tub = Tub(certData=certData_high)
+        tub.startService()
+        self.services.append(tub)
+        self.port = port = allocate_tcp_port()
+        tub.listenOn("tcp:%d:interface=127.0.0.1" % port)
+        tub.setLocation(*[hint % {"port": port, "refused": allocate_tcp_port()}
+                          for hint in hints])
+        self.target = Target()
+        return tub.registerReference(self.target)
+
+    def makeClient(self, delay):
+        self.client = client = Tub(certData_low)
+        client.setOption("connection-stagger-delay", delay)
+        self.handler = CountingHandler()
+        client.addConnectionHintHandler("counted", self.handler)
+        client.startService()
+        self.services.append(client)
+        return client
+
+    def test_head_start(self):
+        # the second hint is not tried while the first is doing fine
+        url = self.makeServers("tcp:127.0.0.1:%(port)d",
+                               "counted:127.0.0.1:%(port)d")
+        client = self.makeClient(60)
+        d = client.getReference(url)
+        d.addCallback(self.stall, 0.5)
+        d.addCallback(lambda res: self.failUnlessEqual(self.handler.asked, 0))
+        return d
+    test_head_start.timeout = 10
+
+    def test_all_at_once(self):
+        url = self.makeServers("tcp:127.0.0.1:%(port)d",
+                               "counted:127.0.0.1:%(port)d")
+        client = self.makeClient(None)
+        d = client.getReference(url)
+        d.addCallback(lambda res: self.failUnlessEqual(self.handler.asked, 1))
+        return d
+    test_all_at_once.timeout = 10
+
+    def test_failure_and_recent_hint(self):
+        # a refused connection does not make the next hint wait out the
+        # delay, and the hint that worked is tried first next time
+        url = self.makeServers("counted:127.0.0.1:%(refused)d",
+                               "tcp:127.0.0.1:%(port)d")
+        client = self.makeClient(60)
+        tubref = SturdyRef(url).getTubRef()
+        good = "tcp:127.0.0.1:%d" % self.port
+        d = client.getReference(url)
+        def _connected(rref):
+            self.failUnlessEqual(self.handler.asked, 1)
+            self.failUnlessEqual(client.rankLocationHints(tubref)[0], good)
+            d2 = defer.Deferred()
+            rref.notifyOnDisconnect(d2.callback, None)
+            rref.tracker.broker.transport.loseConnection()
+            return d2
+        d.addCallback(_connected)
+        d.addCallback(self.insert_turns, 2)
+        d.addCallback(lambda res: client.getReference(url))
+        d.addCallback(lambda rref: rref.callRemote("call"))
+        def _reconnected(res):
+            self.failUnlessEqual(self.target.calls, 1)
+            # the refused hint was not tried again
+            self.failUnlessEqual(self.handler.asked, 1)
+        d.addCallback(_reconnected)
+        return d
+    test_failure_and_recent_hint.timeout = 10
+
 class SharedConnections(BaseMixin, unittest.TestCase):
     def makeServers(self):
         self.tub = tub = Tub(certData=certData_high)
@@ -679,6 +764,68 @@ class Future(BaseMixin, unittest.TestCase):
     testTooFarInFuture4.timeout = 10
 
 
+class NegotiationNoFeatures(negotiate.Negotiation):
+    # behaves like a peer that predates 'banana-features'
+    bananaFeatures = ()
+
+class Features(BaseMixin, unittest.TestCase):
+    def connect(self, serverCert, clientCert,
+                serverNegotiation=negotiate.Negotiation,
+                clientNegotiation=negotiate.Negotiation):
+        url, portnum = self.makeSpecificServer(serverCert, serverNegotiation)
+        client = Tub(certData=clientCert)
+        client.negotiationClass = clientNegotiation
+        client.startService()
+        self.services.append(client)
+        d = client.getReference(url)
+        def _got_rref(rref):
+            client_broker = rref.tracker.broker
+            server_broker = self.tub.brokers.values()[0]
+            return client_broker, server_broker
+        d.addCallback(_got_rref)
+        return d
+
+    def checkFeatures(self, brokers, expected):
+        for b in brokers:
+            self.failUnlessEqual(b.negotiatedFeatures, frozenset(expected))
+            self.failUnlessEqual(b.useAutoVocabulary,
+                                 "auto-vocab" in expected)
+            self.failUnlessEqual(b.useCallCancel, "call-cancel" in expected)
+            self.failUnlessEqual(b.useCallBatch, "call-batch" in expected)
+            self.failUnlessEqual(b.useDecrefMany, "decref-many" in expected)
+            self.failUnlessEqual(b.useCallPipeline,
+                                 "call-pipeline" in expected)
+
+    def test_both_new_server_decides(self):
+        d = self.connect(certData_high, certData_low)
+        d.addCallback(self.checkFeatures, ["auto-vocab", "call-cancel", "call-batch",
+                             "decref-many", "call-pipeline"])
+        return d
+
+    def test_both_new_client_decides(self):
+        d = self.connect(certData_low, certData_high)
+        d.addCallback(self.checkFeatures, ["auto-vocab", "call-cancel", "call-batch",
+                             "decref-many", "call-pipeline"])
+        return d
+
+    def test_old_client(self):
+        d = self.connect(certData_high, certData_low,
+                         clientNegotiation=NegotiationNoFeatures)
+        d.addCallback(self.checkFeatures, [])
+        return d
+
+    def test_old_server(self):
+        d = self.connect(certData_high, certData_low,
+                         serverNegotiation=NegotiationNoFeatures)
+        d.addCallback(self.checkFeatures, [])
+        return d
+
+    def test_old_client_decides(self):
+        d = self.connect(certData_low, certData_high,
+                         clientNegotiation=NegotiationNoFeatures)
+        d.addCallback(self.checkFeatures, [])
+        return d
+
 class Replacement(BaseMixin, unittest.TestCase):
     # in certain circumstances, a new connection is supposed to replace an
     # existing one.
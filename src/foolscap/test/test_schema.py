@@ -24,8 +24,13 @@ class ConformTest(unittest.TestCase):
     """
     def conforms(self, c, obj):
         c.checkObject(obj, False)
+        c.compileChecker()(obj, False)
     def violates(self, c, obj):
-        self.assertRaises(schema.Violation, c.checkObject, obj, False)
+        v = self.assertRaises(schema.Violation, c.checkObject, obj, False)
+        # the compiled checker must raise the very same Violation
+        v2 = self.assertRaises(schema.Violation,
+                               c.compileChecker(), obj, False)
+        self.failUnlessEqual(str(v2), str(v))
 
     def testInteger(self):
         # s_int32_t
@@ -323,6 +328,20 @@ class CreateTest(unittest.TestCase):
         self.check(c, RemoteInterfaceConstraint)
         self.failUnlessEqual(c.interface, None)
 
+    def testCheckedOnReceive(self):
+        # these can be enforced entirely as the tokens arrive
+        for c in [int, str, bool, float, schema.Any(), schema.Nothing(),
+                  schema.ListOf(schema.DictOf(str, schema.ListOf(int))),
+                  schema.TupleOf(int, str), schema.ByteStringConstraint(10)]:
+            self.failUnless(IConstraint(c).checkedOnReceive, c)
+        # these need another look at the finished object
+        for c in [unicode, schema.ChoiceOf(int, str),
+                  schema.ByteStringConstraint(regexp="a"),
+                  schema.ListOf(int, minLength=1),
+                  schema.ListOf(schema.DictOf(str, unicode)),
+                  schema.TupleOf(int, common.RIHelper)]:
+            self.failIf(IConstraint(c).checkedOnReceive, c)
+
 
 class Arguments(unittest.TestCase):
     def test_arguments(self):
@@ -373,6 +392,27 @@ class Arguments(unittest.TestCase):
         self.failUnlessRaises(schema.Violation,
                               r.checkResults, 12, False)
 
+    def test_required_arguments(self):
+        def foo(a=int, b=schema.Optional(int, 0), c=int): return str
+        r = RemoteMethodSchema(method=foo)
+        r.checkRequiredArgs((1,), {"c": 3})
+        r.checkRequiredArgs((1, 2, 3), {})
+        r.checkRequiredArgs((), {"a": 1, "c": 3})
+        self.failUnlessRaises(schema.Violation, # missing required "c"
+                              r.checkRequiredArgs, (1, 2), {})
+        self.failUnlessRaises(schema.Violation, # missing required "a"
+                              r.checkRequiredArgs, (), {"b": 2, "c": 3})
+
+    def test_compiled_locations(self):
+        # the compiled argument checkers report the same location
+        def foo(a=schema.ListOf(schema.DictOf(str, int)), b=(int, str)):
+            return str
+        r = RemoteMethodSchema(method=foo)
+        v = self.failUnlessRaises(schema.Violation, r.checkAllArgs,
+                                  ([{"x": "oops"}], (1, "a")), {}, False)
+        self.failUnlessSubstring("(a=)", str(v))
+        self.failUnlessSubstring("is not a number", str(v))
+
     def test_bad_arguments(self):
         def foo(nodefault): return str
         self.failUnlessRaises(InvalidRemoteInterface,
@@ -2,13 +2,17 @@
 
 from twisted.trial import unittest
 from twisted.application import service
+from twisted.internet import defer
 from cStringIO import StringIO
-import gc
+import StringIO as pyStringIO
+import gc, mmap
 
 from foolscap.api import Referenceable, Copyable, RemoteCopy, \
-     flushEventualQueue, serialize, unserialize, Tub
+     flushEventualQueue, serialize, unserialize, serialize_sync, \
+     unserialize_sync, Tub
+from foolscap import slicer, storage
 from foolscap.referenceable import RemoteReference
-from foolscap.tokens import Violation
+from foolscap.tokens import Violation, BananaError
 from foolscap.util import allocate_tcp_port
 from foolscap.test.common import ShouldFailMixin
 
@@ -147,3 +151,134 @@ class Serialize(unittest.TestCase, ShouldFailMixin):
                                       t2.unserialize, data))
         return d
     test_referenceables_die.timeout = 5
+
+class StallingSlicer(slicer.BaseSlicer):
+    def slice(self, streamable, banana):
+        self.streamable = streamable
+        yield defer.Deferred()
+
+class SyncStorage(unittest.TestCase):
+    def test_round_trip(self):
+        for obj in [1, -5, 4.5, "abc", u"\u1234", None, True,
+                    [1, (2, 3)], {"a": set([1]), "b": 2**70}]:
+            data = serialize_sync(obj)
+            self.failUnlessEqual(unserialize_sync(data), obj)
+
+    def test_matches_async(self):
+        obj = {"a": [1, 2, 3], "b": ("x", None)}
+        d = serialize(obj)
+        d.addCallback(self.failUnlessEqual, serialize_sync(obj))
+        return d
+
+    def test_references(self):
+        l = [1]
+        data = serialize_sync([l, l])
+        new = unserialize_sync(data)
+        self.failUnlessEqual(new, [[1], [1]])
+        self.failUnlessIdentical(new[0], new[1])
+        # pooled Bananas must not carry references from one call to the next
+        self.failUnlessEqual(serialize_sync([l, l]), data)
+        self.failUnlessEqual(unserialize_sync(data), new)
+
+    def test_unsafe(self):
+        foo = Foo()
+        foo.a = 1
+        data = serialize_sync(foo, root_class=storage.UnsafeStorageRootSlicer)
+        foo2 = unserialize_sync(data,
+                                root_class=storage.UnsafeStorageRootUnslicer)
+        self.failUnlessEqual(foo2.__class__, Foo)
+        self.failUnlessEqual(foo2.a, 1)
+        self.failUnlessRaises(Violation, unserialize_sync, data)
+
+    def test_unserializable(self):
+        self.failUnlessRaises(Violation, serialize_sync, open)
+        self.failUnlessEqual(serialize_sync(1), "\x01\x81")
+
+    def test_stall(self):
+        e = self.failUnlessRaises(BananaError,
+                                  serialize_sync, StallingSlicer(None))
+        self.failUnless("cannot be serialized synchronously" in str(e), e)
+        self.failUnlessEqual(serialize_sync(2), "\x02\x81")
+
+    def test_bad_input(self):
+        data = serialize_sync([1, 2])
+        e = self.failUnlessRaises(BananaError, unserialize_sync, data[:-2])
+        self.failUnless("incomplete" in str(e), e)
+        e = self.failUnlessRaises(BananaError, unserialize_sync, data+data)
+        self.failUnless("got 2" in str(e), e)
+        self.failUnlessEqual(unserialize_sync(data), [1, 2])
+
+class MeasuringBanana(storage.StorageBanana):
+    largestBuffer = 0
+    def dataReceived(self, chunk):
+        storage.StorageBanana.dataReceived(self, chunk)
+        self.largestBuffer = max(self.largestBuffer, len(self.buffer))
+
+class CountingStream(pyStringIO.StringIO):
+    writes = 0
+    def write(self, data):
+        self.writes += 1
+        pyStringIO.StringIO.write(self, data)
+
+class Streams(unittest.TestCase):
+    obj = ["look at the pretty graph", 3, True, {"x": ("y",)}]
+
+    def test_file(self):
+        data = serialize_sync(self.obj)
+        d = unserialize(StringIO(data))
+        d.addCallback(self.failUnlessEqual, self.obj)
+        d.addCallback(lambda ign: unserialize_sync(StringIO(data)))
+        d.addCallback(self.failUnlessEqual, self.obj)
+        return d
+
+    def test_iterator(self):
+        data = serialize_sync(self.obj)
+        chunks = [data[i:i+3] for i in range(0, len(data), 3)]
+        d = unserialize(iter(chunks))
+        d.addCallback(self.failUnlessEqual, self.obj)
+        d.addCallback(lambda ign: unserialize_sync(chunks))
+        d.addCallback(self.failUnlessEqual, self.obj)
+        return d
+
+    def test_mmap(self):
+        fn = self.mktemp()
+        f = open(fn, "wb")
+        serialize_sync(self.obj, outstream=f)
+        f.close()
+        f = open(fn, "rb")
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.failUnlessEqual(unserialize_sync(m), self.obj)
+        m.close()
+        f.close()
+
+    def test_bounded(self):
+        # the receive buffer only ever holds a few reads' worth of data
+        obj = ["%d" % i * 100 for i in range(10000)]
+        data = serialize_sync(obj)
+        self.failUnless(len(data) > 10*storage.READ_SIZE)
+        b = MeasuringBanana()
+        d = unserialize(StringIO(data), banana=b)
+        d.addCallback(self.failUnlessEqual, obj)
+        def _check(ign):
+            self.failUnless(0 < b.largestBuffer <= 3*storage.READ_SIZE,
+                            b.largestBuffer)
+        d.addCallback(_check)
+        return d
+
+    def test_outstream(self):
+        # large objects are written out in pieces, without being assembled
+        # into a single string first
+        obj = ["%d" % i * 100 for i in range(10000)]
+        out = CountingStream()
+        d = serialize(obj, outstream=out)
+        def _check(res):
+            self.failUnlessIdentical(res, out)
+            self.failUnless(out.writes > 10, out.writes)
+            self.failUnlessEqual(out.getvalue(), serialize_sync(obj))
+            out2 = CountingStream()
+            self.failUnlessIdentical(serialize_sync(obj, outstream=out2),
+                                     out2)
+            self.failUnless(out2.writes > 10, out2.writes)
+            self.failUnlessEqual(out2.getvalue(), out.getvalue())
+        d.addCallback(_check)
+        return d
@@ -0,0 +1,90 @@
+from twisted.trial import unittest
+from twisted.internet import task
+
+from foolscap.timerwheel import TimerWheel
+
+class Wheel(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000.0)
+        self.fired = []
+
+    def makeWheel(self, resolution=1.0, slots=8):
+        return TimerWheel(resolution, slots, self.clock)
+
+    def cb(self, name):
+        def _fired(now):
+            self.fired.append((name, now))
+        return _fired
+
+    def tickAt(self, w, now):
+        self.clock.advance(now - self.clock.seconds())
+
+    def test_fire(self):
+        w = self.makeWheel()
+        w.schedule("a", 1002.5, self.cb("a"))
+        w.schedule("b", 1003.0, self.cb("b"))
+        w.schedule("c", 1005.0, self.cb("c"))
+        self.failUnlessEqual(len(w), 3)
+        self.tickAt(w, 1002.0)
+        self.failUnlessEqual(self.fired, [])
+        # timers are never early, and all the due ones fire together
+        self.tickAt(w, 1003.0)
+        self.failUnlessEqual(sorted(self.fired),
+                             [("a", 1003.0), ("b", 1003.0)])
+        self.failUnlessEqual(len(w), 1)
+        self.tickAt(w, 1006.0)
+        self.failUnlessEqual(self.fired[-1], ("c", 1006.0))
+        self.failUnlessEqual(len(w), 0)
+        self.failUnlessEqual(w.timer, None)
+        self.failUnlessEqual(w.fired, 3)
+
+    def test_later_revolution(self):
+        w = self.makeWheel(slots=8)
+        w.schedule("a", 1001.0, self.cb("a"))
+        w.schedule("b", 1009.0, self.cb("b")) # same slot, next revolution
+        self.tickAt(w, 1001.0)
+        self.failUnlessEqual(self.fired, [("a", 1001.0)])
+        self.tickAt(w, 1008.5)
+        self.failUnlessEqual(len(self.fired), 1)
+        self.tickAt(w, 1009.0)
+        self.failUnlessEqual(self.fired[-1], ("b", 1009.0))
+
+    def test_fell_behind(self):
+        w = self.makeWheel(slots=8)
+        for i in range(20):
+            w.schedule(i, 1001.0 + i, self.cb(i))
+        self.tickAt(w, 1030.0)
+        self.failUnlessEqual(sorted([name for (name, now) in self.fired]),
+                             range(20))
+
+    def test_reschedule_and_cancel(self):
+        w = self.makeWheel()
+        w.schedule("a", 1001.0, self.cb("a"))
+        w.schedule("a", 1004.0, self.cb("a2"))
+        w.schedule("b", 1002.0, self.cb("b"))
+        w.cancel("b")
+        w.cancel("nonexistent")
+        self.tickAt(w, 1003.0)
+        self.failUnlessEqual(self.fired, [])
+        self.tickAt(w, 1004.0)
+        self.failUnlessEqual(self.fired, [("a2", 1004.0)])
+        w.schedule("c", 1010.0, self.cb("c"))
+        self.failIfEqual(w.timer, None)
+        w.cancel("c")
+        # the reactor timer is only used while something is scheduled
+        self.failUnlessEqual(w.timer, None)
+
+    def test_callback_reschedules(self):
+        w = self.makeWheel()
+        def _again(now):
+            self.fired.append(now)
+            if len(self.fired) < 3:
+                w.schedule("a", now, _again)
+        w.schedule("a", 1001.0, _again)
+        # a timer scheduled from a callback goes into a later tick
+        self.tickAt(w, 1001.0)
+        self.tickAt(w, 1002.0)
+        self.tickAt(w, 1003.0)
+        self.tickAt(w, 1004.0)
+        self.failUnlessEqual(self.fired, [1001.0, 1002.0, 1003.0])
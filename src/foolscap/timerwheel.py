@@ -0,0 +1,104 @@
+# -*- test-case-name: foolscap.test.test_timerwheel -*-
+
+import math
+from twisted.internet import reactor as _reactor
+from twisted.python import log
+
+class TimerWheel:
+    """I am a hashed timer wheel: a coarse substitute for a large number of
+    reactor.callLater timers which are rescheduled much more often than
+    they fire, like the idle timers of many connections.
+
+    Time is divided into ticks of 'resolution' seconds, and each timer lives
+    in the slot for the tick at (or just after) its deadline, modulo the
+    number of slots. While any timers are scheduled, a single reactor timer
+    wakes me once per tick, and every timer which has come due is fired in
+    that one pass. Timers can fire up to one tick late, but never early.
+
+    Timers are identified by a key (any hashable object): scheduling a key
+    again moves it. 'reactor' is anything that provides IReactorTime.
+    """
+
+    def __init__(self, resolution=1.0, slots=512, reactor=_reactor):
+        self.resolution = resolution
+        self.reactor = reactor
+        self.clock = reactor.seconds
+        # each slot maps key to callback
+        self.slots = [{} for i in range(slots)]
+        # maps key to the tick at which it is due
+        self.ticks = {}
+        self.lastTick = self._tickBefore(self.clock())
+        self.timer = None
+        self.fired = 0
+
+    def _tickBefore(self, when):
+        return int(math.floor(when / self.resolution))
+
+    def schedule(self, key, when, callback):
+        """Arrange for callback(now) to be called once 'when' (in
+        seconds-since-epoch) has passed."""
+        self.cancel(key)
+        if self.timer is None:
+            # we have been asleep, so no ticks are owed
+            self.lastTick = self._tickBefore(self.clock())
+        tick = int(math.ceil(when / self.resolution))
+        tick = max(tick, self.lastTick + 1)
+        self.ticks[key] = tick
+        self.slots[tick % len(self.slots)][key] = callback
+        if self.timer is None:
+            self._startTimer()
+
+    def cancel(self, key):
+        tick = self.ticks.pop(key, None)
+        if tick is None:
+            return
+        del self.slots[tick % len(self.slots)][key]
+        if not self.ticks and self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def stop(self):
+        self.ticks.clear()
+        for slot in self.slots:
+            slot.clear()
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def _startTimer(self):
+        delay = (self.lastTick + 1) * self.resolution - self.clock()
+        self.timer = self.reactor.callLater(max(delay, 0), self._tick)
+
+    def _tick(self):
+        self.timer = None
+        now = self.clock()
+        current = self._tickBefore(now)
+        first = self.lastTick + 1
+        self.lastTick = current
+        nslots = len(self.slots)
+        if current - first + 1 >= nslots:
+            # we fell behind by a whole revolution: look at every slot
+            slots = self.slots
+        else:
+            slots = [self.slots[t % nslots] for t in range(first, current+1)]
+        ticks = self.ticks
+        due = []
+        for slot in slots:
+            for key, callback in slot.items():
+                if ticks[key] <= current:
+                    # otherwise it belongs to a later revolution
+                    del slot[key]
+                    del ticks[key]
+                    due.append(callback)
+        self.fired += len(due)
+        # callbacks can schedule themselves again, in a later tick
+        for callback in due:
+            try:
+                callback(now)
+            except:
+                log.err()
+        if self.ticks and self.timer is None:
+            self._startTimer()
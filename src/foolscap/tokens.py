@@ -231,6 +231,23 @@ class IRootSlicer(Interface):
         """Called when the transport is closed. The RootSlicer may choose to
         abandon objects being sent here."""
 
+class IStreamedString(Interface):
+    """I am sent as a single STRING token, but my body is read in pieces as
+    the transport accepts it, rather than being held in memory first."""
+
+    size = Attribute(\
+"""The length of the string. This must be known before any of it is
+sent.""")
+
+class StringBodyChunk(object):
+    """A piece of the body of a STRING token. Slicers which stream a
+    string call banana.sendStringHeader(size) and then yield these, and
+    produce() writes their data to the transport unchanged."""
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
 class IUnslicer(Interface):
     # .parent
 